@@ -0,0 +1,9 @@
+'''
+Performance benchmarks for piep.
+
+These are not run as part of the test suite; run each one as a module
+from the repository root, e.g. ``python -m bench.reader``.
+
+``python -m bench.suite`` times a set of representative pipelines end to end,
+and can compare the results against a saved baseline.
+'''
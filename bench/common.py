@@ -0,0 +1,45 @@
+from __future__ import print_function
+import os
+import sys
+import time
+import tempfile
+import contextlib
+
+def best_of(fn, repeat=3):
+	'''return the fastest wall-clock time (in seconds) of ``repeat`` calls to ``fn``'''
+	best = None
+	for _ in range(repeat):
+		start = time.perf_counter()
+		fn()
+		elapsed = time.perf_counter() - start
+		if best is None or elapsed < best:
+			best = elapsed
+	return best
+
+def report(title, rows):
+	'''print a table of (label, seconds[, extra]) rows, relative to the first row'''
+	print(title)
+	base = rows[0][1]
+	for row in rows:
+		label, seconds = row[:2]
+		extra = ' '.join(str(x) for x in row[2:])
+		print('  %-40s %9.4fs  x%.2f  %s' % (label, seconds, base / seconds if seconds else 0, extra))
+	sys.stdout.flush()
+
+@contextlib.contextmanager
+def temp_file(contents):
+	'''yields the path of a temporary file holding ``contents`` (bytes)'''
+	fd, path = tempfile.mkstemp(prefix='piep-bench-')
+	try:
+		with os.fdopen(fd, 'wb') as f:
+			f.write(contents)
+		yield path
+	finally:
+		os.remove(path)
+
+def log_lines(n, start=0):
+	'''generate ``n`` deterministic access-log style lines (as bytes), from line number ``start``'''
+	return b''.join(
+		b'10.0.%d.%d - - [01/Jan/2020:00:00:%02d] "GET /path/%d/item.html HTTP/1.1" %d %d\n' % (
+			(i // 256) % 256, i % 256, i % 60, i % 997, 200 if i % 7 else 404, (i * 7919) % 100000)
+		for i in range(start, start + n))
@@ -0,0 +1,95 @@
+'''
+Deterministic synthetic datasets for the benchmark suite: access logs,
+path lists and JSON lines, at sizes from 1MB to 1GB.
+
+Datasets are generated once (into ``$PIEP_BENCH_DIR``, or a ``piep-bench``
+directory under the system temp directory) and reused by later runs. Since the
+contents only depend on the kind and size, results from different machines
+(or runs) are comparable.
+
+	python -m bench.datasets [SIZE ...]
+'''
+from __future__ import print_function
+import os
+import sys
+import json
+import tempfile
+from bench.common import log_lines
+
+SIZES = {
+	'1M': 1024 * 1024,
+	'100M': 100 * 1024 * 1024,
+	'1G': 1024 * 1024 * 1024,
+}
+
+# lines generated at a time
+CHUNK = 10000
+
+def data_dir():
+	return os.environ.get('PIEP_BENCH_DIR') or os.path.join(tempfile.gettempdir(), 'piep-bench')
+
+def path_lines(n, start=0):
+	'''generate ``n`` sorted-looking paths (as bytes), each directory followed by its files'''
+	lines = []
+	for i in range(start, start + n):
+		package, module = divmod(i, 50)
+		if module == 0:
+			lines.append(b'src/pkg%d/\n' % (package,))
+		else:
+			lines.append(b'src/pkg%d/sub%d/module_%d%s\n' % (package, module % 7, module, b'.py' if module % 3 else b'.txt'))
+	return b''.join(lines)
+
+_STATUSES = [200, 200, 200, 301, 404, 500]
+def json_lines(n, start=0):
+	'''generate ``n`` JSON objects, one per line (as bytes)'''
+	return b''.join(
+		json.dumps({
+			'id': i,
+			'user': 'user%d' % ((i * 31) % 1000,),
+			'status': _STATUSES[i % len(_STATUSES)],
+			'path': '/api/v1/items/%d' % (i % 997,),
+			'tags': ['t%d' % (i % 5,), 't%d' % (i % 11,)],
+		}, sort_keys=True).encode('ascii') + b'\n'
+		for i in range(start, start + n))
+
+KINDS = {
+	'logs': log_lines,
+	'paths': path_lines,
+	'json': json_lines,
+}
+
+def generate(path, kind, size):
+	'''write ``size`` bytes (rounded down to a whole line) of ``kind`` lines to ``path``'''
+	make_lines = KINDS[kind]
+	tmp = path + '.tmp'
+	written = 0
+	start = 0
+	with open(tmp, 'wb') as f:
+		while written < size:
+			chunk = make_lines(CHUNK, start)
+			start += CHUNK
+			if written + len(chunk) > size:
+				chunk = chunk[:chunk.rfind(b'\n', 0, size - written) + 1]
+				if not chunk:
+					break
+			f.write(chunk)
+			written += len(chunk)
+	os.rename(tmp, path)
+
+def dataset(kind, size):
+	'''return the path of the ``kind`` dataset of ``size`` (a key of ``SIZES``), generating it if necessary'''
+	directory = data_dir()
+	path = os.path.join(directory, '%s-%s.txt' % (kind, size))
+	if not os.path.exists(path):
+		if not os.path.isdir(directory):
+			os.makedirs(directory)
+		generate(path, kind, SIZES[size])
+	return path
+
+def main(*sizes):
+	for size in sizes or ['1M']:
+		for kind in sorted(KINDS):
+			print(dataset(kind, size))
+
+if __name__ == '__main__':
+	main(*sys.argv[1:])
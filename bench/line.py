@@ -0,0 +1,64 @@
+'''
+Measure the memory used by each input line, and the time taken by chains
+of string methods.
+
+"Line methods" runs each method through its ``piep.Line`` wrapper (as piep
+does when it can't tell that ``p`` is a string), "plain str" is the same
+chain using plain ``str`` methods with only the result converted to a ``Line``.
+
+	python -m bench.line [LINES]
+'''
+from __future__ import print_function
+import sys
+import tracemalloc
+from piep import main as piep_main
+from piep.builtins import builtins
+from piep.line import Line
+from piep.sequence import Stream
+from bench.common import best_of, log_lines
+
+PIPELINES = [
+	'p.upper()',
+	'p.strip().lower()',
+	'p.strip().lower().split()[2]',
+	'p.split()[0].startswith("10.0.1")',
+]
+
+class DictLine(str):
+	'''a str subclass with a __dict__ (like piep.Line before it had __slots__)'''
+
+def memory_per_line(cls, lines):
+	tracemalloc.start()
+	try:
+		# (decoding creates a new string, whereas str(line) returns the same one)
+		held = [cls(line.encode('ascii').decode('ascii')) for line in lines]
+		size = tracemalloc.get_traced_memory()[0]
+	finally:
+		tracemalloc.stop()
+	del held
+	return size / float(len(lines))
+
+def run_pipeline(code, lines):
+	globs = builtins.copy()
+	globs['pp'] = Stream(lines)
+	piep_main.execfn(code, globs)
+	for _ in globs['pp']:
+		pass
+
+def main(n=100000):
+	text = log_lines(n).decode('ascii').splitlines()
+	print('memory per line (bytes, including the list holding it)')
+	for label, cls in [('str', str), ('str subclass with __dict__', DictLine), ('piep.Line', Line)]:
+		print('  %-40s %8.1f  (getsizeof: %d)' % (label, memory_per_line(cls, text), sys.getsizeof(cls(text[0]))))
+
+	lines = [Line(line) for line in text]
+	print('%-40s %14s %10s' % ('time per line (ns)', 'Line methods', 'plain str'))
+	for pipeline in PIPELINES:
+		exprs = piep_main.split_on_pipes(pipeline)
+		wrapped = piep_main.compile_pipe_exprs(exprs)
+		plain = piep_main.compile_pipe_exprs(exprs, input_lines=True)
+		timings = [best_of(lambda: run_pipeline(code, lines)) for code in (wrapped, plain)]
+		print('%-40s %14.0f %10.0f' % ((pipeline,) + tuple(t * 1e9 / n for t in timings)))
+
+if __name__ == '__main__':
+	main(*map(int, sys.argv[1:]))
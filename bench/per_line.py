@@ -0,0 +1,62 @@
+'''
+Measure piep's per-line overhead for simple linewise pipelines, compared
+to the same expression in a plain python loop.
+
+"per-line call" is the ``pp.map_index(_transformer)`` path (still used
+for ``--jobs`` and for expressions whose closures capture per-line variables),
+"fused" is the generated loop with every per-line check, and "specialised" is
+the fused loop without the checks which can't apply (what piep actually runs).
+
+	python -m bench.per_line [LINES]
+'''
+from __future__ import print_function
+import sys
+from piep import main as piep_main
+from piep.builtins import builtins
+from piep.sequence import Stream
+from piep.line import Line
+from bench.common import best_of, log_lines
+
+PIPELINES = [
+	('p', lambda lines: [l for l in lines]),
+	('p.upper()', lambda lines: [l.upper() for l in lines]),
+	('"404" in p', lambda lines: [l for l in lines if '404' in l]),
+	('p.startswith("10.0.1.")', lambda lines: [l for l in lines if l.startswith('10.0.1.')]),
+	('p.split() | p[0] | p.upper()', lambda lines: [l.split()[0].upper() for l in lines]),
+	('p.strip().lower() | "get" in p', lambda lines: [l for l in (l.strip().lower() for l in lines) if 'get' in l]),
+]
+
+def _serial_map_index(pp, fn, jobs, names, source=None):
+	return pp.map_index(fn)
+
+def run_pipeline(code, lines, per_line_call):
+	globs = builtins.copy()
+	globs['pp'] = Stream(lines)
+	if per_line_call:
+		globs['_parallel_map_index'] = _serial_map_index
+	piep_main.execfn(code, globs)
+	for _ in globs['pp']:
+		pass
+
+def main(n=200000):
+	# (input lines are always `piep.Line` instances)
+	lines = [Line(line) for line in log_lines(n).decode('ascii').splitlines()]
+	print('%-36s %8s %15s %8s %13s' % ('per line (ns)', 'python', 'per-line call', 'fused', 'specialised'))
+	for pipeline, plain in PIPELINES:
+		exprs = piep_main.split_on_pipes(pipeline)
+		# an unknown `--eval` keeps every check in place
+		fused = piep_main.compile_pipe_exprs(exprs, rebound=['*'])
+		specialised = piep_main.compile_pipe_exprs(exprs, input_lines=True)
+		# compiling for multiple jobs produces the per-line `_transformer`,
+		# which run_pipeline then applies serially with pp.map_index
+		per_line = piep_main.compile_pipe_exprs(exprs, jobs=2, rebound=['*'])
+		timings = [
+			best_of(lambda: plain(lines)),
+			best_of(lambda: run_pipeline(per_line, lines, True)),
+			best_of(lambda: run_pipeline(fused, lines, False)),
+			best_of(lambda: run_pipeline(specialised, lines, False)),
+		]
+		print('%-36s %8.0f %15.0f %8.0f %13.0f' % ((pipeline,) + tuple(t * 1e9 / n for t in timings)))
+
+if __name__ == '__main__':
+	main(*map(int, sys.argv[1:]))
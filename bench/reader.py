@@ -0,0 +1,30 @@
+'''
+Compare the bulk block reader (and the memory-mapped reader) used for
+piep's input against plain per-line text iteration.
+
+	python -m bench.reader [NUM_LINES]
+'''
+from __future__ import print_function
+import sys
+from piep.line import Line
+from piep.reader import read_lines, map_lines
+from bench.common import best_of, report, temp_file, log_lines
+
+def line_by_line(path):
+	with open(path) as f:
+		for _ in map(lambda x: Line(x.rstrip('\n\r')), iter(f)): pass
+
+def chunked(path, bufsize, reader=read_lines):
+	with open(path) as f:
+		for _ in reader(f, bufsize=bufsize): pass
+
+def main(num_lines=500000):
+	with temp_file(log_lines(num_lines)) as path:
+		rows = [('line-by-line text iteration', best_of(lambda: line_by_line(path)))]
+		for bufsize in (8 * 1024, 64 * 1024, 1024 * 1024, 8 * 1024 * 1024):
+			rows.append(('read_lines(bufsize=%d)' % bufsize, best_of(lambda: chunked(path, bufsize))))
+			rows.append(('map_lines(bufsize=%d)' % bufsize, best_of(lambda: chunked(path, bufsize, map_lines))))
+		report('reading %d lines:' % num_lines, rows)
+
+if __name__ == '__main__':
+	main(*map(int, sys.argv[1:]))
@@ -0,0 +1,55 @@
+'''
+Measure regex-heavy pipelines: a constant pattern (which is compiled once),
+and cycling through many distinct patterns (more than the ``re`` module's
+own cache holds).
+
+"re module" is the plain ``re.search`` each line used to make, "piep" is
+what piep runs now.
+
+	python -m bench.regex [LINES]
+'''
+from __future__ import print_function
+import re
+import sys
+from piep import main as piep_main
+from piep.builtins import builtins
+from piep.line import Line
+from piep.sequence import Stream
+from bench.common import best_of, log_lines
+
+def run_pipeline(code, lines, bindings):
+	globs = builtins.copy()
+	globs.update(bindings)
+	globs['pp'] = Stream(lines)
+	piep_main.execfn(code, globs)
+	for _ in globs['pp']:
+		pass
+
+def plain_search(patterns):
+	def run(lines):
+		search = re.search
+		count = len(patterns)
+		return [l for i, l in enumerate(lines) if search(patterns[i % count], l)]
+	return run
+
+def main(n=100000):
+	lines = [Line(line) for line in log_lines(n).decode('ascii').splitlines()]
+	print('%-44s %12s %12s' % ('per line (ns)', 're module', 'piep'))
+
+	def compare(label, pipeline, patterns):
+		code = piep_main.compile_pipe_exprs(piep_main.split_on_pipes(pipeline), input_lines=True)
+		bindings = {'PATTERNS': patterns}
+		timings = [
+			best_of(lambda: plain_search(patterns)(lines)),
+			best_of(lambda: run_pipeline(code, lines, bindings)),
+		]
+		print('%-44s %12.0f %12.0f' % ((label,) + tuple(t * 1e9 / n for t in timings)))
+
+	compare('p.matches("HTTP/1.[01]\\" 404")', 'p.matches("HTTP/1.[01]\\" 404")', ['HTTP/1.[01]" 404'])
+	compare('re.search("HTTP/1.[01]\\" 404", p)', 're.search("HTTP/1.[01]\\" 404", p)', ['HTTP/1.[01]" 404'])
+	for distinct in (10, 100, 1000):
+		patterns = ['/path/%d/item' % (n,) for n in range(distinct)]
+		compare('p.matches(PATTERNS[i %% %d])' % (distinct,), 'p.matches(PATTERNS[i %% %d])' % (distinct,), patterns)
+
+if __name__ == '__main__':
+	main(*map(int, sys.argv[1:]))
@@ -0,0 +1,37 @@
+'''
+Measure how pipeline splitting scales with the length of the pipeline,
+from 100 bytes to 1MB (with a large embedded literal, as generated
+pipelines tend to have).
+
+	python -m bench.split [MAX_BYTES]
+'''
+from __future__ import print_function
+import sys
+from piep.main import split_on_pipes, _split_chars
+from bench.common import best_of
+
+def pipeline(size):
+	items = []
+	length = 0
+	n = 0
+	while length < size:
+		item = '"item|%d": (%d, [%d])' % (n, n, n)
+		items.append(item)
+		length += len(item) + 2
+		n += 1
+	return 'p.strip() | {%s}.get(p) | p is not None | "(%%s)" %% (p,)' % (', '.join(items),)
+
+def main(max_bytes=1024 * 1024):
+	print('%10s %14s %14s' % ('bytes', 'tokenize', 'scan'))
+	for size in (100, 1000, 10 * 1000, 100 * 1000, 1024 * 1024):
+		if size > max_bytes:
+			break
+		cmd = pipeline(size)
+		assert len(split_on_pipes(cmd)) == 4
+		print('%10d %13.4fs %13.4fs' % (
+			len(cmd),
+			best_of(lambda: split_on_pipes(cmd)),
+			best_of(lambda: _split_chars(cmd))))
+
+if __name__ == '__main__':
+	main(*map(int, sys.argv[1:]))
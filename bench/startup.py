@@ -0,0 +1,56 @@
+'''
+Measure piep's cold-start import time, by parsing the output of
+``python -X importtime``. Exits with a failure status if the median
+import time of ``piep.main`` exceeds the budget.
+
+	python -m bench.startup [BUDGET_MS] [RUNS]
+'''
+from __future__ import print_function
+import os
+import sys
+import subprocess
+
+# modules which should only be loaded by pipelines which need them
+LAZY_MODULES = ['ast', 'subprocess', 'shlex', 'tempfile', 'hashlib', 'multiprocessing', 'mmap']
+
+def import_times(module='piep.main'):
+	'''returns a dict of {module: cumulative import time (in microseconds)} for a fresh interpreter'''
+	root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+	env = dict(os.environ, PYTHONPATH=root)
+	proc = subprocess.Popen(
+		[sys.executable, '-X', 'importtime', '-c', 'import ' + module],
+		stderr=subprocess.PIPE, env=env)
+	_, err = proc.communicate()
+	assert proc.returncode == 0, err.decode('utf-8')
+	times = {}
+	for line in err.decode('utf-8').splitlines():
+		if not line.startswith('import time:') or 'cumulative' in line:
+			continue
+		_, self_us, cumulative_us, name = [part.strip() for part in line.replace('import time:', '|').split('|')]
+		times[name] = int(cumulative_us)
+	return times
+
+def main(budget_ms=100, runs=10):
+	samples = []
+	loaded = set()
+	for _ in range(runs):
+		times = import_times()
+		samples.append(times['piep.main'] / 1000.0)
+		loaded.update(times)
+	samples.sort()
+	median = samples[len(samples) // 2]
+	print('import piep.main: median %.1fms, min %.1fms, max %.1fms (budget %sms)' % (
+		median, samples[0], samples[-1], budget_ms))
+
+	failed = False
+	eager = sorted(loaded.intersection(LAZY_MODULES))
+	if eager:
+		print('FAIL: modules imported eagerly: %s' % (', '.join(eager),))
+		failed = True
+	if median > budget_ms:
+		print('FAIL: import time exceeds budget')
+		failed = True
+	return 1 if failed else 0
+
+if __name__ == '__main__':
+	sys.exit(main(*map(float, sys.argv[1:2]), *map(int, sys.argv[2:3])))
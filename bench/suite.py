@@ -0,0 +1,197 @@
+'''
+Time a suite of representative pipelines over generated datasets (see
+:mod:`bench.datasets`), both in-process (``piep.main.run``) and as a
+``python -m piep`` subprocess. Where the equivalent ``awk`` / ``sed`` / ``sort``
+commands are available, they're timed too (once their output has been checked
+against piep's, so that the two don't drift apart).
+
+Results can be saved as JSON, and compared against a previously saved
+baseline: cases which have become more than ``--threshold`` slower are
+reported, and the exit status is nonzero.
+
+	python -m bench.suite [--size=1M] [--repeat=3] [--only=NAME] [--json=FILE] [--baseline=FILE]
+'''
+from __future__ import print_function
+import os
+import sys
+import json
+import shutil
+import platform
+import subprocess
+from collections import deque
+from optparse import OptionParser
+from piep import main as piep_main
+from bench.common import best_of
+from bench.datasets import SIZES, dataset
+
+class Case(object):
+	'''
+	A pipeline (``args`` to piep) over the ``kind`` dataset, and optionally an
+	equivalent shell command (using only the tools in ``tools``). Both produce
+	the same output, once each is passed through ``normalise`` (if given).
+	'''
+	def __init__(self, name, kind, args, shell=None, tools=(), files=(), normalise=None):
+		self.name = name
+		self.kind = kind
+		self.args = list(args)
+		self.shell = shell
+		self.tools = tools
+		self.normalise = normalise
+		# datasets passed to piep with -f, and to the shell command as $1, $2, ...
+		self.files = files
+
+CASES = [
+	Case('filter', 'logs', ['"404" in p'],
+		shell="awk '/404/'", tools=['awk']),
+	Case('field', 'logs', ['p.split()[6]'],
+		shell="awk '{print $7}'", tools=['awk']),
+	Case('regex', 'logs', ['p.matches(r"item\\.html HTTP/1\\.1\\" 404")'],
+		shell="sed -n '/item\\.html HTTP\\/1\\.1\" 404/p'", tools=['sed']),
+	Case('sort-uniq', 'logs', ['p.split()[0] | pp.sort(uniq=True)'],
+		shell="awk '{print $1}' | sort -u", tools=['awk', 'sort']),
+	Case('sort-numeric', 'logs', ['pp.sortby(lambda l: int(l.rsplit(None, 1)[1]))'],
+		shell="sort -s -n -k 9,9", tools=['sort']),
+	Case('top-10', 'logs', ['pp.sortby(lambda l: -int(l.rsplit(None, 1)[1]))[:10]'],
+		shell="sort -s -rn -k 9,9 | sed 10q", tools=['sort', 'sed']),
+	Case('head', 'logs', ['pp[:10]'],
+		shell="sed 10q", tools=['sed']),
+	Case('tail', 'logs', ['pp[-10:]'],
+		shell="sed -e :a -e '$q;N;11,$D;ba'", tools=['sed']),
+	Case('column-sum', 'logs', ['pp.columns(types={8: int}).sum()'],
+		shell="awk '{s += $9} END {print s}'", tools=['awk']),
+	Case('counts', 'logs', ['pp.counts(lambda l: l.split(None, 1)[0], top=10)'],
+		shell="awk '{print $1}' | sort | uniq -c | sort -rn | sed 10q", tools=['awk', 'sort', 'uniq', 'sed'],
+		normalise=lambda lines: _counts(lines)),
+	Case('count', 'logs', ['len(pp)'],
+		shell="awk 'END {print NR}'", tools=['awk']),
+	Case('divide', 'paths', ['pp.divide(lambda path: path.endswith("/")) | p[0], len(p) - 1'],
+		shell="awk '/\\/$/ {if (d) print d, n; d=$0; n=0; next} {n++} END {print d, n}'", tools=['awk']),
+	Case('zip', 'paths', ['pp.zip(ff) | "%s %s" % p'], files=['logs']),
+	Case('json', 'json', ['-m', 'json', 'json.loads(p)["status"]'],
+		shell="sed 's/.*\"status\": \\([0-9]*\\).*/\\1/'", tools=['sed']),
+	Case('sh-per-line', 'paths', ['pp[:200] | sh("echo", p)']),
+]
+
+def _counts(lines):
+	'''the counts in ``pp.counts()`` (or ``uniq -c``) output, since tied keys may be in any order'''
+	return sorted(int(field) for line in lines for field in line.split() if field.isdigit())
+
+def _drain(lines):
+	deque(lines, maxlen=0)
+
+def _piep_args(case, size):
+	args = []
+	for kind in case.files:
+		args += ['-f', dataset(kind, size)]
+	return args + case.args
+
+def run_in_process(case, size):
+	path = dataset(case.kind, size)
+	opts, args = piep_main.parse_args(['-i', path] + _piep_args(case, size))
+	_drain(piep_main.run(opts, args))
+
+def _run_command(cmd, path, env=None):
+	with open(path, 'rb') as stdin:
+		subprocess.check_call(cmd, stdin=stdin, stdout=subprocess.DEVNULL, env=env)
+
+def run_subprocess(case, size):
+	env = dict(os.environ)
+	env['PYTHONPATH'] = os.path.dirname(os.path.dirname(os.path.abspath(piep_main.__file__)))
+	_run_command([sys.executable, '-m', 'piep'] + _piep_args(case, size), dataset(case.kind, size), env)
+
+def run_shell(case, size):
+	args = [dataset(kind, size) for kind in case.files]
+	_run_command(['sh', '-c', case.shell, 'sh'] + args, dataset(case.kind, size))
+
+def shell_output_matches(case, size):
+	'''run ``case`` once with piep and once with its shell command, and check that their output is the same'''
+	path = dataset(case.kind, size)
+	opts, args = piep_main.parse_args(['-i', path] + _piep_args(case, size))
+	expected = [str(line) for line in piep_main.run(opts, args)]
+	with open(path, 'rb') as stdin:
+		output = subprocess.check_output(['sh', '-c', case.shell, 'sh'] + [dataset(kind, size) for kind in case.files], stdin=stdin)
+	actual = output.decode('utf-8').splitlines()
+	if case.normalise is not None:
+		expected, actual = case.normalise(expected), case.normalise(actual)
+	return expected == actual
+
+def runners(case):
+	'''yields (label, fn) for each way of running ``case``'''
+	yield 'piep', run_in_process
+	yield 'piep (subprocess)', run_subprocess
+	if case.shell is not None and all(shutil.which(tool) for tool in case.tools):
+		yield '+'.join(case.tools), run_shell
+
+def run_suite(cases, size, repeat):
+	'''
+	returns ``{case: {runner: seconds}}``, printing each result as it's measured
+	(shell commands whose output doesn't match piep's are reported, and not timed)
+	'''
+	results = {}
+	for case in cases:
+		# (generate datasets before timing anything)
+		for kind in [case.kind] + list(case.files):
+			dataset(kind, size)
+		timings = results[case.name] = {}
+		for label, fn in runners(case):
+			if fn is run_shell and not shell_output_matches(case, size):
+				print('WARN: %s: the output of `%s` differs from piep\'s' % (case.name, case.shell))
+				continue
+			timings[label] = best_of(lambda: fn(case, size), repeat)
+			print('  %-14s %-20s %9.4fs' % (case.name, label, timings[label]))
+			sys.stdout.flush()
+	return results
+
+def compare(results, baseline, threshold):
+	'''print each timing relative to ``baseline``, and return the list of regressions'''
+	regressions = []
+	print('%-14s %-20s %10s %10s %8s' % ('case', 'runner', 'baseline', 'now', 'change'))
+	for name in sorted(results):
+		for label, seconds in sorted(results[name].items()):
+			previous = baseline.get(name, {}).get(label)
+			if not previous:
+				continue
+			change = seconds / previous - 1
+			flag = ''
+			if change > threshold and label.startswith('piep'):
+				flag = '  SLOWER'
+				regressions.append((name, label))
+			print('%-14s %-20s %9.4fs %9.4fs %+7.1f%%%s' % (name, label, previous, seconds, change * 100, flag))
+	return regressions
+
+def main(argv=None):
+	p = OptionParser('usage: python -m bench.suite [OPTIONS]')
+	p.add_option('--size', default='1M', type='choice', choices=sorted(SIZES), help='dataset size: %s (default %%default)' % ', '.join(sorted(SIZES)))
+	p.add_option('--repeat', type='int', default=3, help='take the best of N runs (default %default)')
+	p.add_option('--only', action='append', default=[], metavar='NAME', help='only run the named case(s)')
+	p.add_option('--json', metavar='FILE', help='save results to FILE')
+	p.add_option('--baseline', metavar='FILE', help='compare results against FILE (saved with --json)')
+	p.add_option('--threshold', type='float', default=0.1, help='report piep timings which are this much slower than the baseline (default %default)')
+	opts, args = p.parse_args(argv)
+
+	cases = [case for case in CASES if not opts.only or case.name in opts.only]
+	assert cases, "No such case: %s" % (', '.join(opts.only),)
+	print('%d cases over %s datasets' % (len(cases), opts.size))
+	results = run_suite(cases, opts.size, opts.repeat)
+
+	if opts.json:
+		with open(opts.json, 'w') as f:
+			json.dump({
+				'size': opts.size,
+				'repeat': opts.repeat,
+				'python': platform.python_version(),
+				'machine': platform.machine(),
+				'results': results,
+			}, f, indent=2, sort_keys=True)
+
+	if opts.baseline:
+		with open(opts.baseline) as f:
+			baseline = json.load(f)
+		if baseline.get('size') != opts.size:
+			print('WARN: baseline was measured with --size=%s' % (baseline.get('size'),))
+		if compare(results, baseline['results'], opts.threshold):
+			return 1
+	return 0
+
+if __name__ == '__main__':
+	sys.exit(main())
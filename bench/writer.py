@@ -0,0 +1,35 @@
+'''
+Compare batched output writing against one ``print()`` per line.
+
+	python -m bench.writer [NUM_LINES]
+'''
+from __future__ import print_function
+import io
+import os
+import sys
+from piep.line import Line
+from piep.writer import write_lines, format_lines
+from bench.common import best_of, report
+
+def print_each(lines, out):
+	for line in format_lines(lines, ' '):
+		print(line, file=out)
+
+def batched(lines, out, threaded=False):
+	write_lines(format_lines(lines, ' '), out=out, threaded=threaded)
+
+def main(num_lines=500000):
+	lines = [Line('line number %d' % n) for n in range(num_lines)]
+	pairs = [(line, line) for line in lines]
+	with io.open(os.devnull, 'w') as out:
+		rows = [
+			('print() per line', best_of(lambda: print_each(lines, out))),
+			('write_lines', best_of(lambda: batched(lines, out))),
+			('write_lines (threaded)', best_of(lambda: batched(lines, out, threaded=True))),
+			('print() per line (tuples)', best_of(lambda: print_each(pairs, out))),
+			('write_lines (tuples)', best_of(lambda: batched(pairs, out))),
+		]
+	report('writing %d lines:' % num_lines, rows)
+
+if __name__ == '__main__':
+	main(*map(int, sys.argv[1:]))
@@ -1,5 +1,7 @@
 from __future__ import absolute_import
 
+__version__ = '0.10.0'
+
 from .sequence import List
 from .line import Line
 from .shell import Command
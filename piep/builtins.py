@@ -27,13 +27,14 @@ Globally-accessible functions:
 
 '''
 from __future__ import print_function
-import subprocess
 import re, os, sys
+from itertools import chain
 from .pycompat import *
 
 from piep.sequence import iter_length, BaseList, List, Stream
 from piep import line
-from piep.shell import Command, check_for_failed_commands
+from piep.shell import Command, check_for_failed_commands, coprocess
+from piep.parallel import parallel_map_index, threaded_map_index
 builtins = {}
 
 
@@ -74,7 +75,8 @@ def sh(*args, **kwargs):
 	Invoke a shell program and return its output. ``*args`` will be the program name + arguments, and
 	``**kwargs`` will be passed through to ``subprocess.Popen``.
 
-	One additional keyword argument is supported - the ``check`` keyword argument (used to suppress an exception when the command fails).
+	Two additional keyword arguments are supported - ``check`` (used to suppress an exception when the command fails),
+	and ``input`` (a string or sequence of lines to write to the command's stdin).
 
 	For more info, see :ref:`running shell commands`
 	'''
@@ -90,7 +92,44 @@ def spawn(*a, **k):
 	sh(*a, **k)
 	return True
 
-devnull = open(os.devnull, 'r+')
+@add_builtin
+def coproc(*args, **kwargs):
+	'''
+	Start a long-running command, and return a function which sends it a request (a line on its stdin)
+	and returns its response. Unlike calling ``sh`` for every line, there's just one process
+	(calling ``coproc`` again with the same arguments returns the same one)::
+
+		piep 'coproc("bc", "-l")(p + " * 2")'
+
+	By default, each response is one line of output. Pass ``lines=n`` for responses of ``n`` lines, or
+	``end=marker`` for responses ending with a ``marker`` line. The command must flush its
+	output after each response (many tools need an option for this, like ``sed -u`` or ``python3 -u``).
+
+	To send many requests without waiting for each response in turn, use ``coproc(...).map(requests)``,
+	which returns a stream of responses::
+
+		piep 'coproc("bc", "-l").map(pp)'
+
+	Coprocesses are closed at the end of the pipeline, and if one failed, an exception will be raised
+	(unless ``check=False``). Other keyword arguments are passed through to ``subprocess.Popen``.
+	'''
+	return coprocess(args, kwargs)
+
+class _DevNull(object):
+	'''a stand-in for the null device, which only gets opened on first use'''
+	_file = None
+	def _open(self):
+		if self._file is None:
+			_DevNull._file = open(os.devnull, 'r+')
+		return self._file
+	def __getattr__(self, attr):
+		return getattr(self._open(), attr)
+	def __iter__(self):
+		return iter(self._open())
+	def __repr__(self):
+		return repr(self._open())
+
+devnull = _DevNull()
 add_builtin(devnull, 'devnull')
 
 @add_builtin
@@ -137,3 +176,9 @@ def ignore(*a):
 	return True
 
 add_builtin(check_for_failed_commands, "_check_for_failed_commands")
+add_builtin(parallel_map_index, "_parallel_map_index")
+add_builtin(threaded_map_index, "_threaded_map_index")
+add_builtin(chain, "_chain")
+add_builtin(line.compile_regex, "_compile_regex")
+add_builtin(python_builtin.str, "_str")
+add_builtin(line._new_line, "_line")
@@ -0,0 +1,123 @@
+'''
+On-disk cache of compiled pipelines.
+
+Compiled code objects are stored with ``marshal`` under ``$PIEP_CACHE_DIR``
+(default: ``$XDG_CACHE_HOME/piep``, or ``~/.cache/piep``). Cache keys include
+the pipeline text, compile options, the python version and the piep version
+(plus the modification times of piep's own source files, so that a modified
+compiler never reuses stale code).
+
+Pipelines are stored in a directory per version. When a new version first
+stores a pipeline, the other versions' directories are removed, and only the
+newest :data:`MAX_PIPELINES` pipelines are kept.
+'''
+import os
+import sys
+import marshal
+
+import piep
+
+# compiled pipelines kept (for the current version of piep) before the oldest are removed
+MAX_PIPELINES = 1000
+
+def cache_dir():
+	path = os.environ.get('PIEP_CACHE_DIR')
+	if not path:
+		base = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+		path = os.path.join(base, 'piep')
+	return path
+
+def _pipeline_dir():
+	return os.path.join(cache_dir(), 'pipelines')
+
+def _source_signature():
+	src = os.path.dirname(os.path.abspath(__file__))
+	try:
+		entries = sorted(
+			(entry.name, entry.stat().st_mtime_ns, entry.stat().st_size)
+			for entry in os.scandir(src) if entry.name.endswith('.py'))
+	except OSError:
+		entries = []
+	return entries
+
+def _version():
+	'''a digest of everything (besides the pipeline itself) which affects compiled code'''
+	return digest((
+		sys.implementation.cache_tag,
+		sys.version,
+		piep.__version__,
+		_source_signature(),
+	))
+
+def key(*parts):
+	'''return a cache key for the given (repr-able) parts'''
+	# (pipelines are stored in a directory per version, so that stale ones are easy to remove)
+	return '%s/%s' % (_version(), digest(parts))
+
+def digest(value):
+	'''return a hex digest of ``repr(value)``'''
+	from hashlib import blake2b
+	return blake2b(repr(value).encode('utf-8'), digest_size=20).hexdigest()
+
+def load(key):
+	'''return the cached code object for ``key``, or ``None``'''
+	try:
+		with open(os.path.join(_pipeline_dir(), key), 'rb') as f:
+			return marshal.load(f)
+	except (OSError, EOFError, ValueError, TypeError):
+		return None
+
+def store(key, code):
+	'''save ``code`` under ``key`` (failures are ignored, it's only a cache)'''
+	import tempfile
+	path = os.path.join(_pipeline_dir(), key)
+	dest = os.path.dirname(path)
+	try:
+		if not os.path.isdir(dest):
+			os.makedirs(dest)
+			_remove_other_versions(dest)
+		fd, tmp = tempfile.mkstemp(dir=dest, prefix='.tmp-')
+		try:
+			with os.fdopen(fd, 'wb') as f:
+				marshal.dump(code, f)
+			os.replace(tmp, path)
+		except BaseException:
+			os.remove(tmp)
+			raise
+		_prune(dest)
+	except (OSError, ValueError):
+		pass
+
+def _remove_other_versions(current):
+	'''remove pipelines cached by other versions of piep (or python), which will never be used again'''
+	import shutil
+	for entry in os.scandir(os.path.dirname(current)):
+		if entry.path == current:
+			continue
+		if entry.is_dir(follow_symlinks=False):
+			shutil.rmtree(entry.path, ignore_errors=True)
+		else:
+			# (from before pipelines were stored per version)
+			_remove(entry.path)
+
+def _prune(dest):
+	'''remove the oldest pipelines in ``dest``, beyond :data:`MAX_PIPELINES`'''
+	entries = [entry for entry in os.scandir(dest) if not entry.name.startswith('.tmp-')]
+	if len(entries) <= MAX_PIPELINES:
+		return
+	entries.sort(key=lambda entry: entry.stat().st_mtime)
+	for entry in entries[:len(entries) - MAX_PIPELINES]:
+		_remove(entry.path)
+
+def _remove(path):
+	try:
+		os.remove(path)
+	except OSError:
+		pass
+
+def clear():
+	'''remove all cached pipelines (and command results, see :mod:`piep.memo`)'''
+	import shutil
+	from piep import memo
+	shutil.rmtree(_pipeline_dir(), ignore_errors=True)
+	memo.clear()
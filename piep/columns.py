@@ -0,0 +1,366 @@
+'''
+Columnar numeric data (``pp.columns()``).
+
+Lines are split and converted in large batches, with each numeric column
+stored in an ``array.array`` (``'d'`` for floats, ``'q'`` for ints), so no
+per-line python code runs while parsing. Aggregates over those arrays run in
+C too: using NumPy (sharing the arrays' memory) when it's installed, or
+builtins like ``sum``, ``min`` and ``itertools.compress`` otherwise. Both give
+the same results (float sums always use ``math.fsum``, and int sums don't overflow).
+'''
+import math
+import operator
+from array import array
+from collections import Counter
+from itertools import chain, compress, islice, repeat
+
+from piep.sequence import List
+
+BATCH_LINES = 4096
+
+# set to False to always use the stdlib implementation, even if NumPy is installed
+use_numpy = True
+
+_TYPECODES = {float: 'd', int: 'q'}
+
+# (`histogram` has a `range` argument)
+_range = range
+
+_COMPARISONS = {
+	'lt': operator.lt,
+	'le': operator.le,
+	'gt': operator.gt,
+	'ge': operator.ge,
+	'eq': operator.eq,
+	'ne': operator.ne,
+}
+
+def _numpy():
+	if not use_numpy:
+		return None
+	try:
+		import numpy
+	except ImportError:
+		return None
+	return numpy
+
+def parse(lines, sep=None, types=None, names=None, header=False, batch_lines=BATCH_LINES):
+	'''
+	Parse ``lines`` into :class:`Columns` (see :meth:`piep.sequence.BaseList.columns`).
+
+	>>> cols = parse(['a 1 2.5', 'b 2 0.5'], types=[str, int, float])
+	>>> cols[1], cols[2]
+	(array('q', [1, 2]), array('d', [2.5, 0.5]))
+	>>> parse(['n x', '1 2', '3 4'], header=True, types={'x': int})['x']
+	array('q', [2, 4])
+	'''
+	# (plain `str.split`, since `piep.Line.split` wraps its result in a `piep.List`)
+	split = lambda line: str.split(line, sep)
+	batches = _numbered(filter(None, _batches(lines, batch_lines)))
+	pending, numbers = next(batches, ([], ()))
+	if header:
+		names = split(pending[0]) if pending else []
+		pending, numbers = (pending[1:], numbers[1:]) if len(pending) > 1 else next(batches, ([], ()))
+
+	if types is None:
+		# every column is a float, so we need to know how many there are
+		if names is None:
+			count = len(split(pending[0])) if pending else 0
+		else:
+			count = len(names)
+		types = [float] * count
+
+	if isinstance(types, dict):
+		wanted = [(_field_index(key, names), type) for key, type in types.items()]
+	else:
+		wanted = [(index, type) for index, type in enumerate(types) if type is not None]
+
+	columns = [_new_column(type) for _, type in wanted]
+	converters = [(operator.itemgetter(index), type, column) for (index, type), column in zip(wanted, columns)]
+	for chunk, numbers in chain([(pending, numbers)], batches):
+		rows = list(map(str.split, chunk, repeat(sep)))
+		try:
+			for get, type, column in converters:
+				column.extend(map(type, map(get, rows)))
+		except IndexError:
+			needed = max(index for index, _ in wanted) + 1
+			for offset, row in enumerate(rows):
+				if len(row) < needed:
+					raise ValueError("line %d has %d fields (expected at least %d): %r" % (
+						numbers[offset], len(row), needed, chunk[offset]))
+			raise
+		except (ValueError, OverflowError):
+			for offset, row in enumerate(rows):
+				for get, type, _ in converters:
+					try:
+						_new_column(type).append(type(get(row)))
+					except (ValueError, OverflowError) as e:
+						raise ValueError("line %d: %s" % (numbers[offset], e))
+			raise
+
+	keys = [(index, names[index] if names is not None and index < len(names) else None) for index, _ in wanted]
+	return Columns(keys, columns)
+
+def _numbered(batches):
+	'''
+	``(lines, numbers)`` for each batch of lines, with blank lines left out (``numbers``
+	are the line numbers of the remaining ``lines``, counting from 1)
+	'''
+	count = 0
+	for batch in batches:
+		start = count + 1
+		count += len(batch)
+		if all(map(str.strip, batch)):
+			yield batch, _range(start, count + 1)
+		else:
+			numbers = [number for number, line in enumerate(batch, start) if line.strip()]
+			if numbers:
+				yield [batch[number - start] for number in numbers], numbers
+
+def _batches(lines, size):
+	'''lists of (at most `size`) lines, reading blocks directly from the input file if possible'''
+	from piep.reader import line_batches
+	blocks = line_batches(lines)
+	if blocks is None:
+		lines = iter(lines)
+		blocks = iter(lambda: list(islice(lines, size)), [])
+	for block in blocks:
+		if len(block) <= size:
+			yield block
+		else:
+			# (smaller batches are faster to split, since there's less for the GC to track)
+			for start in _range(0, len(block), size):
+				yield block[start:start + size]
+
+def _field_index(key, names):
+	if isinstance(key, int):
+		return key
+	if names is None:
+		raise ValueError("column %r given by name, but there's no header (or names)" % (key,))
+	try:
+		return names.index(key)
+	except ValueError:
+		raise KeyError(key)
+
+def _new_column(type):
+	typecode = _TYPECODES.get(type)
+	return list() if typecode is None else array(typecode)
+
+def _is_numeric(column):
+	return isinstance(column, array)
+
+class Columns(object):
+	'''
+	Columns of values parsed from a stream (see :meth:`piep.sequence.BaseList.columns`).
+
+	Each column is identified by its field index (counting from 0), or by its name if a
+	header (or ``names``) was given. ``cols[key]`` returns a column as an ``array.array``
+	of numbers (or a list, for other types). Iterating over ``Columns`` yields each row
+	as a tuple, so a ``Columns`` result is output one row per line.
+
+	Methods which take a ``column`` may omit it when there's only one column.
+	'''
+	def __init__(self, keys, columns):
+		# (index, name) for each column
+		self._keys = keys
+		self._columns = columns
+
+	def __len__(self):
+		return len(self._columns[0]) if self._columns else 0
+
+	def __iter__(self):
+		return zip(*self._columns)
+
+	def __repr__(self):
+		return '<Columns %r, %d rows>' % (self.keys(), len(self))
+
+	def keys(self):
+		'''the key (name, or field index) of each column'''
+		return [index if name is None else name for index, name in self._keys]
+
+	def _position(self, key):
+		if key is None:
+			if len(self._columns) != 1:
+				raise ValueError("a column must be given (there are %d)" % (len(self._columns),))
+			return 0
+		for position, (index, name) in enumerate(self._keys):
+			if key == name:
+				return position
+		for position, (index, name) in enumerate(self._keys):
+			if key == index:
+				return position
+		raise KeyError(key)
+
+	def __getitem__(self, key):
+		return self._columns[self._position(key)]
+
+	def _numeric(self, column, method):
+		values = self[column]
+		if not _is_numeric(values):
+			raise TypeError("%s() needs a numeric column, but %r isn't" % (method, column))
+		return values
+
+	def _nonempty(self, column, method):
+		values = self._numeric(column, method)
+		if not values:
+			raise ValueError("%s() of an empty column" % (method,))
+		return values
+
+	def sum(self, column=None):
+		'''
+		The sum of a numeric column.
+
+		>>> parse(['1 2', '3 4']).sum(1)
+		6.0
+		'''
+		values = self._numeric(column, 'sum')
+		if values.typecode == 'd':
+			return math.fsum(values)
+		np = _numpy()
+		if np is not None:
+			data = _as_numpy(np, values)
+			# (NumPy's int64 sum wraps around on overflow, which can only happen if
+			# the approximate sum is anywhere near that large)
+			if abs(data.sum(dtype=float).item()) < 2.0 ** 62:
+				return data.sum().item()
+		return sum(values)
+
+	def mean(self, column=None):
+		'''
+		The mean of a numeric column.
+
+		>>> parse(['1', '2', '6']).mean()
+		3.0
+		'''
+		values = self._nonempty(column, 'mean')
+		return math.fsum(values) / len(values)
+
+	def min(self, column=None):
+		'''
+		The smallest value in a numeric column.
+
+		>>> parse(['3', '1', '2'], types=[int]).min()
+		1
+		'''
+		values = self._nonempty(column, 'min')
+		np = _numpy()
+		if np is not None:
+			return _as_numpy(np, values).min().item()
+		return min(values)
+
+	def max(self, column=None):
+		'''
+		The largest value in a numeric column.
+
+		>>> parse(['3', '1', '2'], types=[int]).max()
+		3
+		'''
+		values = self._nonempty(column, 'max')
+		np = _numpy()
+		if np is not None:
+			return _as_numpy(np, values).max().item()
+		return max(values)
+
+	def histogram(self, column=None, bins=10, range=None):
+		'''
+		Count the values of a numeric column in ``bins`` equal-width bins spanning ``range``
+		(a ``(low, high)`` pair, by default the column's smallest and largest values).
+		Values outside ``range`` aren't counted.
+
+		Returns a :class:`piep.List` of ``(low, high, count)`` for each bin. Like NumPy's ``histogram``,
+		each bin includes its low edge, and only the last bin also includes its high edge.
+
+		>>> list(parse(['1', '2', '2', '3', '4']).histogram(bins=3))
+		[(1.0, 2.0, 1), (2.0, 3.0, 2), (3.0, 4.0, 2)]
+		'''
+		values = self._numeric(column, 'histogram')
+		if bins < 1:
+			raise ValueError("bins must be at least 1")
+		if range is None:
+			if values:
+				low, high = self.min(column), self.max(column)
+			else:
+				low, high = 0.0, 1.0
+			restrict = False
+		else:
+			low, high = range
+			restrict = True
+		low, high = float(low), float(high)
+		if low == high:
+			low, high = low - 0.5, high + 0.5
+		width = (high - low) / bins
+		edges = [low + width * i for i in _range(bins)] + [high]
+
+		np = _numpy()
+		if np is not None:
+			counts, _ = np.histogram(_as_numpy(np, values), bins=bins, range=(low, high))
+			counts = counts.tolist()
+		else:
+			if restrict:
+				values = list(compress(values, map(operator.and_,
+					map(operator.ge, values, repeat(low)),
+					map(operator.le, values, repeat(high)))))
+			scale = bins / (high - low)
+			found = Counter(map(math.floor, map(operator.mul, map(operator.sub, values, repeat(low)), repeat(scale))))
+			# (the high edge, and anything rounded up to it, belongs to the last bin)
+			found[bins - 1] = found.get(bins - 1, 0) + found.pop(bins, 0)
+			counts = [found.get(i, 0) for i in _range(bins)]
+		return List(zip(edges[:-1], edges[1:], counts))
+
+	def filter(self, column=None, fn=None, lt=None, le=None, gt=None, ge=None, eq=None, ne=None):
+		'''
+		Return the rows where ``column`` meets every given condition: ``fn(value)`` is true, and / or
+		the value compares as given to each of ``lt``, ``le``, ``gt``, ``ge``, ``eq`` and ``ne``
+		(e.g. ``gt=100`` keeps values greater than 100).
+
+		The comparisons are vectorised, whereas ``fn`` is called once for each value.
+
+		>>> cols = parse(['a 1', 'b 5', 'c 9'], types=[str, int])
+		>>> list(cols.filter(1, gt=2, lt=9))
+		[('b', 5)]
+		>>> cols.filter(0, fn=lambda s: s != 'b').sum(1)
+		10
+		'''
+		conditions = [(_COMPARISONS[op], value) for op, value in sorted(dict(lt=lt, le=le, gt=gt, ge=ge, eq=eq, ne=ne).items()) if value is not None]
+		values = self[column]
+		np = _numpy()
+		if np is not None and _is_numeric(values):
+			mask = np.ones(len(values), dtype=bool)
+			data = _as_numpy(np, values)
+			for compare, value in conditions:
+				mask &= compare(data, value)
+			if fn is not None:
+				mask &= np.fromiter(map(fn, values), dtype=bool, count=len(values))
+			return Columns(self._keys, [_select_numpy(np, each, mask) for each in self._columns])
+
+		masks = [map(compare, values, repeat(value)) for compare, value in conditions]
+		if fn is not None:
+			masks.append(map(bool, map(fn, values)))
+		if not masks:
+			return Columns(self._keys, list(self._columns))
+		mask = masks[0]
+		for other in masks[1:]:
+			mask = map(operator.and_, mask, other)
+		mask = list(mask)
+		return Columns(self._keys, [_select(each, mask) for each in self._columns])
+
+	def rows(self):
+		'''the rows, as a :class:`piep.Stream` of tuples'''
+		from piep.sequence import Stream
+		return Stream(iter(self))
+
+def _select(column, mask):
+	if _is_numeric(column):
+		return array(column.typecode, compress(column, mask))
+	return list(compress(column, mask))
+
+def _as_numpy(np, column):
+	'''a NumPy view of an ``array.array`` column (sharing its memory)'''
+	if not column:
+		return np.empty(0, dtype=column.typecode)
+	return np.frombuffer(column, dtype=column.typecode)
+
+def _select_numpy(np, column, mask):
+	if _is_numeric(column):
+		return array(column.typecode, _as_numpy(np, column)[mask].tobytes())
+	return list(compress(column, mask))
@@ -0,0 +1,570 @@
+'''
+Disk-backed algorithms, for inputs which don't fit in memory.
+
+The memory budget is set with ``--memory-limit`` (or ``$PIEP_MEMORY_LIMIT``),
+and is measured approximately (by the shallow size of each item held). When no
+budget is set, everything happens in memory.
+'''
+import os
+import sys
+
+MEMORY_LIMIT = None
+
+_SIZE_SUFFIXES = {'k': 1024, 'm': 1024 ** 2, 'g': 1024 ** 3, 't': 1024 ** 4}
+
+def parse_size(size):
+	'''
+	Parse a size in bytes, with an optional K/M/G/T suffix.
+
+	>>> parse_size('512')
+	512
+	>>> parse_size('2M')
+	2097152
+	>>> parse_size(None) is None
+	True
+	'''
+	if size is None or size == '':
+		return None
+	size = str(size).strip()
+	multiplier = _SIZE_SUFFIXES.get(size[-1:].lower())
+	if multiplier is not None:
+		size = size[:-1]
+	try:
+		return int(float(size) * (multiplier or 1))
+	except ValueError:
+		raise ValueError("invalid size: %r" % (size,))
+
+def sort(items, key=None, uniq=False, limit=None, reverse=False):
+	'''
+	Return an iterator over the sorted ``items`` (with duplicates removed if ``uniq``, and largest
+	first if ``reverse``).
+
+	If the items don't fit in ``limit`` bytes (default: :data:`MEMORY_LIMIT`), sorted runs
+	are written to temporary files and lazily merged back together. At most :data:`MERGE_FAN_IN`
+	runs are merged at once (so there are never more open files than that), with runs beyond
+	that merged into longer runs first.
+
+	>>> list(sort([3, 1, 2, 1, 3], limit=100))
+	[1, 1, 2, 3, 3]
+	>>> list(sort([3, 1, 2, 1, 3], uniq=True, limit=100))
+	[1, 2, 3]
+	>>> list(sort(['bb', 'a', 'ccc', 'dd'], key=len, limit=100))
+	['a', 'bb', 'dd', 'ccc']
+	>>> list(sort(['bb', 'a', 'ccc', 'dd'], key=len, limit=100, reverse=True))
+	['ccc', 'bb', 'dd', 'a']
+	'''
+	if limit is None:
+		limit = MEMORY_LIMIT
+	if not limit:
+		return iter(_sorted(items, key, uniq, reverse))
+
+	import shutil
+	import tempfile
+	items = iter(items)
+	keyed = key is not None
+	# runs are written to (closed) files in `directory`, and only opened to be merged, MERGE_FAN_IN at a time.
+	# levels[n] holds runs which have been merged n times
+	directory = None
+	levels = [[]]
+	try:
+		while True:
+			chunk, exhausted = _take(items, limit)
+			if exhausted and directory is None:
+				# everything fit in memory
+				return iter(_sorted(chunk, key, uniq, reverse))
+			if directory is None:
+				directory = tempfile.mkdtemp(prefix='piep-sort-')
+			if chunk:
+				levels[0].append(_spill_run(_sorted_run(chunk, key, uniq, reverse), directory))
+				for level, runs in enumerate(levels):
+					if len(runs) < MERGE_FAN_IN:
+						break
+					if level + 1 == len(levels):
+						levels.append([])
+					levels[level + 1].append(_spill_run(_merge_runs(runs, keyed, uniq, reverse), directory))
+					del runs[:]
+			if exhausted:
+				break
+
+		# (earlier levels hold later items, and merging keeps equal items in the order of their runs)
+		runs = [run for runs in reversed(levels) for run in runs]
+		while len(runs) > MERGE_FAN_IN:
+			runs[:MERGE_FAN_IN] = [_spill_run(_merge_runs(runs[:MERGE_FAN_IN], keyed, uniq, reverse), directory)]
+	except BaseException:
+		if directory is not None:
+			shutil.rmtree(directory, ignore_errors=True)
+		raise
+
+	merged = _merge_runs(runs, keyed, uniq, reverse)
+	# (the runs are removed as they're read, but the merge might never be finished)
+	import weakref
+	weakref.finalize(merged, shutil.rmtree, directory, True)
+	if keyed:
+		from operator import itemgetter
+		return map(itemgetter(1), merged)
+	return merged
+
+def smallest(k, items, key=None, largest=False, limit=None):
+	'''
+	Return the ``k`` smallest (or ``largest``) items, in order. Like ``heapq.nsmallest``
+	(or ``heapq.nlargest``), this only holds ``k`` items in memory, unless the first ``k`` items
+	don't fit in ``limit`` bytes (default: :data:`MEMORY_LIMIT`), in which case it's done with
+	an external :func:`sort` instead.
+
+	>>> smallest(2, [3, 1, 2])
+	[1, 2]
+	>>> list(smallest(3, ['bb', 'a', 'ccc', 'dd'], key=len, largest=True, limit=100))
+	['ccc', 'bb', 'dd']
+	'''
+	import heapq
+	from itertools import chain, islice
+	if limit is None:
+		limit = MEMORY_LIMIT
+	if limit:
+		items = iter(items)
+		head, fits = _take(islice(items, k), limit)
+		items = chain(head, items)
+		if not fits:
+			return islice(sort(items, key=key, limit=limit, reverse=largest), k)
+	return (heapq.nlargest if largest else heapq.nsmallest)(k, items, key=key)
+
+def _sorted(items, key, uniq, reverse=False):
+	if uniq:
+		items = set(items)
+	return sorted(items, key=key, reverse=reverse)
+
+def _sorted_run(items, key, uniq, reverse):
+	'''sorted items (or `(key, item)` pairs, so that keys are only computed once) to spill'''
+	if key is None:
+		return _sorted(items, None, uniq, reverse)
+	from operator import itemgetter
+	# (`sorted` is stable, so equal keys stay in order)
+	return sorted(((key(item), item) for item in items), key=itemgetter(0), reverse=reverse)
+
+def _take(items, limit):
+	'''take items until their (approximate) size exceeds `limit`. Returns (chunk, exhausted)'''
+	getsizeof = sys.getsizeof
+	chunk = []
+	append = chunk.append
+	size = 0
+	for item in items:
+		append(item)
+		size += getsizeof(item)
+		if size >= limit:
+			return chunk, False
+	return chunk, True
+
+SPILL_BATCH = 1024
+
+# the most spilled runs which are read at once (each one is an open file)
+MERGE_FAN_IN = 64
+
+def _spill_run(items, directory):
+	'''write `items` to a new file in `directory`, returning its path'''
+	import tempfile
+	fd, path = tempfile.mkstemp(prefix='run-', dir=directory)
+	with open(fd, 'wb') as f:
+		_write(items, f)
+	return path
+
+def _read_run(path):
+	'''iterate over the items written to `path` by `_spill_run`, removing it once done'''
+	try:
+		yield from _unspill(open(path, 'rb'))
+	finally:
+		try:
+			os.remove(path)
+		except OSError: # (already removed along with its directory)
+			pass
+
+def _write(items, f):
+	import pickle
+	from itertools import islice
+	items = iter(items)
+	while True:
+		batch = list(islice(items, SPILL_BATCH))
+		if not batch:
+			break
+		pickle.dump(batch, f, pickle.HIGHEST_PROTOCOL)
+
+def _unspill(f):
+	'''iterate over the items written to `f` by `_spill`'''
+	import pickle
+	try:
+		while True:
+			try:
+				batch = pickle.load(f)
+			except EOFError:
+				break
+			yield from batch
+	finally:
+		f.close()
+
+def _merge_runs(runs, keyed, uniq, reverse=False):
+	'''merge the items (or `(key, item)` pairs) written to each of the `runs` paths by `_spill_run`'''
+	import heapq
+	from operator import itemgetter
+	readers = [_read_run(run) for run in runs]
+	try:
+		merged = heapq.merge(*readers, key=itemgetter(0) if keyed else None, reverse=reverse)
+		if uniq:
+			merged = _drop_repeats(merged)
+		yield from merged
+	finally:
+		for reader in readers:
+			reader.close()
+
+def _drop_repeats(items):
+	'''
+	>>> list(_drop_repeats([1, 1, 2, 3, 3, 3]))
+	[1, 2, 3]
+	'''
+	marker = last = object()
+	for item in items:
+		if last is marker or item != last:
+			yield item
+		last = item
+
+# number of temporary files that aggregate state is spread across, once it no longer fits in memory
+PARTITIONS = 16
+
+# approximate bytes taken by each group (besides its key), for the memory budget
+_GROUP_OVERHEAD = 100
+
+class _Aggregate(object):
+	'''
+	An aggregate function, as a per-group state built up from the first value (``init``),
+	each later value (``update``), and partial states from spilled partitions (``merge``).
+	'''
+	def __init__(self, init, update, merge, result=None):
+		self.init = init
+		self.update = update
+		self.merge = merge
+		self.result = result
+
+AGGREGATES = {
+	'count': _Aggregate(lambda v: 1, lambda s, v: s + 1, lambda a, b: a + b),
+	'sum': _Aggregate(lambda v: v, lambda s, v: s + v, lambda a, b: a + b),
+	'min': _Aggregate(lambda v: v, min, min),
+	'max': _Aggregate(lambda v: v, max, max),
+	'first': _Aggregate(lambda v: v, lambda s, v: s, lambda a, b: a),
+	'last': _Aggregate(lambda v: v, lambda s, v: v, lambda a, b: b),
+	'mean': _Aggregate(
+		lambda v: (v, 1),
+		lambda s, v: (s[0] + v, s[1] + 1),
+		lambda a, b: (a[0] + b[0], a[1] + b[1]),
+		lambda s: s[0] / s[1]),
+}
+
+def _identity(item):
+	return item
+
+def _aggregate_columns(aggregates):
+	'''
+	Expand `(name, spec)` pairs (as given to `BaseList.groupby(...).agg`) into
+	`(value_fn, aggregate)` for each output column.
+	'''
+	columns = []
+	for name, spec in aggregates:
+		try:
+			aggregate = AGGREGATES[name]
+		except KeyError:
+			raise ValueError("unknown aggregate %r (expected one of: %s)" % (name, ', '.join(sorted(AGGREGATES))))
+		specs = spec if isinstance(spec, (list, tuple)) else [spec]
+		for fn in specs:
+			if fn is True:
+				fn = _identity
+			elif not callable(fn):
+				raise TypeError("%s= should be True or a function (or a list of functions), not %r" % (name, fn))
+			columns.append((fn, aggregate))
+	return columns
+
+def _row(key, values):
+	# (tuple keys are output as separate columns)
+	if isinstance(key, tuple):
+		return key + tuple(values)
+	return (key,) + tuple(values)
+
+def aggregate(items, key, aggregates, limit=None):
+	'''
+	Group ``items`` by ``key(item)`` (or the item itself if ``key`` is ``None``), and compute
+	``aggregates`` (a list of ``(name, spec)``, see :meth:`piep.sequence.GroupBy.agg`) for each group,
+	in a single pass. Each group only holds its aggregate state, not its items.
+
+	Returns a list of ``(key, value, ...)`` rows, in the order each key was first seen.
+	If the groups don't fit in ``limit`` bytes (default: :data:`MEMORY_LIMIT`), their state is
+	spilled to :data:`PARTITIONS` temporary files (by the hash of each key) and merged
+	one partition at a time (see :func:`_merge_partitions`). In that case a (lazy) iterator
+	is returned instead, and the rows are in no particular order.
+
+	>>> aggregate(['a1', 'b2', 'a3'], lambda s: s[0], [('count', True), ('sum', lambda s: int(s[1]))])
+	[('a', 2, 4), ('b', 1, 2)]
+	>>> sorted(aggregate(['a1', 'b2', 'a3'], lambda s: s[0], [('max', True), ('first', True)], limit=100))
+	[('a', 'a3', 'a1'), ('b', 'b2', 'b2')]
+	'''
+	if limit is None:
+		limit = MEMORY_LIMIT
+	columns = _aggregate_columns(aggregates)
+	if key is None:
+		key = _identity
+	getsizeof = sys.getsizeof
+	groups = {}
+	size = 0
+	partitions = None
+	for item in items:
+		k = key(item)
+		state = groups.get(k)
+		if state is None:
+			state = groups[k] = [agg.init(fn(item)) for fn, agg in columns]
+			if limit:
+				size += getsizeof(k) + getsizeof(state) + _GROUP_OVERHEAD
+				if size >= limit:
+					partitions = _spill_partitions(groups.items(), partitions)
+					groups = {}
+					size = 0
+		else:
+			for i, (fn, agg) in enumerate(columns):
+				state[i] = agg.update(state[i], fn(item))
+
+	results = [agg.result for fn, agg in columns]
+	def rows(groups):
+		for k, state in groups.items():
+			yield _row(k, [value if result is None else result(value) for value, result in zip(state, results)])
+
+	if partitions is None:
+		return list(rows(groups))
+	partitions = _spill_partitions(groups.items(), partitions)
+	merges = [agg.merge for fn, agg in columns]
+	def merge(existing, state):
+		return [merge(a, b) for merge, a, b in zip(merges, existing, state)]
+	def merged():
+		for groups in _merge_partitions(partitions, merge, limit):
+			yield from rows(groups)
+	return merged()
+
+def count(items, key=None, top=None, limit=None):
+	'''
+	Count how many times each ``key(item)`` (or each item, if ``key`` is ``None``) occurs,
+	returning ``(key, count)`` pairs, most common first (ties are in the order first seen). If ``top`` is given,
+	only that many pairs are returned.
+
+	Like :func:`aggregate`, counts are spilled to temporary files if they don't fit in
+	``limit`` bytes, in which case a (lazy) iterator over the pairs is returned instead of a list.
+
+	>>> count('abracadabra')
+	[('a', 5), ('b', 2), ('r', 2), ('c', 1), ('d', 1)]
+	>>> count(['x1', 'y2', 'x3'], key=lambda s: s[0], top=1)
+	[('x', 2)]
+	>>> sorted(count('abracadabra', limit=200))
+	[('a', 5), ('b', 2), ('c', 1), ('d', 1), ('r', 2)]
+	'''
+	from collections import Counter
+	from itertools import islice
+	if limit is None:
+		limit = MEMORY_LIMIT
+	items = iter(items)
+	counts = Counter()
+	partitions = None
+	if not limit:
+		# (Counter counts an iterable in C)
+		counts.update(items if key is None else map(key, items))
+	else:
+		getsizeof = sys.getsizeof
+		key_size = 0 # average, so far
+		seen = 0
+		while True:
+			chunk = list(islice(items, SPILL_BATCH))
+			if not chunk:
+				break
+			keys = chunk if key is None else list(map(key, chunk))
+			counts.update(keys)
+			key_size = (key_size * seen + sum(map(getsizeof, keys))) / (seen + len(keys))
+			seen += len(keys)
+			if len(counts) * (key_size + _GROUP_OVERHEAD) >= limit:
+				partitions = _spill_partitions(counts.items(), partitions)
+				counts = Counter()
+
+	if partitions is None:
+		return counts.most_common(top)
+
+	partitions = _spill_partitions(counts.items(), partitions)
+	def merged():
+		import operator
+		for counts in _merge_partitions(partitions, operator.add, limit):
+			yield from counts.items()
+
+	from operator import itemgetter
+	if top is not None:
+		import heapq
+		return heapq.nlargest(top, merged(), key=itemgetter(1))
+	# (order of first appearance isn't known once spilled, so ties are in no particular order)
+	return sort(merged(), key=lambda pair: -pair[1], limit=limit)
+
+# how many times a partition which is still too large to merge in memory is split again
+MAX_REPARTITIONS = 4
+
+def _merge_partitions(partitions, merge, limit, level=0):
+	'''
+	Yields a dict of `{key: state}` for each partition written by `_spill_partitions`,
+	combining the states of equal keys with `merge(earlier, later)`. A partition whose
+	groups don't fit in `limit` bytes is itself split into partitions (by a different hash),
+	up to `MAX_REPARTITIONS` times.
+	'''
+	getsizeof = sys.getsizeof
+	for pairs in _read_partitions(partitions):
+		groups = {}
+		size = 0
+		split = None
+		for k, state in pairs:
+			existing = groups.get(k)
+			if existing is None:
+				groups[k] = state
+				size += getsizeof(k) + getsizeof(state) + _GROUP_OVERHEAD
+				# (there's no point splitting a single group)
+				if size >= limit and level < MAX_REPARTITIONS and len(groups) > 1:
+					split = _spill_partitions(groups.items(), split, level + 1)
+					groups = {}
+					size = 0
+			else:
+				# (partitions are written in order, so `state` is from later items)
+				groups[k] = merge(existing, state)
+		if split is None:
+			yield groups
+		else:
+			split = _spill_partitions(groups.items(), split, level + 1)
+			groups = None
+			yield from _merge_partitions(split, merge, limit, level + 1)
+
+def _spill_partitions(pairs, partitions, level=0):
+	'''
+	append `(key, state)` pairs to temporary files, partitioned by the hash of each key
+	(a partition is split again at the next `level`, so each level uses a different hash)
+	'''
+	import pickle
+	import tempfile
+	if partitions is None:
+		partitions = [tempfile.TemporaryFile(prefix='piep-') for _ in range(PARTITIONS)]
+	count = len(partitions)
+	batches = [[] for _ in partitions]
+	for pair in pairs:
+		index = (hash((level, pair[0])) if level else hash(pair[0])) % count
+		batch = batches[index]
+		batch.append(pair)
+		if len(batch) >= SPILL_BATCH:
+			pickle.dump(batch, partitions[index], pickle.HIGHEST_PROTOCOL)
+			del batch[:]
+	for f, batch in zip(partitions, batches):
+		if batch:
+			pickle.dump(batch, f, pickle.HIGHEST_PROTOCOL)
+	return partitions
+
+def _read_partitions(partitions):
+	'''yields an iterator over the pairs in each partition written by `_spill_partitions`'''
+	try:
+		for f in partitions:
+			f.seek(0)
+			yield _unspill(f)
+	finally:
+		for f in partitions:
+			f.close()
+
+def join(left, right, left_key=None, right_key=None, how='inner', limit=None):
+	'''
+	Yield ``(left_item, right_item)`` for each pair of items whose keys (``left_key(item)`` and
+	``right_key(item)``, or the items themselves) are equal. When ``how`` is ``'left'``, left items
+	with no match are also included, as ``(left_item, None)``.
+
+	A hash table is built from ``right`` and ``left`` is streamed through it, so results are in the
+	order of ``left``. If ``right`` doesn't fit in ``limit`` bytes (default: :data:`MEMORY_LIMIT`),
+	both sides are instead spilled to :data:`PARTITIONS` temporary files (by the hash of each key),
+	and each pair of partitions is joined in turn, building the table from the smaller of the two.
+	In that case, results are in no particular order.
+
+	>>> list(join(['a1', 'b2', 'c3'], ['a!', 'a?', 'c!'], lambda s: s[0], lambda s: s[0]))
+	[('a1', 'a!'), ('a1', 'a?'), ('c3', 'c!')]
+	>>> sorted(join(['a1', 'b2', 'c3'], ['a!', 'c!'], lambda s: s[0], lambda s: s[0], how='left', limit=100), key=str)
+	[('a1', 'a!'), ('b2', None), ('c3', 'c!')]
+	'''
+	if how not in ('inner', 'left'):
+		raise ValueError("how must be 'inner' or 'left', not %r" % (how,))
+	if limit is None:
+		limit = MEMORY_LIMIT
+	return _hash_join(left, left_key or _identity, right, right_key or _identity, how == 'left', limit)
+
+def _hash_join(left, left_key, right, right_key, outer, limit):
+	getsizeof = sys.getsizeof
+	right = iter(right)
+	table = {}
+	size = 0
+	for item in right:
+		k = right_key(item)
+		matches = table.get(k)
+		if matches is None:
+			table[k] = [item]
+			if limit:
+				size += getsizeof(k) + _GROUP_OVERHEAD
+		else:
+			matches.append(item)
+		if limit:
+			size += getsizeof(item)
+			if size >= limit:
+				yield from _grace_join(left, left_key, right, right_key, table, outer)
+				return
+
+	for item in left:
+		matches = table.get(left_key(item))
+		if matches is not None:
+			for match in matches:
+				yield (item, match)
+		elif outer:
+			yield (item, None)
+
+def _grace_join(left, left_key, right, right_key, table, outer):
+	'''join by partitioning both sides on disk (`table` holds the right items read so far)'''
+	right_partitions = _spill_partitions(
+		((k, item) for k, items in table.items() for item in items), None)
+	table.clear()
+	right_partitions = _spill_partitions(((right_key(item), item) for item in right), right_partitions)
+	left_partitions = _spill_partitions(((left_key(item), item) for item in left), None)
+
+	# (the smaller side of each pair of partitions, by bytes written, becomes the hash table)
+	builds_left = [l.tell() < r.tell() for l, r in zip(left_partitions, right_partitions)]
+	try:
+		for left_pairs, right_pairs, build_left in zip(
+				_read_partitions(left_partitions), _read_partitions(right_partitions), builds_left):
+			if not build_left:
+				table = _hash_table(right_pairs)
+				for k, item in left_pairs:
+					matches = table.get(k)
+					if matches is not None:
+						for match in matches:
+							yield (item, match)
+					elif outer:
+						yield (item, None)
+			else:
+				table = _hash_table(left_pairs)
+				matched = set()
+				for k, match in right_pairs:
+					items = table.get(k)
+					if items is not None:
+						matched.add(k)
+						for item in items:
+							yield (item, match)
+				if outer:
+					for k, items in table.items():
+						if k not in matched:
+							for item in items:
+								yield (item, None)
+	finally:
+		for f in left_partitions + right_partitions:
+			f.close()
+
+def _hash_table(pairs):
+	table = {}
+	for k, item in pairs:
+		matches = table.get(k)
+		if matches is None:
+			table[k] = [item]
+		else:
+			matches.append(item)
+	return table
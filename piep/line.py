@@ -1,6 +1,28 @@
 from __future__ import print_function
 import os
 import re
+from functools import lru_cache, partial
+
+REGEX_CACHE_SIZE = 2048
+
+@lru_cache(maxsize=REGEX_CACHE_SIZE)
+def _compile_cached(pattern, flags):
+	return re.compile(pattern, flags)
+
+_Pattern = type(re.compile(''))
+
+def compile_regex(pattern, flags=0):
+	'''
+	Like ``re.compile``, but with a cache of the most recently used
+	:data:`REGEX_CACHE_SIZE` patterns (which is much larger than the ``re``
+	module's own cache, and quicker to check).
+
+	>>> compile_regex('a+') is compile_regex('a+')
+	True
+	'''
+	if flags == 0 and type(pattern) is _Pattern:
+		return pattern
+	return _compile_cached(pattern, flags)
 
 def _apply_doc(ret, fn, doc):
 	ret.__name__ = fn.__name__
@@ -9,19 +31,32 @@ def _apply_doc(ret, fn, doc):
 	elif doc is not False:
 		ret.__doc__ = doc
 
+_new_str = str.__new__
+
 def wrap(fn, doc=False):
-	ret = lambda *a, **k: Line(fn(*a, **k))
+	def ret(*a, **k):
+		result = fn(*a, **k)
+		# (equivalent to `Line(result)`, without the python-level Line.__new__)
+		return None if result is None else _new_str(Line, result)
 	_apply_doc(ret, fn, doc)
 	return ret
 
 def wrap_multi(fn, doc=False):
 	def ret(*a, **k):
-		from piep.sequence import List
-		return List(Line(l) for l in fn(*a, **k))
+		return _make_list(map(_new_line, fn(*a, **k)))
 	_apply_doc(ret, fn, doc)
 	return ret
 
+def _make_list(items):
+	# piep.sequence imports this module, so it can't be imported until it's first needed
+	global _make_list
+	from piep.sequence import List
+	_make_list = List
+	return List(items)
+
 class Line(str):
+	__slots__ = ()
+
 	def __new__(cls, s, *a, **k):
 		if s is None:
 			return s
@@ -69,19 +104,19 @@ class Line(str):
 		return shlex.split(self)
 
 	@wrap_multi
-	def splitre(self, regex, *a, **kw):
-		'''re.split(regex, self, *a, **kw)'''
-		return re.split(regex, self, *a, **kw)
+	def splitre(self, regex, maxsplit=0, flags=0):
+		'''re.split(regex, self, maxsplit, flags)'''
+		return compile_regex(regex, flags).split(self, maxsplit)
 
 	@wrap
 	def match(self, pattern, group=0, flags=0):
 		'''extract matched part of the string (or a captured group, if ``group`` is given)'''
-		res = re.search(pattern, self, flags=flags)
+		res = compile_regex(pattern, flags).search(self)
 		return res and res.group(group or 0)
 
 	def matches(self, pattern, group=0, flags=0):
 		'''return True or False depending on if the given regex can be found anywhere in the line'''
-		return bool(re.search(pattern, self, flags=flags))
+		return compile_regex(pattern, flags).search(self) is not None
 
 	# copy all `str` builtins
 	capitalize = wrap(str.capitalize)
@@ -116,3 +151,6 @@ class Line(str):
 	__rmod__     = wrap(str.__rmod__)
 	__rmul__     = wrap(str.__rmul__)
 
+# for results which are known to be strings
+_new_line = partial(_new_str, Line)
+
@@ -2,14 +2,16 @@
 
 from __future__ import print_function
 import os, sys
-import ast
 from optparse import OptionParser
 import itertools
 
 from piep.sequence import Stream, BaseList, List
 from piep.line import Line
+from piep.reader import read_lines, map_lines, DEFAULT_BUFSIZE
+from piep.writer import write_lines, format_lines
 from piep.builtins import builtins
 from piep.error import Exit
+from piep import cache, external, shell
 
 from .pycompat import *
 
@@ -23,12 +25,24 @@ def main(argv=None):
 		argv = sys.argv[1:]
 	try:
 		opts, args = parse_args(argv)
-		lines = run(opts, args)
-		print_results(lines, opts)
+		if opts.clear_cache:
+			cache.clear()
+			if not args:
+				return 0
+		if opts.profile_stats:
+			import cProfile
+			stats = cProfile.Profile()
+			try:
+				stats.runcall(lambda: print_results(run(opts, args), opts))
+			finally:
+				stats.dump_stats(opts.profile_stats)
+		else:
+			print_results(run(opts, args), opts)
 		return 0
 	except Exit as e:
-		if e.message:
-			print(e.message, file=sys.stderr)
+		message = str(e)
+		if message:
+			print(message, file=sys.stderr)
 		sys.exit(1)
 	except KeyboardInterrupt:
 		print("interrupted", file=sys.stderr)
@@ -55,37 +69,114 @@ def parse_args(argv=None):
 	p.add_option('-i', '--input', dest='input', help='use a named file (instead of stdin)')
 	p.add_option('-p', '--path', action='append', dest='import_paths', default=[], help='add a location to the import path (the same as $PYTHONPATH / sys.path)')
 	p.add_option('-0', '--read0', action='store_true', dest='input_nullsep', help='read input as null-separated fields')
+	p.add_option('--bufsize', type='int', default=DEFAULT_BUFSIZE, metavar='BYTES', help='size of each block read from input files (default %default)')
+	p.add_option('--mmap', action='store_true', help='memory-map input files (instead of reading them), where possible')
 	p.add_option('-n', '--no-input', action='store_true', help='don\'t read stdin - self-constructing pipeline')
 	p.add_option('--print0', action='store_true', dest='output_nullsep', help='print output as null-separated fields')
+	p.add_option('--jobs', type='int', default=1, metavar='N', help='process line-wise expressions in N worker processes')
+	p.add_option('--sh-cache', type='choice', choices=['memory', 'disk'], metavar='memory|disk', help='reuse the output of sh() commands run with the same arguments, for the duration of this run (memory) or across runs (disk)')
+	p.add_option('--sh-cache-env', action='append', default=[], metavar='NAME', help='environment variable which affects cached commands (may be given multiple times)')
+	p.add_option('--sh-cache-paths', action='store_true', help='rerun cached commands when any argument which is a path has been modified')
+	p.add_option('--sh-cache-failures', action='store_true', help='cache the results of failed commands too')
+	p.add_option('--sh-jobs', type='int', default=1, dest='sh_jobs', metavar='N', help='run shell commands for up to N lines at once (results are still in input order)')
+	p.add_option('--memory-limit', default=os.environ.get('PIEP_MEMORY_LIMIT'), metavar='BYTES', help='approximate memory budget for sort (etc.) before spilling to temporary files, e.g. 512M (default: $PIEP_MEMORY_LIMIT, or unlimited)')
+	p.add_option('--no-hoist', action='store_false', dest='hoist', default=True, help='evaluate line-independent subexpressions for every line, rather than once')
+	p.add_option('--profile', action='store_true', help='print the number of lines, and time taken, for each stage of the pipeline (to stderr)')
+	p.add_option('--profile-stats', metavar='FILE', help='save a cProfile (pstats) profile of the whole run to FILE')
+	p.add_option('--no-cache', action='store_false', dest='cache', default=True, help='don\'t use (or update) the cache of compiled pipelines')
+	p.add_option('--clear-cache', action='store_true', help='remove all cached pipelines (and command results) before running')
+	p.add_option('--write-thread', action='store_true', help='write output from a separate thread (overlapping formatting with I/O)')
 	opts, args = p.parse_args(argv)
-	assert len(args) > 0, "Not enough arguments\n" + p.format_help()
-	assert len(args) == 1, "Too many arguments\n" + p.format_help()
+	assert len(args) > 0 or opts.clear_cache, "Not enough arguments\n" + p.format_help()
+	assert len(args) <= 1, "Too many arguments\n" + p.format_help()
 	DEBUG = opts.debug
 	return (opts, args)
 
 def print_results(lines, opts):
 	'''print lines separated by either \n or \0'''
-	lines = iter(lines)
-	print_line = print
-	if opts.output_nullsep:
-		try:
-			line = next(lines)
-		except StopIteration:
-			return
-		print(line, end='')
-		def print_line(line):
-			print('\0', line, end='', sep='')
-	for line in lines:
-		print_line(line)
+	sep = '\0' if opts.output_nullsep else '\n'
+	write_lines(lines, sep=sep, threaded=opts.write_thread, interleaved=opts.interleaved)
 
 def run(opts, args):
 	cmd = args[0]
 	input_file = open(opts.input) if opts.input else sys.stdin
 
 	opts.join = opts.join.encode('utf-8').decode('unicode_escape')
+	external.MEMORY_LIMIT = external.parse_size(opts.memory_limit)
+	shell.result_cache = None
+	if opts.sh_cache:
+		from piep.memo import ResultCache
+		shell.result_cache = ResultCache(
+			disk=opts.sh_cache == 'disk',
+			env=opts.sh_cache_env,
+			paths=opts.sh_cache_paths,
+			failures=opts.sh_cache_failures)
 
 	bindings = init_globals(opts, input_file)
+	if opts.profile:
+		import atexit
+		from piep.profiler import Profiler
+		# (reported at exit, once all output has been written)
+		bindings['_profiler'] = Profiler()
+		atexit.register(bindings['_profiler'].report)
+
+	code = compile_pipeline(cmd, opts)
+	# (output printed by the pipeline itself has to be interleaved with its results)
+	opts.interleaved = _may_write_stdout(code, bindings)
+	execfn(code, bindings)
+	output = bindings['pp']
+
+	# strings are iterable, but we don't want to do that!
+	if isinstance(output, basestring):
+		output = [output]
+	try:
+		output = iter(output)
+	except TypeError as err:
+		debug(err)
+		shell.finish_streamed_commands()
+		shell.close_coprocesses()
+		return [output]
+	return format_lines(itertools.chain(output, shell.closing_streamed_commands(), shell.closing_coprocesses()), opts.join)
+
+# names which suggest that code writes to stdout itself
+_STDOUT_NAMES = frozenset(['print', 'stdout'])
 
+def _may_write_stdout(code, bindings):
+	'''
+	Whether ``code`` (or any function it refers to which was defined with
+	``--eval``) may write to stdout, judging by the names it uses.
+	'''
+	import types
+	from piep.parallel import _referenced_names
+	pending = [code]
+	seen = set()
+	while pending:
+		names = _referenced_names(pending.pop())
+		if not _STDOUT_NAMES.isdisjoint(names):
+			return True
+		for name in names.difference(seen):
+			seen.add(name)
+			value = bindings.get(name)
+			if isinstance(value, types.FunctionType) and value.__globals__ is bindings:
+				pending.append(value.__code__)
+	return False
+
+def compile_pipeline(cmd, opts):
+	'''
+	Compile the entire pipeline string into a code object. Unless disabled,
+	compiled code is cached on disk (keyed on ``cmd`` and all options which
+	affect compilation), in which case parsing & compilation are skipped entirely.
+	'''
+	options = dict(jobs=opts.jobs, sh_jobs=opts.sh_jobs, hoist=opts.hoist, profile=opts.profile)
+	key = None
+	if opts.cache:
+		key = cache.key(cmd, opts.no_input, sorted(options.items()), opts.evals, opts.imports)
+		code = cache.load(key)
+		if code is not None:
+			debug("Using cached pipeline %s" % (key,))
+			return code
+
+	import ast
 	debug("Pipeline string: %s" % (cmd,))
 	exprs = split_on_pipes(cmd)
 	debug("Split expressions:\n  - " + "\n  - ".join(exprs))
@@ -97,26 +188,40 @@ def run(opts, args):
 			assert 'pp' in assigned_names, "The first expression must assign to `pp` when --no-input is specified"
 		else:
 			exprs[0] = 'pp=' + exprs[0]
-	output = eval_pipes(exprs, bindings)
+	code = compile_pipe_exprs(exprs, input_lines=not opts.no_input, rebound=_bound_names(opts), **options)
+	if key is not None:
+		cache.store(key, code)
+	return code
 
-	# strings are iterable, but we don't want to do that!
-	if isinstance(output, basestring):
-		output = [output]
-	try:
-		output = iter(output)
-	except TypeError as err:
-		debug(err)
-		yield output
-	else:
-		for line in output:
-			if line is not None:
-				if isinstance(line, (tuple, list)):
-					line = opts.join.join(map(str, line))
-				yield line
+def _bound_names(opts):
+	'''
+	The global names bound by ``--import`` and ``--eval`` options
+	(including ``"*"`` if that can't be determined).
+	'''
+	import ast
+	names = set(mod.split('.')[0] for mod in opts.imports)
+	for eval_str in opts.evals:
+		try:
+			tree = ast.parse(eval_str)
+		except SyntaxError:
+			names.add('*')
+			continue
+		for node in ast.walk(tree):
+			if isinstance(node, ast.Name) and not isinstance(node.ctx, ast.Load):
+				names.add(node.id)
+			elif isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)):
+				names.add(node.name)
+			elif isinstance(node, (ast.Import, ast.ImportFrom)):
+				names.update((alias.asname or alias.name).split('.')[0] for alias in node.names)
+			elif isinstance(node, (ast.Global, ast.Nonlocal)):
+				names.update(node.names)
+	return sorted(names)
 
 def init_globals(opts, input_file):
+	sep = '\0' if opts.input_nullsep else '\n'
+	reader = map_lines if opts.mmap else read_lines
 	def make_stream(f):
-		return Stream(map(lambda x: Line(x.rstrip('\n\r')), iter(f)))
+		return Stream(reader(f, sep=sep, bufsize=opts.bufsize))
 
 	pp = make_stream(input_file)
 	globs = builtins.copy()
@@ -126,6 +231,7 @@ def init_globals(opts, input_file):
 		if path not in sys.path:
 			sys.path.insert(0, path)
 	for import_mod in opts.imports:
+		import ast
 		import_node = ast.Import(names=[ast.alias(name=import_mod, asname=None)])
 		code = compile(ast.fix_missing_locations(ast.Module(body=[import_node], type_ignores=[])), 'import %s' % (import_mod,), 'exec')
 		eval(code, globs)
@@ -169,55 +275,98 @@ def split_on_pipes(cmds):
 
 	>>> split_on_pipes(r'a.replace("/", "\\") | b')
 	['a.replace("/", "\\\\")', 'b']
+
+	>>> split_on_pipes('f"{a|b}" | c')
+	['f"{a|b}"', 'c']
+
+	>>> split_on_pipes('"""a|b""" | c')
+	['"""a|b"""', 'c']
+
+	>>> split_on_pipes('a\n| b')
+	['a', 'b']
 	'''
-	
-	OPENERS = frozenset(('{', '(', '['))
-	CLOSERS = {
-		'}':'{',
-		')':'(',
-		']':'[',
-	}
-	QUOTES = frozenset(('"',"'"))
+	import tokenize
+	try:
+		return _split_tokens(cmds)
+	except (SyntaxError, tokenize.TokenError):
+		# not valid python (e.g. unbalanced brackets); the resulting
+		# expressions will most likely fail to parse, but that's
+		# a better error than a tokenize failure.
+		return _split_chars(cmds)
+
+def _split_tokens(cmds):
+	'''split on top-level `|` operators, according to python's own tokenizer'''
+	import io
+	import tokenize
+	line_offsets = [0]
+	for line in cmds.split('\n'):
+		line_offsets.append(line_offsets[-1] + len(line) + 1)
 
 	cmd_array = []
-	letters = list(cmds)
+	start = 0
+	depth = 0
+	for tok in tokenize.generate_tokens(io.StringIO(cmds).readline):
+		if tok.type != tokenize.OP:
+			continue
+		op = tok.string
+		if op in _OPENERS:
+			depth += 1
+		elif op in _CLOSERS:
+			depth = max(depth - 1, 0)
+		elif op == '|' and depth == 0:
+			row, col = tok.start
+			pos = line_offsets[row - 1] + col
+			cmd_array.append(cmds[start:pos].strip())
+			start = pos + 1
+	cmd_array.append(cmds[start:].strip())
+	return cmd_array
+
+def _split_chars(cmds):
+	'''
+	split on `|` characters outside of quotes and brackets,
+	in a single pass over the string
 
-	cmd = ''
+	>>> _split_chars('a | "b|c" | [d')
+	['a', '"b|c"', '[d']
+	'''
+	QUOTES = frozenset(('"',"'"))
+
+	cmd_array = []
+	start = 0
 	escape = False
 	context = []
-	while letters:
-		letter = letters.pop(0)
-		open_ctx = context[-1] if context else None
-		debug("got letter %r, open_ctx = %r, esc=%s" % (letter, open_ctx, escape))
-
+	for pos, letter in enumerate(cmds):
 		if not escape:
+			open_ctx = context[-1] if context else None
 			# behave differently if inside quotes
 			if open_ctx in QUOTES:
 				if open_ctx == letter:
 					context.pop()
 			else:
 				# quotes and brackets can nest in anything but quotes
-				if letter in QUOTES or letter in OPENERS:
+				if letter in QUOTES or letter in _OPENERS:
 					context.append(letter)
-				elif letter in CLOSERS:
-					opener = CLOSERS[letter]
-					if open_ctx == opener:
+				elif letter in _CLOSERS:
+					if open_ctx == _CLOSERS[letter]:
 						context.pop()
-
-			if letter == '|' and open_ctx is None:
-				cmd_array.append(cmd.strip())
-				cmd = ''
-				continue
-
-		cmd += letter
+				elif letter == '|' and open_ctx is None:
+					cmd_array.append(cmds[start:pos].strip())
+					start = pos + 1
 
 		# if backslash, set `escape` for the next letter we encounter,
 		# note that two backslashes in a row reverts to unescaped
 		escape = letter == '\\' and not escape
 
-	cmd_array.append(cmd.strip())
+	cmd_array.append(cmds[start:].strip())
 	return cmd_array
 
+_OPENERS = frozenset(('{', '(', '['))
+_CLOSERS = {
+	'}':'{',
+	')':'(',
+	']':'[',
+}
+
 class Mode(object):
 	__slots__ = ['desc', 'vars']
 	def __init__(self, desc, vars):
@@ -236,6 +385,7 @@ RESERVED_VARS = MODE.GLOBAL.vars.union(MODE.LINE.vars)
 NON_ASSIGNABLE_VARS = RESERVED_VARS.difference(['pp', 'p'])
 
 def detect_mode(expr, source_text):
+	import ast
 	names = set()
 	class NameFinder(ast.NodeVisitor):
 		def visit_Assign(self, node):
@@ -263,6 +413,7 @@ def detect_mode(expr, source_text):
 	return (mode or MODE.LINE), names
 
 def parse_expr(expr):
+	import ast
 	try:
 		return ast.parse(expr + '\n', mode='eval').body
 	except SyntaxError as e:
@@ -276,24 +427,53 @@ def parse_expr(expr):
 		except SyntaxError as e:
 			raise Exit("got error: %s\nwhile evaluating: %s" % (e,expr))
 
-def compile_pipe_exprs(exprs):
+def compile_pipe_exprs(exprs, jobs=1, input_lines=False, rebound=(), hoist=True, sh_jobs=1, profile=False):
+	'''
+	Compile pipeline expressions into a code object, which transforms ``pp``.
+
+	``input_lines`` indicates that ``pp`` initially contains lines of input (so ``p``
+	is known to be a string in the first stage), and ``rebound`` lists the names
+	bound by ``--eval`` / ``--import``. Both are used to leave out per-line checks
+	which can't apply. Unless ``hoist`` is false, line-independent subexpressions
+	are evaluated once rather than for every line. Line-wise groups which run shell
+	commands process up to ``sh_jobs`` lines at once. If ``profile`` is set, each stage
+	is surrounded by calls to ``_profiler`` (a :class:`piep.profiler.Profiler`).
+	'''
+	import ast
+	from piep.optimise import (rewrite_sort_slices, needs_command_checks, infer_kind, assigns_p,
+		hoist_invariants, precompile_regexes, unwrap_str_chains, STR, BOOL)
 	body = []
 
 	# this code doesn't need to be parameterised, so we'll just parse a string
 	post_pipe_check = ast.parse(
 			"_check_for_failed_commands()\n"
 		).body
-	post_expr_check = post_pipe_check + ast.parse(
+	# (in file mode, a command which becomes `pp` is checked once the next stage has read its output)
+	global_check = ast.parse(
+			"_check_for_failed_commands(pp)\n"
+		).body
+	# (the result handling of `BaseList.map`, for a `p` assigned by the last expression in a fused loop)
+	filter_assigned = ast.parse(
+			"if p is True: p = _original\n"
+			"elif p is False or p is None: continue\n"
+		).body
+	normalise_result = ast.parse(
 			"if callable(_p): _p = _p(p)\n"
 			"p = p if _p is True else (None if _p is False else _p)\n"
-			"if p is None: return None\n"
 		).body
 
+	def skip_line(fused):
+		'''
+		per-line `_transformer` functions drop a line by returning None,
+		fused loops just move on to the next line
+		'''
+		return ast.Continue() if fused else ast.Return(const(None))
+
 	def annotate(expr):
 		'''get the mode & referenced variables for a given ast node'''
 		ast_node = parse_expr(expr)
 		mode, vars = detect_mode(ast_node, expr)
-		return ast_node, mode, vars
+		return expr, ast_node, mode, vars
 
 	def name(id, ctx=None):
 		if ctx is None:
@@ -309,42 +489,129 @@ def compile_pipe_exprs(exprs):
 	def assign(var, expr):
 		return ast.Assign(targets=[name(var, ctx=ast.Store())], value=expr)
 
-	def combine_pipe_transforms(body):
-		'''
-		Takes a list of expressions and creates a list of statements
-		to process the entirety of ``pp`` with the given sub-pipeline.
-		Importantly, the expressions exist in the same lexical scope, so
-		assignments are available for use in subsequent expressions.
-		'''
-		transform_def = ast.FunctionDef(
-			name='_transformer',
+	def const(value):
+		return ast.Constant(value=value)
+
+	def function(fn_name, args, body):
+		return ast.FunctionDef(
+			name=fn_name,
 			args=ast.arguments(
 				posonlyargs=[],
-				args=[arg('p'), arg('i')],
+				args=[arg(a) for a in args],
 				vararg=None,
 				kwarg=None,
 				kwonlyargs=[],
 				kw_defaults=[],
 				defaults=[]
 			),
-			body=body + [ast.Return(name('p'))],
+			body=body,
 			decorator_list=[])
 
-		map_fn = ast.Attribute(value=name('pp'), attr='map_index', ctx=ast.Load())
-		assign_pp = assign('pp', ast.Call(
-				func=map_fn,
-				args=[name('_transformer')],
-				keywords=[],
-				starargs=None,
-				kwargs=None
-				))
+	def call(func, *args):
+		return ast.Call(func=func, args=list(args), keywords=[])
+
+	def attr(obj, attr_name):
+		return ast.Attribute(value=obj, attr=attr_name, ctx=ast.Load())
+
+	def line_statements(exprs, kinds, fused):
+		'''
+		The statements to evaluate ``exprs`` (with result kinds from ``infer_kind``)
+		for a single line, skipping to the next line when ``p`` is filtered out.
+		'''
+		statements = []
+		for expr, kind in zip(exprs, kinds):
+			if isinstance(expr, ast.Assign):
+				statements.append(expr)
+			elif kind is BOOL:
+				test = expr
+				if post_pipe_check:
+					statements.append(assign('_p', expr))
+					statements.extend(post_pipe_check)
+					test = name('_p')
+				statements.append(ast.If(test=ast.UnaryOp(op=ast.Not(), operand=test), body=[skip_line(fused)], orelse=[]))
+			elif kind is STR:
+				statements.append(assign('p', expr))
+				statements.extend(post_pipe_check)
+			else:
+				statements.append(assign('_p', expr))
+				statements.extend(post_pipe_check)
+				statements.extend(normalise_result)
+				statements.append(ast.If(
+					test=ast.Compare(left=name('p'), ops=[ast.Is()], comparators=[const(None)]),
+					body=[skip_line(fused)], orelse=[]))
+		return statements
+
+	def combine_pipe_transforms(body, source, names, fused, hoisted=None, threaded=False, ends_in_assignment=False):
+		'''
+		Takes a list of expressions and creates a list of statements
+		to process the entirety of ``pp`` with the given sub-pipeline.
+		Importantly, the expressions exist in the same lexical scope, so
+		assignments are available for use in subsequent expressions.
+
+		When ``fused``, this is a single generator function looping over
+		every line (so there are no per-line function calls besides the
+		user's own code), with any ``hoisted`` loop invariants evaluated
+		before the loop. If the group ``ends_in_assignment``, the value it
+		assigns to ``p`` is filtered like a result of ``pp.map`` (``True``
+		keeps the line, ``False`` or ``None`` drops it). When not ``fused``, it's
+		a ``_transformer(p, i)`` function applied to each line by ``pp.map_index``, by ``_parallel_map_index``
+		when running with multiple ``jobs``, or by ``_threaded_map_index``
+		when ``threaded``.
+		'''
+		if fused:
+			def loop(body):
+				if ends_in_assignment:
+					body = [assign('_original', name('p'))] + body + filter_assigned
+				return ast.For(
+					target=ast.Tuple(elts=[name('i', ast.Store()), name('p', ast.Store())], ctx=ast.Store()),
+					iter=call(name('enumerate'), name('_lines')),
+					body=body + [ast.Expr(ast.Yield(name('p')))],
+					orelse=[])
+
+			transform = [loop(body)]
+			if hoisted is not None:
+				# loop invariants are evaluated once the first line arrives. If that fails,
+				# we run the original loop instead (which raises at the same point it always would)
+				prelude, hoisted_body = hoisted
+				transform = ast.parse(
+					"_lines = iter(_lines)\n"
+					"for _first in _lines: break\n"
+					"else: return\n"
+					"_lines = _chain((_first,), _lines)\n"
+				).body + [
+					ast.Try(
+						body=prelude + [assign('_hoisted', const(True))],
+						handlers=[ast.ExceptHandler(type=name('Exception'), name=None, body=[assign('_hoisted', const(False))])],
+						orelse=[],
+						finalbody=[]),
+					ast.If(test=name('_hoisted'), body=[loop(hoisted_body)], orelse=transform),
+				]
+			return [
+				function('_transformer', ['_lines'], transform),
+				assign('pp', call(attr(name('pp'), '_replace'), call(name('_transformer'), attr(name('pp'), 'src')))),
+			]
+
+		transform_def = function('_transformer', ['p', 'i'], body + [ast.Return(name('p'))])
+		if threaded or jobs > 1:
+			map_call = call(
+				name('_threaded_map_index' if threaded else '_parallel_map_index'),
+				name('pp'),
+				name('_transformer'),
+				const(sh_jobs if threaded else jobs),
+				ast.Tuple(elts=[const(n) for n in sorted(names)], ctx=ast.Load()),
+				const(source))
+		else:
+			map_call = call(attr(name('pp'), 'map_index'), name('_transformer'))
 		return [
 			transform_def,
-			assign_pp
+			assign('pp', map_call)
 			]
 
-	annotated_exprs = map(annotate, exprs)
-	is_linewise = lambda x: x[1] is MODE.LINE
+	annotated_exprs = rewrite_sort_slices(list(map(annotate, exprs)), MODE.GLOBAL)
+	is_linewise = lambda x: x[2] is MODE.LINE
+	command_checks = needs_command_checks([item[1] for item in annotated_exprs], rebound)
+	if not command_checks:
+		post_pipe_check = global_check = []
 
 	def ensure_stream():
 		call = ast.Call(
@@ -356,26 +623,67 @@ def compile_pipe_exprs(exprs):
 		)
 		body.append(assign('pp', call))
 
+	stage_numbers = itertools.count()
+	def profile_stage(start, source):
+		'''surround the statements in ``body[start:]`` with profiling probes'''
+		index = next(stage_numbers)
+		body.insert(start, ast.Expr(call(attr(name('_profiler'), 'begin'), const(index), const(source))))
+		body.append(assign('pp', call(attr(name('_profiler'), 'end'), const(index), name('pp'))))
+
+	if profile and input_lines:
+		profile_stage(len(body), '(input)')
+
+	first_stage = True
 	for linewise, group in itertools.groupby(annotated_exprs, is_linewise):
+		stage_start = len(body)
 		if linewise:
-			group_body = []
+			group = list(group)
+			group_exprs = [item[1] for item in group]
+			threaded = sh_jobs > 1 and needs_command_checks(group_exprs, rebound)
+			fused = jobs <= 1 and not threaded and not _captures_loop_variables(group_exprs)
+			group_source = ' | '.join(item[0] for item in group)
+			group_names = set()
 			for item in group:
-				expr, mode, vars = item
-				if not isinstance(expr, ast.Assign):
-					group_body.append(assign('_p', expr))
-					group_body.extend(post_expr_check)
-				else:
-					group_body.append(expr)
+				group_names.update(item[3])
+
+			# results which can't be callable or None don't need normalising
+			p_kind = STR if (first_stage and input_lines) else None
+			kinds = []
+			for index, expr in enumerate(group_exprs):
+				kind = None if isinstance(expr, ast.Assign) else infer_kind(expr, p_kind)
+				kinds.append(kind)
+				group_exprs[index] = unwrap_str_chains(precompile_regexes(expr, p_kind, rebound), p_kind)
+				if kind is STR:
+					p_kind = STR
+				elif kind is None or assigns_p(expr):
+					p_kind = None
+
+			group_body = line_statements(group_exprs, kinds, fused)
+			hoisted = None
+			if fused and hoist:
+				hoisted_exprs, prelude = hoist_invariants(group_exprs, rebound)
+				if prelude:
+					hoisted = (
+						[assign(var, expr) for var, expr in prelude],
+						line_statements(hoisted_exprs, kinds, fused))
 			ensure_stream()
-			body.extend(combine_pipe_transforms(group_body))
+			group_names.difference_update(MODE.LINE.vars)
+			body.extend(combine_pipe_transforms(group_body, group_source, group_names, fused, hoisted, threaded,
+				ends_in_assignment=isinstance(group_exprs[-1], ast.Assign)))
+			if profile:
+				profile_stage(stage_start, group_source)
 		else:
 			for item in group:
-				expr = item[0]
+				stage_start = len(body)
+				expr = item[1]
 				ensure_stream()
 				if not isinstance(expr, ast.Assign):
 					expr = assign('pp', expr)
 				body.append(expr)
-				body.extend(post_pipe_check)
+				body.extend(global_check)
+				if profile:
+					profile_stage(stage_start, item[0])
+		first_stage = False
 	
 	mod = ast.Module(body=body, type_ignores=[])
 	ast.fix_missing_locations(mod)
@@ -383,8 +691,37 @@ def compile_pipe_exprs(exprs):
 	#raise RuntimeError(ast.dump(mod))
 	return compile(mod, '(input)', 'exec')
 
-def eval_pipes(exprs, bindings):
-	mod = compile_pipe_exprs(exprs)
+def _captures_loop_variables(nodes):
+	'''
+	Does any lambda or generator expression in ``nodes`` refer to a variable
+	which is assigned per line (i.e. ``p``, ``i`` or an assignment in the pipeline)?
+
+	Such closures would see later lines' values if they were evaluated after
+	the fused loop had moved on, so those groups get a function call per line instead.
+
+	>>> import ast
+	>>> _captures_loop_variables([ast.parse("sorted(p, key=lambda c: c.lower())").body[0]])
+	False
+	>>> _captures_loop_variables([ast.parse("(c + p for c in 'ab')").body[0]])
+	True
+	'''
+	import ast
+	assigned = set(MODE.LINE.vars)
+	assigned.add('_p')
+	closures = []
+	for node in nodes:
+		for child in ast.walk(node):
+			if isinstance(child, ast.Name) and isinstance(child.ctx, ast.Store):
+				assigned.add(child.id)
+			elif isinstance(child, (ast.Lambda, ast.GeneratorExp)):
+				closures.append(child)
+	return any(
+		isinstance(child, ast.Name) and child.id in assigned
+		for closure in closures
+		for child in ast.walk(closure))
+
+def eval_pipes(exprs, bindings, jobs=1):
+	mod = compile_pipe_exprs(exprs, jobs=jobs)
 	execfn(mod, bindings)
 	return bindings['pp']
 
@@ -0,0 +1,155 @@
+'''
+Caching of shell command results (``--sh-cache``).
+
+Results (the exit status and output of a command) are keyed on the command's
+arguments, working directory and a selection of environment variables, or its
+entire environment when one is given explicitly (plus, optionally, the modification
+time and size of any arguments which are paths).
+They're kept in a size-limited in-memory LRU, and optionally in an sqlite
+database under the cache directory, which is shared between runs.
+'''
+import os
+import threading
+from collections import OrderedDict
+
+from piep import cache
+
+MEMORY_BYTES = 64 * 1024 * 1024
+
+# keyword arguments (besides piep's own) which don't prevent caching a command's result
+_CACHEABLE_KWARGS = frozenset(['stdout', 'cwd', 'env', 'shell'])
+
+def database_path():
+	return os.path.join(cache.cache_dir(), 'sh-results.sqlite')
+
+def clear():
+	'''remove all cached command results'''
+	path = database_path()
+	for suffix in ('', '-wal', '-shm'):
+		try:
+			os.remove(path + suffix)
+		except OSError:
+			pass
+
+class ResultCache(object):
+	'''
+	A cache of ``(status, stdout)`` results. ``env`` lists the environment variables
+	which are part of each key (for commands which don't pass their own ``env``), ``paths`` includes the mtime & size of path arguments,
+	and failed commands are only cached when ``failures`` is set. If ``disk`` is set,
+	results are also stored in (and loaded from) an sqlite database.
+
+	All methods are safe to call from multiple threads (and from forked processes).
+	'''
+	def __init__(self, disk=False, env=(), paths=False, failures=False, max_bytes=MEMORY_BYTES):
+		self.env = sorted(env)
+		self.paths = paths
+		self.failures = failures
+		self.max_bytes = max_bytes
+		self._memory = OrderedDict()
+		self._size = 0
+		self._lock = threading.Lock()
+		self._store = _Database(database_path()) if disk else None
+
+	def key(self, cmd, kwargs, input=None):
+		'''returns the key for a command, or ``None`` if its result can't be cached'''
+		import subprocess
+		if not set(kwargs).issubset(_CACHEABLE_KWARGS) or kwargs.get('stdout') is not subprocess.PIPE:
+			return None
+		if not (input is None or isinstance(input, str)):
+			return None
+		cwd = kwargs.get('cwd') or os.getcwd()
+		environ = kwargs.get('env')
+		if environ is None:
+			environ = [(name, os.environ.get(name)) for name in self.env]
+		else:
+			# (an explicit environment is usually specific to the command, so all of it matters)
+			environ = sorted((os.fsdecode(name), os.fsdecode(value)) for name, value in environ.items())
+		args = [os.fspath(arg) if isinstance(arg, os.PathLike) else arg for arg in cmd]
+		parts = [
+			args,
+			cwd,
+			environ,
+			bool(kwargs.get('shell')),
+			input,
+		]
+		if self.paths:
+			parts.append([_path_signature(os.path.join(cwd, arg)) for arg in args if isinstance(arg, str)])
+		return cache.digest(parts)
+
+	def get(self, key):
+		'''returns ``(status, stdout)``, or ``None``'''
+		with self._lock:
+			result = self._memory.get(key)
+			if result is not None:
+				self._memory.move_to_end(key)
+				return result
+		if self._store is not None:
+			result = self._store.get(key)
+			if result is not None:
+				self._remember(key, result)
+		return result
+
+	def put(self, key, status, stdout):
+		if status != 0 and not self.failures:
+			return
+		result = (status, stdout)
+		self._remember(key, result)
+		if self._store is not None:
+			self._store.put(key, result)
+
+	def _remember(self, key, result):
+		size = len(result[1])
+		if size > self.max_bytes:
+			return
+		with self._lock:
+			previous = self._memory.pop(key, None)
+			if previous is not None:
+				self._size -= len(previous[1])
+			self._memory[key] = result
+			self._size += size
+			while self._size > self.max_bytes:
+				_, evicted = self._memory.popitem(last=False)
+				self._size -= len(evicted[1])
+
+def _path_signature(path):
+	try:
+		st = os.stat(path)
+	except (OSError, ValueError):
+		return None
+	return (st.st_mtime_ns, st.st_size)
+
+class _Database(object):
+	'''results stored in sqlite (errors are ignored, it's only a cache)'''
+	def __init__(self, path):
+		self.path = path
+		self._local = threading.local()
+
+	def _connection(self):
+		import sqlite3
+		# connections can't be shared between threads, or across a fork
+		pid = os.getpid()
+		conn = getattr(self._local, 'conn', None)
+		if conn is None or self._local.pid != pid:
+			dest = os.path.dirname(self.path)
+			if not os.path.isdir(dest):
+				os.makedirs(dest)
+			conn = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+			conn.execute('PRAGMA journal_mode=WAL')
+			conn.execute('CREATE TABLE IF NOT EXISTS results (key TEXT PRIMARY KEY, status INTEGER, stdout BLOB)')
+			self._local.conn, self._local.pid = conn, pid
+		return conn
+
+	def get(self, key):
+		import sqlite3
+		try:
+			row = self._connection().execute('SELECT status, stdout FROM results WHERE key = ?', (key,)).fetchone()
+		except (sqlite3.Error, OSError):
+			return None
+		return None if row is None else (row[0], row[1])
+
+	def put(self, key, result):
+		import sqlite3
+		try:
+			self._connection().execute('INSERT OR REPLACE INTO results VALUES (?, ?, ?)', (key,) + result)
+		except (sqlite3.Error, OSError):
+			pass
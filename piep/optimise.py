@@ -0,0 +1,669 @@
+'''
+Compile-time analysis and AST rewrites of pipeline expressions.
+
+Rewrite passes take (and return) the annotated expressions used by
+:func:`piep.main.compile_pipe_exprs`, i.e. a list of
+``(source, ast_node, mode, referenced_names)`` tuples.
+'''
+import ast
+
+def _is_pp_call(node, methods):
+	'''is `node` a call of `pp.<method>(...)`, for one of `methods`?'''
+	return (isinstance(node, ast.Call)
+		and isinstance(node.func, ast.Attribute)
+		and isinstance(node.func.value, ast.Name)
+		and node.func.value.id == 'pp'
+		and node.func.attr in methods)
+
+def _int_constant(node):
+	'''the value of `node`, if it's an integer literal (possibly negated)'''
+	negate = False
+	if isinstance(node, ast.UnaryOp) and isinstance(node.op, ast.USub):
+		negate = True
+		node = node.operand
+	if isinstance(node, ast.Constant) and type(node.value) is int:
+		return -node.value if negate else node.value
+	return None
+
+def _plain_sort(call):
+	'''is `call` a `pp.sort()` without uniq?'''
+	if call.func.attr != 'sort' or call.args:
+		return False
+	return all(kw.arg == 'uniq' and isinstance(kw.value, ast.Constant) and kw.value.value is False
+		for kw in call.keywords)
+
+def _pp_call(method, args, keywords):
+	return ast.Call(
+		func=ast.Attribute(value=ast.Name(id='pp', ctx=ast.Load()), attr=method, ctx=ast.Load()),
+		args=args, keywords=keywords)
+
+def _rewrite_sort_slice(node):
+	'''
+	Returns a bounded-heap equivalent of a `pp.sort(...)[...]` / `pp.sortby(...)[...]`
+	subscript node, or None if it doesn't match.
+
+	- `pp.sortby(...)[:k]` and `pp.sort()[:k]` become `pp.bottom(k, ...)`
+	- `pp.sort()[-k:]` becomes `pp.top(k).reverse()`
+	'''
+	if not (isinstance(node, ast.Subscript) and isinstance(node.slice, ast.Slice)):
+		return None
+	call = node.value
+	if not _is_pp_call(call, ('sort', 'sortby')):
+		return None
+	bounds = node.slice
+	if bounds.step is not None:
+		return None
+
+	if bounds.lower is None and bounds.upper is not None:
+		k = _int_constant(bounds.upper)
+		if k is None or k < 0:
+			return None
+		if call.func.attr == 'sortby':
+			return _pp_call('bottom', [ast.Constant(value=k)] + call.args, call.keywords)
+		if _plain_sort(call):
+			return _pp_call('bottom', [ast.Constant(value=k)], [])
+
+	elif bounds.upper is None and bounds.lower is not None:
+		k = _int_constant(bounds.lower)
+		if k is None or k >= 0 or not _plain_sort(call):
+			return None
+		# (`top` only differs from this for items which compare equal
+		# but are distinguishable, which don't occur in sorted lines)
+		return ast.Call(
+			func=ast.Attribute(value=_pp_call('top', [ast.Constant(value=-k)], []), attr='reverse', ctx=ast.Load()),
+			args=[], keywords=[])
+	return None
+
+class _SortSliceRewriter(ast.NodeTransformer):
+	def visit_Subscript(self, node):
+		self.generic_visit(node)
+		return _rewrite_sort_slice(node) or node
+
+def rewrite_sort_slices(annotated, global_mode):
+	'''
+	Replace sort-then-slice patterns (within an expression, or across two
+	consecutive file-level expressions like ``pp.sortby(fn) | pp[:10]``)
+	with ``pp.bottom`` / ``pp.top``, which only need to keep ``k`` items in memory.
+	'''
+	result = []
+	for item in annotated:
+		source, node, mode, names = item
+		if mode is not global_mode or isinstance(node, ast.Assign):
+			result.append(item)
+			continue
+
+		if result:
+			prev_source, prev_node, prev_mode, prev_names = result[-1]
+			if (prev_mode is global_mode
+					and _is_pp_call(prev_node, ('sort', 'sortby'))
+					and isinstance(node, ast.Subscript)
+					and isinstance(node.value, ast.Name) and node.value.id == 'pp'):
+				combined = _rewrite_sort_slice(ast.Subscript(value=prev_node, slice=node.slice, ctx=ast.Load()))
+				if combined is not None:
+					result[-1] = (prev_source + ' | ' + source, combined, mode, set(prev_names).union(names))
+					continue
+
+		result.append((source, _SortSliceRewriter().visit(node), mode, names))
+	return result
+
+# builtins which create (or may create) shell commands
+COMMAND_NAMES = frozenset(['sh', 'spawn', 'Command'])
+
+# python builtins which can reach arbitrary globals
+_OPAQUE_BUILTINS = frozenset(['eval', 'exec', '__import__', 'globals', 'locals', 'vars', 'breakpoint'])
+
+def _known_names():
+	import builtins as python_builtins
+	from piep.builtins import builtins
+	from piep.main import RESERVED_VARS
+	return (
+		set(dir(python_builtins)).difference(_OPAQUE_BUILTINS)
+		.union(builtins)
+		.union(RESERVED_VARS)
+		.difference(COMMAND_NAMES))
+
+def needs_command_checks(nodes, rebound=()):
+	'''
+	Could any of the given expressions start a shell command? If not, the
+	``_check_for_failed_commands()`` call after each expression can be left out.
+
+	This is the case when every referenced name is a python or piep builtin
+	(other than ``sh``, ``spawn`` and ``Command``), or a variable assigned within
+	the pipeline itself. ``rebound`` are the names bound by ``--eval`` and ``--import``,
+	which could refer to anything (``"*"`` means any name may have been rebound).
+
+	>>> needs_command_checks([ast.parse("sorted(p.split(), key=lambda w: len(w))").body[0]])
+	False
+	>>> needs_command_checks([ast.parse("sh('ls', p)").body[0]])
+	True
+	>>> needs_command_checks([ast.parse("fn(p)").body[0]])
+	True
+	>>> needs_command_checks([ast.parse("len(p)").body[0]], rebound=['len'])
+	True
+	'''
+	if '*' in rebound:
+		return True
+	loaded = set()
+	local = set()
+	for node in nodes:
+		for child in ast.walk(node):
+			if isinstance(child, ast.Name):
+				(loaded if isinstance(child.ctx, ast.Load) else local).add(child.id)
+			elif isinstance(child, ast.arg):
+				local.add(child.arg)
+	unknown = loaded.difference(_known_names().difference(rebound), local.difference(COMMAND_NAMES))
+	return bool(unknown)
+
+STR = 'str'
+BOOL = 'bool'
+
+# methods of `str` (and `piep.Line`) which always return a string / boolean
+_STR_METHODS = frozenset([
+	'capitalize', 'casefold', 'center', 'expandtabs', 'format', 'join', 'ljust', 'lower',
+	'lstrip', 'removeprefix', 'removesuffix', 'replace', 'rjust', 'rstrip', 'strip',
+	'swapcase', 'title', 'translate', 'upper', 'zfill',
+	'basename', 'dirname', 'ext', 'filename', 'reversed', 'stripext',
+])
+_BOOL_METHODS = frozenset([
+	'endswith', 'isalnum', 'isalpha', 'isascii', 'isdecimal', 'isdigit', 'isidentifier',
+	'islower', 'isnumeric', 'isprintable', 'isspace', 'istitle', 'isupper', 'startswith',
+	'matches',
+])
+_BOOL_COMPARISONS = (ast.In, ast.NotIn, ast.Is, ast.IsNot)
+
+def infer_kind(node, p_kind=None):
+	'''
+	Returns :data:`STR` if ``node`` always evaluates to a string, :data:`BOOL` if
+	it always evaluates to a boolean, or ``None`` if it may be anything.
+	``p_kind`` is what's known about ``p``.
+
+	>>> infer_kind(ast.parse("p.strip().upper()").body[0].value, STR)
+	'str'
+	>>> infer_kind(ast.parse("p.strip().upper()").body[0].value) is None
+	True
+	>>> infer_kind(ast.parse("'x' in p or p.startswith('y')").body[0].value, STR)
+	'bool'
+	>>> infer_kind(ast.parse("p == 'x'").body[0].value) is None
+	True
+	'''
+	if isinstance(node, ast.Constant):
+		if isinstance(node.value, bool):
+			return BOOL
+		return STR if isinstance(node.value, str) else None
+	if isinstance(node, ast.JoinedStr):
+		return STR
+	if isinstance(node, ast.Name):
+		return p_kind if node.id == 'p' else None
+	if isinstance(node, ast.UnaryOp):
+		return BOOL if isinstance(node.op, ast.Not) else None
+	if isinstance(node, ast.Compare):
+		if all(isinstance(op, _BOOL_COMPARISONS) for op in node.ops):
+			return BOOL
+		# other comparisons can return anything, unless both sides are strings
+		operands = [node.left] + node.comparators
+		if all(infer_kind(operand, p_kind) == STR for operand in operands):
+			return BOOL
+		return None
+	if isinstance(node, (ast.BoolOp, ast.IfExp)):
+		values = node.values if isinstance(node, ast.BoolOp) else [node.body, node.orelse]
+		kinds = set(infer_kind(value, p_kind) for value in values)
+		return kinds.pop() if len(kinds) == 1 else None
+	if isinstance(node, ast.BinOp):
+		if infer_kind(node.left, p_kind) != STR:
+			return None
+		if isinstance(node.op, ast.Mod):
+			return STR
+		if isinstance(node.op, ast.Add) and infer_kind(node.right, p_kind) == STR:
+			return STR
+		return None
+	if isinstance(node, ast.Subscript):
+		return STR if infer_kind(node.value, p_kind) == STR else None
+	if isinstance(node, ast.Call) and isinstance(node.func, ast.Attribute):
+		if infer_kind(node.func.value, p_kind) == STR:
+			if node.func.attr in _STR_METHODS:
+				return STR
+			if node.func.attr in _BOOL_METHODS:
+				return BOOL
+	return None
+
+def assigns_p(node):
+	'''does ``node`` (re)assign ``p``?'''
+	return any(
+		isinstance(child, ast.Name) and child.id == 'p' and isinstance(child.ctx, ast.Store)
+		for child in ast.walk(node))
+
+IMMUTABLE = 'immutable'
+MUTABLE = 'mutable'
+_FILE = 'file'
+
+# side-effect free callables (by name), and whether their results may be mutated
+_PURE_FUNCTIONS = {
+	'abs': IMMUTABLE, 'bool': IMMUTABLE, 'bytes': IMMUTABLE, 'chr': IMMUTABLE,
+	'float': IMMUTABLE, 'frozenset': IMMUTABLE, 'int': IMMUTABLE, 'len': IMMUTABLE,
+	'max': IMMUTABLE, 'min': IMMUTABLE, 'ord': IMMUTABLE, 'range': IMMUTABLE,
+	'repr': IMMUTABLE, 'round': IMMUTABLE, 'str': IMMUTABLE, 'tuple': IMMUTABLE,
+	'dict': MUTABLE, 'list': MUTABLE, 'set': MUTABLE, 'sorted': MUTABLE,
+	'_compile_regex': IMMUTABLE,
+}
+_PURE_MODULE_FUNCTIONS = {
+	're': dict.fromkeys(['compile', 'escape'], IMMUTABLE),
+	'path': dict.fromkeys([
+		'abspath', 'basename', 'dirname', 'exists', 'expanduser', 'getsize', 'isdir',
+		'isfile', 'join', 'normpath', 'realpath', 'splitext'], IMMUTABLE),
+}
+_PURE_METHODS = {
+	'casefold': IMMUTABLE, 'decode': IMMUTABLE, 'encode': IMMUTABLE, 'format': IMMUTABLE,
+	'join': IMMUTABLE, 'lower': IMMUTABLE, 'lstrip': IMMUTABLE, 'replace': IMMUTABLE,
+	'rstrip': IMMUTABLE, 'strip': IMMUTABLE, 'upper': IMMUTABLE,
+	'rsplit': MUTABLE, 'split': MUTABLE, 'splitlines': MUTABLE,
+}
+_FILE_METHODS = {'read': IMMUTABLE, 'readlines': MUTABLE}
+# functions which consume a file (or other iterable) argument entirely
+_CONSUMING_FUNCTIONS = frozenset(['frozenset', 'list', 'set', 'sorted', 'tuple'])
+_READ_MODES = frozenset(['r', 'rt', 'rb'])
+# builtins whose calls may have side effects on files or shared state
+_EFFECTFUL_BUILTINS = COMMAND_NAMES.union(['os', 'sys', 'open', 'print', 'setattr', 'delattr'])
+
+class _Hoister(object):
+	'''
+	Finds the largest line-independent subexpressions of a group's expressions
+	(see :func:`hoist_invariants`).
+	'''
+	def __init__(self, local, builtin, unstable):
+		self.local = local
+		self.builtin = builtin
+		self.unstable = unstable
+
+	def _module(self, node):
+		'''the name of a builtin module referenced by `node` (if any)'''
+		if isinstance(node, ast.Name) and node.id in ('re', 'path') and node.id in self.builtin:
+			return node.id
+		if (isinstance(node, ast.Attribute) and node.attr == 'path'
+				and isinstance(node.value, ast.Name) and node.value.id == 'os' and 'os' in self.builtin):
+			return 'path'
+		return None
+
+	def classify(self, node):
+		'''
+		Returns IMMUTABLE or MUTABLE if `node` is line-independent and side-effect
+		free (_FILE for files opened for reading), or None.
+		'''
+		if isinstance(node, ast.Constant):
+			return IMMUTABLE
+		if isinstance(node, ast.Name):
+			if node.id in self.local or node.id in self.unstable:
+				return None
+			return IMMUTABLE
+		if isinstance(node, (ast.List, ast.Set, ast.Tuple)):
+			if not all(self.classify(elt) for elt in node.elts):
+				return None
+			return IMMUTABLE if isinstance(node, ast.Tuple) else MUTABLE
+		if isinstance(node, ast.Dict):
+			if not all(part is not None and self.classify(part) for part in node.keys + node.values):
+				return None
+			return MUTABLE
+		if isinstance(node, (ast.BinOp, ast.BoolOp, ast.Compare, ast.UnaryOp, ast.IfExp)):
+			kinds = [self.classify(child) for child in ast.iter_child_nodes(node) if isinstance(child, ast.expr)]
+			if not all(kinds) or _FILE in kinds:
+				return None
+			return MUTABLE if MUTABLE in kinds else IMMUTABLE
+		if isinstance(node, ast.Subscript):
+			if self.classify(node.value) in (IMMUTABLE, MUTABLE) and self.classify(node.slice):
+				return MUTABLE
+			return None
+		if isinstance(node, ast.Slice):
+			parts = [part for part in (node.lower, node.upper, node.step) if part is not None]
+			return IMMUTABLE if all(self.classify(part) for part in parts) else None
+		if isinstance(node, ast.Attribute):
+			return IMMUTABLE if self._module(node.value) or self._module(node) else None
+		if isinstance(node, ast.Call):
+			return self._classify_call(node)
+		return None
+
+	def _classify_call(self, node):
+		if any(isinstance(arg, ast.Starred) for arg in node.args) or any(kw.arg is None for kw in node.keywords):
+			return None
+		args = [self.classify(arg) for arg in node.args]
+		kwargs = [self.classify(kw.value) for kw in node.keywords]
+		if not all(kwargs):
+			return None
+		func = node.func
+
+		if isinstance(func, ast.Name) and func.id in self.builtin and func.id not in self.unstable:
+			if func.id == 'open':
+				mode = node.args[1] if len(node.args) > 1 else None
+				if node.keywords or len(node.args) > 2 or len(node.args) < 1 or args[0] is not IMMUTABLE:
+					return None
+				if mode is not None and not (isinstance(mode, ast.Constant) and mode.value in _READ_MODES):
+					return None
+				return _FILE
+			result = _PURE_FUNCTIONS.get(func.id)
+			if result is None or not all(args):
+				return None
+			if _FILE in args and func.id not in _CONSUMING_FUNCTIONS:
+				return None
+			return result
+
+		if not isinstance(func, ast.Attribute) or not all(kind in (IMMUTABLE, MUTABLE) for kind in args):
+			return None
+		module = self._module(func.value)
+		if module is not None:
+			return _PURE_MODULE_FUNCTIONS[module].get(func.attr)
+		if isinstance(func.value, ast.Name):
+			# methods of unknown objects might do anything
+			return None
+		receiver = self.classify(func.value)
+		if receiver is _FILE:
+			return _FILE_METHODS.get(func.attr)
+		if receiver is not None:
+			return _PURE_METHODS.get(func.attr)
+		return None
+
+	def worth_hoisting(self, node):
+		return not isinstance(node, (ast.Constant, ast.Name, ast.Attribute)) and any(
+			isinstance(child, (ast.Call, ast.Dict, ast.List, ast.Set))
+			for child in ast.walk(node))
+
+	def hoist(self, node, readonly, hoisted):
+		'''
+		Replace hoistable subexpressions of `node` (in place), appending
+		``(name, expr)`` to `hoisted`. Mutable values are only hoisted from
+		positions where they can't be modified (e.g. the right hand side of ``in``).
+		'''
+		kind = self.classify(node)
+		if kind in (IMMUTABLE, MUTABLE) and (kind is IMMUTABLE or readonly) and self.worth_hoisting(node):
+			hoisted_name = '_hoisted_%d' % (len(hoisted),)
+			hoisted.append((hoisted_name, node))
+			return ast.Name(id=hoisted_name, ctx=ast.Load())
+
+		if isinstance(node, (ast.Lambda, ast.GeneratorExp, ast.ListComp, ast.SetComp, ast.DictComp, ast.NamedExpr)):
+			# evaluated for a varying number of items (or none at all)
+			return node
+		for field, value in ast.iter_fields(node):
+			if isinstance(value, list):
+				setattr(node, field, [
+					self.hoist(child, self._readonly_child(node, field, index), hoisted) if isinstance(child, ast.AST) else child
+					for index, child in enumerate(value)])
+			elif isinstance(value, ast.AST):
+				setattr(node, field, self.hoist(value, self._readonly_child(node, field, None), hoisted))
+		return node
+
+	def _readonly_child(self, node, field, index):
+		'''can the value in the given child position of `node` never be modified?'''
+		if isinstance(node, ast.Compare) and field == 'comparators':
+			return isinstance(node.ops[index], (ast.In, ast.NotIn))
+		if isinstance(node, ast.Subscript) and field == 'value':
+			return isinstance(node.ctx, ast.Load)
+		if isinstance(node, ast.Call) and field == 'args':
+			return isinstance(node.func, ast.Name) and node.func.id in _PURE_FUNCTIONS and node.func.id in self.builtin
+		if isinstance(node, ast.Attribute) and field == 'value':
+			return node.attr in ('get', 'keys', 'values', 'items', 'count', 'index', 'issubset', 'issuperset', 'isdisjoint')
+		return False
+
+def hoist_invariants(nodes, rebound=()):
+	'''
+	Loop-invariant hoisting for a group of linewise expressions.
+
+	Finds subexpressions which don't depend on ``p``, ``i`` or anything
+	assigned in the group, and which only use known side-effect free builtins
+	(like ``re.compile``, ``set``, ``frozenset``, ``open(...).read()`` and ``path.*``).
+	These can be evaluated once, rather than once per line.
+
+	Returns a copy of ``nodes`` (with hoisted subexpressions replaced by variables) and
+	a list of ``(name, expr)`` assignments which need to run first. Hoisted
+	expressions may still fail, in which case the original ``nodes`` should be
+	used (so that any error happens at the same time it otherwise would).
+
+	>>> nodes, hoisted = hoist_invariants([ast.parse("p in set(open('allow').read().split())").body[0].value])
+	>>> ast.unparse(nodes[0]), [(name, ast.unparse(expr)) for name, expr in hoisted]
+	('p in _hoisted_0', [('_hoisted_0', "set(open('allow').read().split())")])
+
+	Names which aren't builtins are only used if nothing else in the group
+	could modify them:
+
+	>>> hoist_invariants([ast.parse("p.matches(re.compile(PATTERN))").body[0].value])[1] != []
+	True
+	>>> hoist_invariants([ast.parse("p not in frozenset(seen) and not seen.add(p)").body[0].value])[1]
+	[]
+	'''
+	import copy
+	if '*' in rebound:
+		return nodes, []
+	local = set(['p', 'i', '_p'])
+	for node in nodes:
+		for child in ast.walk(node):
+			if isinstance(child, ast.Name) and not isinstance(child.ctx, ast.Load):
+				local.add(child.id)
+			elif isinstance(child, ast.arg):
+				local.add(child.arg)
+	builtin = _known_names().union(['open']).difference(rebound, local)
+	unstable = set()
+
+	while True:
+		hoister = _Hoister(local, builtin, unstable)
+		hoisted = []
+		result = [hoister.hoist(copy.deepcopy(node), False, hoisted) for node in nodes]
+		if not hoisted:
+			return nodes, []
+
+		# anything hoisted which isn't a side-effect free builtin (e.g. variables
+		# from `--eval`, or reading files) must not be modified (or written)
+		# while the loop is running
+		remaining = set()
+		opaque_calls = False
+		for node in result:
+			for child in ast.walk(node):
+				if isinstance(child, ast.Name):
+					remaining.add(child.id)
+				elif isinstance(child, ast.Call):
+					root = child.func
+					while isinstance(root, ast.Attribute):
+						root = root.value
+					if isinstance(root, ast.Name) and root.id not in local and (
+							root.id not in builtin or root.id in _EFFECTFUL_BUILTINS):
+						opaque_calls = True
+		newly_unstable = set()
+		for _, expr in hoisted:
+			for child in ast.walk(expr):
+				if isinstance(child, ast.Name) and (child.id not in builtin or child.id == 'open'):
+					if opaque_calls or child.id in remaining:
+						newly_unstable.add(child.id)
+		if not newly_unstable:
+			return result, hoisted
+		unstable.update(newly_unstable)
+
+# the position of the `flags` argument to each `re` function
+_RE_FUNCTION_FLAGS = {
+	'search': 2, 'match': 2, 'fullmatch': 2, 'findall': 2, 'finditer': 2,
+	'split': 3, 'sub': 4, 'subn': 4,
+}
+# ... and to each regex method of `piep.Line`
+_LINE_REGEX_METHOD_FLAGS = {'match': 2, 'matches': 2, 'splitre': 2}
+
+def _split_flags(call, position):
+	'''
+	Returns (args, flags) for `call` with its `flags` argument (or None) removed
+	from `args`, or None if the arguments can't be understood.
+	'''
+	if call.keywords and any(kw.arg is None for kw in call.keywords):
+		return None
+	if any(isinstance(arg, ast.Starred) for arg in call.args) or len(call.args) > position + 1:
+		return None
+	args = list(call.args)
+	keywords = [kw for kw in call.keywords if kw.arg != 'flags']
+	flags = [kw.value for kw in call.keywords if kw.arg == 'flags']
+	if len(args) > position:
+		flags.append(args.pop())
+	if len(flags) > 1:
+		return None
+	return args, keywords, (flags[0] if flags else None)
+
+def _compile_regex(pattern, flags):
+	args = [pattern] if flags is None else [pattern, flags]
+	return ast.Call(func=ast.Name(id='_compile_regex', ctx=ast.Load()), args=args, keywords=[])
+
+class _RegexRewriter(ast.NodeTransformer):
+	def __init__(self, p_kind, re_builtin):
+		self.p_kind = p_kind
+		self.re_builtin = re_builtin
+
+	def visit_Call(self, node):
+		self.generic_visit(node)
+		func = node.func
+		if not isinstance(func, ast.Attribute):
+			return node
+
+		if (self.re_builtin and isinstance(func.value, ast.Name) and func.value.id == 're'
+				and func.attr in _RE_FUNCTION_FLAGS and node.args):
+			parts = _split_flags(node, _RE_FUNCTION_FLAGS[func.attr])
+			if parts is None:
+				return node
+			args, keywords, flags = parts
+			pattern = _compile_regex(args[0], flags)
+			return ast.Call(func=ast.Attribute(value=pattern, attr=func.attr, ctx=ast.Load()), args=args[1:], keywords=keywords)
+
+		if (func.attr in _LINE_REGEX_METHOD_FLAGS and node.args
+				and isinstance(node.args[0], ast.Constant) and isinstance(node.args[0].value, str)
+				and infer_kind(func.value, self.p_kind) == STR):
+			parts = _split_flags(node, _LINE_REGEX_METHOD_FLAGS[func.attr])
+			if parts is None:
+				return node
+			args, keywords, flags = parts
+			return ast.Call(func=func, args=[_compile_regex(args[0], flags)] + args[1:], keywords=keywords)
+		return node
+
+def precompile_regexes(node, p_kind=None, rebound=()):
+	'''
+	Returns a copy of ``node`` in which calls to ``re`` functions (like ``re.search(pattern, p)``)
+	use :func:`piep.line.compile_regex` (which has a larger cache than the ``re`` module's).
+	Constant patterns passed to ``re`` functions or to ``p.match``, ``p.matches`` and ``p.splitre``
+	become ``compile_regex("pattern")`` calls, which can then be hoisted (see :func:`hoist_invariants`)
+	so that each is only compiled once.
+
+	>>> ast.unparse(precompile_regexes(ast.parse("re.sub('a+', 'b', p, flags=re.I)").body[0]))
+	"_compile_regex('a+', re.I).sub('b', p)"
+	>>> ast.unparse(precompile_regexes(ast.parse("p.matches('a+')").body[0], STR))
+	"p.matches(_compile_regex('a+'))"
+	'''
+	import copy
+	local = set(
+		child.id for child in ast.walk(node)
+		if isinstance(child, ast.Name) and not isinstance(child.ctx, ast.Load))
+	re_builtin = 're' not in rebound and 're' not in local and '*' not in rebound
+	return _RegexRewriter(p_kind, re_builtin).visit(copy.deepcopy(node))
+
+# `str` methods returning a string (which `piep.Line` wraps to return a `Line`)
+_PLAIN_STR_METHODS = frozenset([
+	'capitalize', 'casefold', 'center', 'expandtabs', 'format', 'join', 'ljust', 'lower',
+	'lstrip', 'removeprefix', 'removesuffix', 'replace', 'rjust', 'rstrip', 'strip',
+	'swapcase', 'title', 'translate', 'upper', 'zfill',
+])
+# `str` methods returning a sequence of strings
+_PLAIN_SEQUENCE_METHODS = frozenset(['partition', 'rpartition', 'rsplit', 'split', 'splitlines'])
+_PLAIN_BOOL_METHODS = _BOOL_METHODS.difference(['matches'])
+
+def _plain_method_call(method, receiver, call):
+	return ast.Call(
+		func=ast.Attribute(value=ast.Name(id='_str', ctx=ast.Load()), attr=method, ctx=ast.Load()),
+		args=[receiver] + call.args,
+		keywords=call.keywords)
+
+class _StrChainRewriter(object):
+	def __init__(self, p_kind):
+		self.p_kind = p_kind
+
+	def _str_method_call(self, node, methods):
+		'''is `node` a call of one of `methods` on a string?'''
+		return (isinstance(node, ast.Call)
+			and isinstance(node.func, ast.Attribute)
+			and node.func.attr in methods
+			and not any(isinstance(arg, ast.Starred) for arg in node.args)
+			and not any(kw.arg is None for kw in node.keywords)
+			and infer_kind(node.func.value, self.p_kind) == STR)
+
+	def _rewrite_args(self, call):
+		call.args = [self.rewrite(arg) for arg in call.args]
+		for kw in call.keywords:
+			kw.value = self.rewrite(kw.value)
+
+	def plain(self, node):
+		'''
+		Returns a version of the string method chain `node` which works on (and returns)
+		plain `str` objects rather than `Line`s, or None if `node` isn't a chain.
+		'''
+		if self._str_method_call(node, _PLAIN_STR_METHODS):
+			self._rewrite_args(node)
+			receiver = node.func.value
+			return _plain_method_call(node.func.attr, self.plain(receiver) or self.rewrite(receiver, escapes=False), node)
+		if isinstance(node, ast.Subscript) and isinstance(node.ctx, ast.Load):
+			value = node.value
+			if self._str_method_call(value, _PLAIN_SEQUENCE_METHODS) and not isinstance(node.slice, ast.Slice):
+				# a single element of e.g. `p.split()`
+				self._rewrite_args(value)
+				receiver = value.func.value
+				value = _plain_method_call(value.func.attr, self.plain(receiver) or self.rewrite(receiver, escapes=False), value)
+			else:
+				value = self.plain(value)
+			if value is not None:
+				return ast.Subscript(value=value, slice=self.rewrite(node.slice), ctx=ast.Load())
+		return None
+
+	def rewrite(self, node, escapes=True):
+		'''
+		Rewrite string method chains within `node`. If the result `escapes`
+		(i.e. it could be seen by the user), it's converted back to a `Line`.
+		'''
+		plain = self.plain(node)
+		if plain is not None:
+			if not escapes:
+				return plain
+			return ast.Call(func=ast.Name(id='_line', ctx=ast.Load()), args=[plain], keywords=[])
+
+		if isinstance(node, ast.Compare):
+			# comparisons don't depend on the type of string
+			node.left = self.rewrite(node.left, escapes=False)
+			node.comparators = [self.rewrite(child, escapes=False) for child in node.comparators]
+			return node
+		if self._str_method_call(node, _PLAIN_BOOL_METHODS):
+			receiver = self.plain(node.func.value)
+			if receiver is not None:
+				self._rewrite_args(node)
+				return _plain_method_call(node.func.attr, receiver, node)
+
+		if isinstance(node, (ast.Lambda, ast.GeneratorExp, ast.ListComp, ast.SetComp, ast.DictComp)):
+			# `p` may be shadowed
+			return node
+		for field, value in ast.iter_fields(node):
+			if isinstance(value, list):
+				setattr(node, field, [self._rewrite_child(child) for child in value])
+			elif isinstance(value, ast.AST):
+				setattr(node, field, self._rewrite_child(value))
+		return node
+
+	def _rewrite_child(self, child):
+		if isinstance(child, ast.expr):
+			return self.rewrite(child)
+		if isinstance(child, ast.keyword):
+			child.value = self.rewrite(child.value)
+		return child
+
+def unwrap_str_chains(node, p_kind=None):
+	'''
+	Returns a copy of ``node`` in which chains of string methods (on values known to be strings)
+	call plain ``str`` methods, only converting the end result to a :class:`piep.Line`
+	(and only if it's used for more than e.g. a comparison).
+
+	Each ``Line`` method would otherwise create a new ``Line`` object, via a python-level wrapper.
+
+	>>> ast.unparse(unwrap_str_chains(ast.parse("p.strip().lower().split()[2]").body[0], STR))
+	'_line(_str.split(_str.lower(_str.strip(p)))[2])'
+	>>> ast.unparse(unwrap_str_chains(ast.parse("p.strip().startswith(x) and p.upper() == 'A'").body[0], STR))
+	"_str.startswith(_str.strip(p), x) and _str.upper(p) == 'A'"
+	>>> ast.unparse(unwrap_str_chains(ast.parse("p.strip().ext()").body[0], STR))
+	'_line(_str.strip(p)).ext()'
+	'''
+	import copy
+	if p_kind is not STR and not any(
+			isinstance(child, (ast.Constant, ast.JoinedStr)) for child in ast.walk(node)):
+		return node
+	return _StrChainRewriter(p_kind).rewrite(copy.deepcopy(node))
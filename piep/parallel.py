@@ -0,0 +1,189 @@
+'''
+Parallel execution of line-mode pipeline groups.
+
+With ``--jobs``, batches of lines are sent to a pool of forked worker processes,
+and results are yielded in input order. Groups which rely on side effects or state
+shared between lines are run serially instead.
+
+With ``--sh-jobs``, groups which run shell commands process multiple lines
+at once on a pool of threads (so that multiple commands can run at once),
+again yielding results in input order. Groups which share state between lines
+(other than by running shell commands) are run serially, in the same way.
+'''
+from __future__ import print_function
+import re
+import sys
+import types
+from collections import deque
+
+BATCH_SIZE = 1024
+
+# names whose use implies side effects that need to happen in order (and in this process)
+SERIAL_NAMES = frozenset(['sh', 'spawn', 'coproc', 'Command', 'devnull', 'print', 'input'])
+
+# the same, for threads (which track the commands each line runs independently,
+# but share coprocesses and the terminal)
+THREAD_SERIAL_NAMES = frozenset(['coproc', 'print', 'input'])
+
+_SHAREABLE_TYPES = (
+	types.ModuleType, types.FunctionType, types.BuiltinFunctionType, type,
+	str, bytes, int, float, complex, bool, type(None), tuple, frozenset, range,
+	type(re.compile('')),
+)
+
+def serial_reason(fn, names, threads=False):
+	'''
+	Returns a description of why ``fn`` (referencing global ``names``) can't be
+	run in parallel (on worker processes, or ``threads``), or ``None`` if it can.
+
+	Functions defined by the pipeline itself (e.g. with ``-e``) are checked in the
+	same way, via the globals (and closure variables) they reference.
+	'''
+	reason = _unshareable(names, fn.__globals__, set(), THREAD_SERIAL_NAMES if threads else SERIAL_NAMES)
+	if reason is not None or threads:
+		return reason
+	try:
+		import multiprocessing
+		multiprocessing.get_context('fork')
+	except ValueError:
+		return 'this platform does not support forked worker processes'
+	return None
+
+def _unshareable(names, globs, checked, serial_names=SERIAL_NAMES):
+	unsafe = sorted(serial_names.intersection(names))
+	if unsafe:
+		return 'it uses `%s`' % (unsafe[0],)
+	for name in sorted(names):
+		if name not in globs:
+			continue
+		value = globs[name]
+		if isinstance(value, types.FunctionType) and value.__globals__ is globs:
+			if name in checked:
+				continue
+			checked.add(name)
+			reason = _unshareable(_referenced_names(value.__code__), globs, checked, serial_names)
+			if reason is None:
+				for contents in _bound_values(value):
+					if not isinstance(contents, _SHAREABLE_TYPES):
+						reason = 'it refers to a %s, which may hold state shared between lines' % (type(contents).__name__,)
+						break
+			if reason is not None:
+				return '%s (via `%s`)' % (reason, name)
+		elif not isinstance(value, _SHAREABLE_TYPES):
+			return '`%s` (a %s) may hold state shared between lines' % (name, type(value).__name__)
+	return None
+
+def _bound_values(fn):
+	'''the values of `fn`'s closure variables and default arguments'''
+	for cell in fn.__closure__ or ():
+		try:
+			yield cell.cell_contents
+		except ValueError: # (not yet assigned)
+			pass
+	yield from fn.__defaults__ or ()
+	yield from (fn.__kwdefaults__ or {}).values()
+
+def _referenced_names(code):
+	'''the global (and attribute) names used by `code`, including any nested functions'''
+	names = set(code.co_names)
+	for const in code.co_consts:
+		if isinstance(const, types.CodeType):
+			names.update(_referenced_names(const))
+	return names
+
+def parallel_map_index(pp, fn, jobs, names, source=None):
+	'''
+	Equivalent to ``pp.map_index(fn)``, but processes batches of lines in ``jobs`` worker processes.
+	Falls back to ``pp.map_index(fn)`` (with a warning) if ``fn`` can't safely be run in parallel.
+	'''
+	reason = serial_reason(fn, names)
+	if reason is not None:
+		print('piep: running `%s` serially, since %s' % (source or 'expression', reason), file=sys.stderr)
+		return pp.map_index(fn)
+	return pp._replace(_parallel_results(pp.src, fn, jobs))
+
+def _batches(src, size):
+	start = 0
+	batch = []
+	for line in src:
+		batch.append(line)
+		if len(batch) == size:
+			yield start, batch
+			start += size
+			batch = []
+	if batch:
+		yield start, batch
+
+def _parallel_results(src, fn, jobs, batch_size=BATCH_SIZE):
+	import multiprocessing
+	pool = multiprocessing.get_context('fork').Pool(jobs, initializer=_init_worker, initargs=(fn,))
+	try:
+		# keep a bounded number of batches in flight, so that
+		# we don't read the entire input ahead of the consumer
+		pending = deque()
+		for batch in _batches(src, batch_size):
+			pending.append(pool.apply_async(_run_batch, (batch,)))
+			if len(pending) >= jobs * 2:
+				yield from pending.popleft().get()
+		while pending:
+			yield from pending.popleft().get()
+	finally:
+		pool.terminate()
+
+_worker_fn = None
+
+def _init_worker(fn):
+	global _worker_fn
+	_worker_fn = fn
+
+def _run_batch(batch):
+	'''the worker half of BaseList.map_index, for a batch of lines'''
+	start, lines = batch
+	fn = _worker_fn
+	results = []
+	for i, line in enumerate(lines, start):
+		result = _filter_result(line, fn(line, i))
+		if result is not None:
+			results.append(result)
+	return results
+
+def threaded_map_index(pp, fn, jobs, names, source=None):
+	'''
+	Equivalent to ``pp.map_index(fn)``, but calls ``fn`` for up to ``jobs`` lines at once (on separate threads).
+	Each call tracks (and checks) the shell commands it starts independently. If any line fails,
+	the error from the earliest such line is raised, once all previous results have been yielded.
+	Falls back to ``pp.map_index(fn)`` (with a warning) if ``fn`` may share state between lines.
+	'''
+	reason = serial_reason(fn, names, threads=True)
+	if reason is not None:
+		print('piep: running `%s` serially, since %s' % (source or 'expression', reason), file=sys.stderr)
+		return pp.map_index(fn)
+	return pp._replace(_threaded_results(pp.src, fn, jobs))
+
+def _threaded_results(src, fn, jobs):
+	from concurrent.futures import ThreadPoolExecutor
+	from piep.shell import track_commands_per_thread
+	run = track_commands_per_thread()
+	pool = ThreadPoolExecutor(jobs, thread_name_prefix='piep-sh')
+	try:
+		pending = deque()
+		for i, line in enumerate(src):
+			pending.append((line, pool.submit(run, fn, line, i)))
+			if len(pending) >= jobs * 2:
+				line, future = pending.popleft()
+				result = _filter_result(line, future.result())
+				if result is not None:
+					yield result
+		while pending:
+			line, future = pending.popleft()
+			result = _filter_result(line, future.result())
+			if result is not None:
+				yield result
+	finally:
+		pool.shutdown(wait=True, cancel_futures=True)
+
+def _filter_result(line, result):
+	'''the result handling of BaseList.map'''
+	if isinstance(result, bool):
+		return line if result else None
+	return result
@@ -0,0 +1,98 @@
+'''
+Per-stage profiling of pipelines (``--profile``).
+
+When profiling, :func:`piep.main.compile_pipe_exprs` surrounds each stage (a
+file-mode expression, or a group of linewise expressions) with calls to
+:meth:`Profiler.begin` and :meth:`Profiler.end`. The time taken by the stage
+itself is recorded, and its output is wrapped in a probe which counts lines
+and times each one. Since stages are lazy, the time taken to produce a line
+includes the time taken by the previous stage to produce its lines, so that
+time is subtracted from each stage's total.
+
+None of this code is generated (or run) without ``--profile``.
+'''
+from __future__ import print_function
+import sys
+import time
+
+from piep import shell
+from piep.sequence import BaseList
+
+class _Stage(object):
+	def __init__(self, label):
+		self.label = label
+		self.lines = None
+		# [wall, cpu, sh] times spent running the stage itself, and
+		# producing lines from its output (which includes pulling lines from earlier stages)
+		self.running = [0.0, 0.0, 0.0]
+		self.producing = [0.0, 0.0, 0.0]
+
+class Profiler(object):
+	def __init__(self):
+		self.stages = {}
+		self.started = time.perf_counter()
+		shell.command_time = 0.0
+		self._pending = None
+
+	def _now(self):
+		return (time.perf_counter(), time.process_time(), shell.command_time)
+
+	def _add(self, times, start):
+		end = self._now()
+		for i in range(3):
+			times[i] += end[i] - start[i]
+
+	def begin(self, index, label):
+		'''called before stage ``index`` (whose source is ``label``) runs'''
+		if index not in self.stages:
+			self.stages[index] = _Stage(label)
+		self._pending = self._now()
+
+	def end(self, index, pp):
+		'''called after stage ``index`` has run, returns ``pp`` (wrapped in a probe if it's a stream)'''
+		stage = self.stages[index]
+		self._add(stage.running, self._pending)
+		if isinstance(pp, BaseList):
+			stage.lines = 0
+			pp = pp._replace(self._probe(stage, pp.src))
+		return pp
+
+	def _probe(self, stage, src):
+		times = stage.producing
+		it = iter(src)
+		while True:
+			start = self._now()
+			try:
+				item = next(it)
+			except StopIteration:
+				self._add(times, start)
+				return
+			self._add(times, start)
+			stage.lines += 1
+			yield item
+
+	def report(self, out=None):
+		'''print a summary of each stage (to stderr, by default)'''
+		shell.command_time = None
+		out = out or sys.stderr
+		total = time.perf_counter() - self.started
+		row = '%-40s %10s %10s %10s %10s %10s'
+		print(row % ('stage', 'lines in', 'lines out', 'wall (s)', 'cpu (s)', 'sh (s)'), file=out)
+		previous = None
+		for index in sorted(self.stages):
+			stage = self.stages[index]
+			times = [running + producing for running, producing in zip(stage.running, stage.producing)]
+			if previous is not None:
+				# lines from the previous stage are all pulled by this one
+				times = [max(0.0, t - upstream) for t, upstream in zip(times, previous.producing)]
+			label = stage.label if len(stage.label) <= 40 else stage.label[:37] + '...'
+			print(row % (
+				label,
+				_count(previous.lines if previous is not None else None),
+				_count(stage.lines),
+				'%.3f' % times[0], '%.3f' % times[1], '%.3f' % times[2]), file=out)
+			previous = stage
+		print(row % ('(total)', '', '', '%.3f' % total, '%.3f' % time.process_time(), ''), file=out)
+
+def _count(lines):
+	return '-' if lines is None else str(lines)
@@ -0,0 +1,298 @@
+'''
+Bulk line readers for piep's input streams.
+
+Rather than iterating a text file one ``readline`` at a time, these readers
+pull large binary blocks from the underlying file, decode each block in one
+go and split it into lines in a single pass.
+'''
+import io
+import os
+import stat
+import codecs
+import weakref
+from functools import partial
+from piep.line import Line
+
+DEFAULT_BUFSIZE = 1024 * 1024
+
+# the (file, sep, bufsize) read by each iterator returned from read_lines / map_lines (see `reversed_lines` and `line_batches`)
+_sources = weakref.WeakKeyDictionary()
+
+# lines are never None, so we can skip the (python-level) Line.__new__
+_make_line = partial(str.__new__, Line)
+
+def read_lines(f, sep='\n', bufsize=DEFAULT_BUFSIZE):
+	'''
+	Yield each line of ``f`` as a :class:`piep.Line` (without its trailing separator).
+
+	``f`` may be a text file (in which case its underlying binary buffer is read
+	directly), a binary file, or any other iterable of strings (which is just
+	iterated line-by-line).
+
+	>>> import io
+	>>> list(read_lines(io.BytesIO(b'a\\nb\\r\\n\\nc')))
+	['a', 'b', '', 'c']
+	>>> list(read_lines(io.BytesIO(b'a\\0b\\0'), sep='\\0'))
+	['a', 'b']
+	>>> list(read_lines(io.BytesIO('\\u00e9\\n\\u00e9\\n'.encode('utf-8')), bufsize=3))
+	['\\xe9', '\\xe9']
+	>>> list(read_lines(['a\\n', 'b']))
+	['a', 'b']
+	'''
+	lines = _read_lines(f, sep, bufsize)
+	_sources[lines] = (f, sep, bufsize)
+	return lines
+
+def _read_lines(f, sep, bufsize):
+	# note: this generator holds a reference to `f` so that a text
+	# wrapper doesn't get collected (and close its buffer) while reading
+	binary, encoding, errors = _binary_source(f)
+	if binary is None or not _ascii_compatible(encoding):
+		yield from _iter_lines(f, sep)
+	else:
+		yield from _read_chunks(binary, sep, bufsize, encoding, errors)
+
+def map_lines(f, sep='\n', bufsize=DEFAULT_BUFSIZE):
+	'''
+	Like :func:`read_lines`, but memory-maps ``f`` instead of reading it.
+
+	Line boundaries are found directly in the mapped file, and each window of
+	``bufsize`` bytes is only decoded once the consumer gets to it. If ``f``
+	is not a regular file (e.g. a pipe or terminal), this falls back to
+	:func:`read_lines`.
+	'''
+	lines = _map_lines(f, sep, bufsize)
+	_sources[lines] = (f, sep, bufsize)
+	return lines
+
+def _map_lines(f, sep, bufsize):
+	binary, encoding, errors = _binary_source(f)
+	mapped = None
+	if binary is not None and _ascii_compatible(encoding):
+		mapped = _mmap(binary)
+	if mapped is None:
+		yield from read_lines(f, sep=sep, bufsize=bufsize)
+		return
+
+	try:
+		yield from _split_mapped(mapped, binary.tell(), sep, bufsize, encoding, errors)
+	finally:
+		mapped.close()
+
+def reversed_lines(lines):
+	'''
+	If ``lines`` is an iterator returned by :func:`read_lines` (or :func:`map_lines`) which
+	hasn't been started, and its file is a regular file, returns an iterator over the same lines
+	in reverse order, reading the file backwards from the end (like ``tac``). Otherwise returns ``None``.
+
+	>>> import tempfile
+	>>> with tempfile.TemporaryFile() as f:
+	...     _ = f.write(b'a\\nb\\r\\n\\nc\\n')
+	...     _ = f.seek(0)
+	...     list(reversed_lines(read_lines(f, bufsize=2)))
+	['c', '', 'b', 'a']
+	>>> reversed_lines(iter(['a'])) is None
+	True
+	'''
+	source = _unstarted_source(lines)
+	if source is None:
+		return None
+	f, sep, bufsize = source
+	binary, encoding, errors = _binary_source(f)
+	if binary is None or not _ascii_compatible(encoding) or not _is_regular_file(binary):
+		return None
+	lines.close()
+	return _read_chunks_reversed(f, binary, sep, bufsize, encoding, errors)
+
+def line_batches(lines):
+	'''
+	If ``lines`` is an iterator returned by :func:`read_lines` (or :func:`map_lines`) which
+	hasn't been started, returns an iterator over lists of its lines (as plain strings, one
+	list per block read from the file), for consumers which process lines in bulk.
+	Otherwise returns ``None``.
+
+	>>> import io
+	>>> list(line_batches(read_lines(io.BytesIO(b'a\\nb\\nc\\n'), bufsize=4)))
+	[['a', 'b'], ['c']]
+	>>> line_batches(iter(['a'])) is None
+	True
+	'''
+	source = _unstarted_source(lines)
+	if source is None:
+		return None
+	f, sep, bufsize = source
+	binary, encoding, errors = _binary_source(f)
+	if binary is None or not _ascii_compatible(encoding):
+		return None
+	lines.close()
+	return _read_blocks(binary, sep, bufsize, encoding, errors)
+
+def _unstarted_source(lines):
+	'''the (file, sep, bufsize) read by `lines`, if it's one of our iterators and hasn't been started'''
+	try:
+		source = _sources.get(lines)
+	except TypeError: # not weak-referenceable, so it's certainly not one of ours
+		return None
+	if source is None:
+		return None
+	import inspect
+	if inspect.getgeneratorstate(lines) != inspect.GEN_CREATED:
+		return None
+	return source
+
+def _is_regular_file(f):
+	try:
+		return f.seekable() and stat.S_ISREG(os.fstat(f.fileno()).st_mode)
+	except (AttributeError, OSError, ValueError, io.UnsupportedOperation):
+		return False
+
+def _read_chunks_reversed(f, binary, sep, bufsize, encoding, errors):
+	# (like `_read_lines`, this holds a reference to `f` while reading)
+	bsep = sep.encode('ascii')
+	strip_cr = sep == '\n'
+	start = binary.tell()
+	pos = binary.seek(0, os.SEEK_END)
+	head = b'' # the start of a line which began in an earlier block
+	last_block = True
+	while pos > start:
+		size = min(bufsize, pos - start)
+		pos -= size
+		binary.seek(pos)
+		block = binary.read(size) + head
+		if last_block:
+			last_block = False
+			# (a trailing separator doesn't start another line)
+			if block.endswith(bsep):
+				block = block[:-1]
+		if pos > start:
+			boundary = block.find(bsep)
+			if boundary == -1:
+				head = block
+				continue
+			head = block[:boundary]
+			block = block[boundary+1:]
+		else:
+			head = b''
+		text = block.decode(encoding, errors)
+		lines = text.split(sep)
+		if strip_cr and '\r' in text:
+			lines = [line.rstrip('\r') for line in lines]
+		lines.reverse()
+		yield from map(_make_line, lines)
+
+def _mmap(f):
+	'''returns a read-only mapping of ``f``, or None if it can't be mapped'''
+	import mmap
+	try:
+		fd = f.fileno()
+		st = os.fstat(fd)
+	except (AttributeError, OSError, io.UnsupportedOperation):
+		return None
+	if not stat.S_ISREG(st.st_mode) or st.st_size == 0:
+		return None
+	try:
+		mapped = mmap.mmap(fd, 0, access=mmap.ACCESS_READ)
+	except (OSError, ValueError):
+		return None
+	if hasattr(mapped, 'madvise') and hasattr(mmap, 'MADV_SEQUENTIAL'):
+		mapped.madvise(mmap.MADV_SEQUENTIAL)
+	return mapped
+
+def _split_mapped(mapped, start, sep, bufsize, encoding, errors):
+	bsep = sep.encode('ascii')
+	strip_cr = sep == '\n'
+	size = len(mapped)
+	# (a trailing separator doesn't start another line)
+	trailing = size > start and mapped[size-1:size] == bsep
+	if trailing:
+		size -= 1
+	view = memoryview(mapped)
+	try:
+		while start < size:
+			end = start + bufsize
+			if end >= size:
+				end = size
+			else:
+				# end each window on a separator (extending past `bufsize` if we must)
+				boundary = mapped.rfind(bsep, start, end)
+				if boundary == -1:
+					boundary = mapped.find(bsep, end)
+				end = size if boundary == -1 else boundary
+			with view[start:end] as window:
+				text = str(window, encoding, errors)
+			start = end + 1
+			lines = text.split(sep)
+			if strip_cr and '\r' in text:
+				lines = [line.rstrip('\r') for line in lines]
+			yield from map(_make_line, lines)
+		if trailing and start == size:
+			# the last window ended on the separator before the trailing one (or there was only a separator)
+			yield Line('')
+	finally:
+		view.release()
+
+def _binary_source(f):
+	'''returns (binary_file, encoding, errors), or (None, None, None) if ``f`` is not a file'''
+	if isinstance(f, io.TextIOBase):
+		buffer = getattr(f, 'buffer', None)
+		if buffer is not None:
+			return buffer, f.encoding, f.errors
+	elif isinstance(f, (io.BufferedIOBase, io.RawIOBase)):
+		import locale
+		return f, locale.getpreferredencoding(False), 'strict'
+	return None, None, None
+
+def _ascii_compatible(encoding):
+	# the block splitter searches for separators in the raw bytes,
+	# which is only valid for encodings where they are single ascii bytes
+	try:
+		return codecs.lookup(encoding).encode('\n\r\0')[0] == b'\n\r\0'
+	except LookupError:
+		return False
+
+def _iter_lines(f, sep):
+	if sep == '\n':
+		for line in f:
+			yield Line(line.rstrip('\n\r'))
+	else:
+		tail = ''
+		for chunk in f:
+			parts = (tail + chunk).split(sep)
+			tail = parts.pop()
+			for part in parts:
+				yield Line(part)
+		if tail:
+			yield Line(tail)
+
+def _read_chunks(f, sep, bufsize, encoding, errors):
+	for lines in _read_blocks(f, sep, bufsize, encoding, errors):
+		yield from map(_make_line, lines)
+
+def _read_blocks(f, sep, bufsize, encoding, errors):
+	'''yields a list of lines (as plain strings) for each block read from `f`'''
+	read = getattr(f, 'read1', f.read)
+	bsep = sep.encode('ascii')
+	strip_cr = sep == '\n'
+	tail = b''
+	pending = [] # blocks containing no separator at all
+	while True:
+		block = read(bufsize)
+		if not block:
+			break
+		end = block.rfind(bsep)
+		if end == -1:
+			pending.append(block)
+			continue
+		if pending:
+			tail = b''.join([tail] + pending)
+			pending = []
+		text = (tail + block[:end]).decode(encoding, errors)
+		tail = block[end+1:]
+		lines = text.split(sep)
+		if strip_cr and '\r' in text:
+			lines = [line.rstrip('\r') for line in lines]
+		yield lines
+	tail = b''.join([tail] + pending)
+	if tail:
+		text = tail.decode(encoding, errors)
+		yield [text.rstrip('\r') if strip_cr else text]
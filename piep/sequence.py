@@ -1,4 +1,5 @@
 from itertools import *
+from collections import deque
 from piep import shell
 import operator
 from piep.line import Line
@@ -39,20 +40,42 @@ class BaseList(object):
 			return result
 		return self._replace(filter(lambda x: x is not None, map(_transform, self.src)))
 
-	def uniq(self, stable=False):
-		'''Remove duplicates. Note: if ``stable`` is not given (or is ``False``),
-		the order of the return value will be in an arbitrary order.
-		If ``stable`` is ``True``, the order will be maintained and only the
-		first occurance of a duplicate line will be kept. This is not the default
-		because it's much slower. For sorted unique output, try ``sort(uniq=True)``'''
-		items = self
-		if stable:
-			# element order preserved
-			seen = {}
-			items = [ seen.setdefault(x,x) for x in items if x not in seen ]
-		else:
-			items = set(items)
-		return List(items)
+	def uniq(self, stable=False, digest=None):
+		'''Remove duplicates. This is lazy: the first occurrence of each item
+		is yielded as soon as it is seen, so the output is always in the original order
+		(``stable`` is accepted for backwards compatibility, but no longer has any effect).
+		For sorted unique output, try ``sort(uniq=True)``.
+
+		Every distinct item is remembered, which can take a lot of memory for
+		inputs with many long, distinct lines. If ``digest`` is given (``64`` or ``128``),
+		only a hash of that many bits is remembered for each item instead. This has a
+		small chance of wrongly dropping an item whose hash collides with an earlier one:
+		roughly ``n**2 / 2**(digest+1)`` for ``n`` distinct items, i.e. around 1 in 4000 for
+		100 million items with a 64-bit digest, and negligible with a 128-bit digest.
+		Digests can only be used for strings (like input lines) and bytes, since there's no
+		general way to hash other values so that equal values always have the same digest.
+
+		>>> list(Stream(['b', 'a', 'b', 'c', 'a']).uniq())
+		['b', 'a', 'c']
+		>>> list(Stream(['b', 'a', 'b', 'c', 'a']).uniq(digest=64))
+		['b', 'a', 'c']
+		'''
+		def it(src):
+			seen = set()
+			remember = seen.add
+			if digest is None:
+				for item in src:
+					if item not in seen:
+						remember(item)
+						yield item
+			else:
+				hash = _digester(digest)
+				for item in src:
+					key = hash(item)
+					if key not in seen:
+						remember(key)
+						yield item
+		return self._replace(it(self.src))
 
 	def zip(self, *others):
 		'''Combine this stream with another, yielding sequential pairs from each stream.
@@ -109,40 +132,219 @@ class BaseList(object):
 
 	def sort(self, uniq=False):
 		'''
-		Return a sorted version of this stream (note: reads entire stream into memory).
+		Return a sorted version of this stream.
 		Alias for ``sorted(self)``.
 
 		When ``uniq``=``True``, duplicates are removed from the result.
+
+		This reads the entire stream before producing any output. If it doesn't fit within
+		``--memory-limit``, sorted runs are spilled to temporary files and merged back lazily.
 		'''
-		items = set(self) if uniq else self
-		return self._replace(sorted(items))
+		from piep import external
+		return self._replace(external.sort(self, uniq=uniq))
 
 	def sortby(self, fn=None, key=None, attr=None, method=None):
 		'''
-		Return a sorted version of this stream (note: reads entire stream into memory).
+		Return a sorted version of this stream (like :data:`sort`, this respects ``--memory-limit``).
 		One (and only one) of the argument types should be provided as the sort key:
 		
 		- ``fn`` will sort using the return value of calling ``fn`` with each item: ``fn(item)``
-		- ``key`` will sort using the given key of each element: ``item[key]``
+		- ``key`` will sort using the given key of each element: ``item[key]`` (or, if ``key`` is a function, ``key(item)``)
 		- ``attr`` will sort using the given attribute of each element: ``item.attr``
 		- ``method`` will sort using the result of calling the given method (with no arguments) on each element: ``item.method()``
 		'''
-		defined_items = list(filter(lambda x: x is not None, (fn, key, attr, method)))
-		assert len(defined_items) == 1, "exactly one of (fn, key, attr, method) arguments allowed to `sortby` method (you gave %s: %r)" % (len(defined_items), defined_items)
+		from piep import external
+		fn = _key_function('sortby', fn, key, attr, method)
+		return self._replace(external.sort(self, key=fn))
+
+	def top(self, k, fn=None, key=None, attr=None, method=None):
+		'''
+		Return the ``k`` largest items, largest first. This only holds ``k`` items in memory at once,
+		so ``pp.top(10, ...)`` is much cheaper than sorting the entire stream and slicing it
+		(unless ``k`` items don't fit within ``--memory-limit``, in which case it falls back to :data:`sortby`).
+		The item comparison may be given in the same ways as for :data:`sortby` (if none
+		is given, items are compared directly).
+
+		>>> list(Stream([3, 1, 4, 1, 5, 9, 2, 6]).top(3))
+		[9, 6, 5]
+		>>> list(Stream(['aaa', 'b', 'cc']).top(2, fn=len))
+		['aaa', 'cc']
+		'''
+		from piep import external
+		fn = _key_function('top', fn, key, attr, method, required=False)
+		return self._replace(external.smallest(k, self.src, key=fn, largest=True))
+
+	def bottom(self, k, fn=None, key=None, attr=None, method=None):
+		'''
+		Return the ``k`` smallest items, smallest first (the same as ``sortby(...)[:k]``, but only
+		holding ``k`` items in memory). See :data:`top`.
+
+		>>> list(Stream([3, 1, 4, 1, 5, 9, 2, 6]).bottom(3))
+		[1, 1, 2]
+		>>> list(Stream(['aaa', 'b', 'cc']).bottom(2, method='upper'))
+		['aaa', 'b']
+		'''
+		from piep import external
+		fn = _key_function('bottom', fn, key, attr, method, required=False)
+		return self._replace(external.smallest(k, self.src, key=fn))
+
+	def join_on(self, other, key=None, other_key=None, how='inner'):
+		'''
+		Join this stream with ``other`` (e.g. a lookup table from ``--file``) on matching keys,
+		yielding ``(item, other_item)`` for each pair of items whose keys are equal. When ``how`` is ``'left'``,
+		items with no match in ``other`` are also included, as ``(item, None)``.
+
+		``key`` gives the key of each item: a function of the item, or an index (or dict key) to look up in it.
+		If not given, items are joined on their entire value. ``other_key`` does the same for ``other``'s
+		items (and defaults to ``key``).
+
+		``other`` is read into a hash table, then this stream is read lazily, so results are
+		in this stream's order. If ``other`` doesn't fit within ``--memory-limit``, both sides
+		are partitioned into temporary files by key instead, and joined one partition at a time
+		(in which case, results are in no particular order).
+
+		>>> users = ['1 alice', '2 bob']
+		>>> list(Stream(['1 login', '3 login', '1 logout']).join_on(users, key=lambda l: l.split()[0]))
+		[('1 login', '1 alice'), ('1 logout', '1 alice')]
+		>>> list(Stream([('x', 1), ('y', 2)]).join_on([('x', 'X')], key=0, how='left'))
+		[(('x', 1), ('x', 'X')), (('y', 2), None)]
+		'''
+		from piep import external
+		key = _key_function('join_on', key=key, required=False)
+		other_key = key if other_key is None else _key_function('join_on', key=other_key)
+		return self._replace(external.join(self.src, other, key, other_key, how=how))
+
+	def groupby(self, fn=None, key=None, attr=None, method=None):
+		'''
+		Group items by a key, given in the same ways as for :data:`sortby` (if none is given,
+		items are grouped by their own value). Unlike :data:`divide`, the input doesn't need to be sorted.
+
+		Returns a :class:`GroupBy`, whose ``agg()`` method computes aggregates for each group:
+
+		>>> list(Stream(['a 1', 'b 2', 'a 3']).groupby(lambda l: l[0]).agg(count=True, sum=lambda l: int(l[2])))
+		[('a', 2, 4), ('b', 1, 2)]
+		'''
+		return GroupBy(self.src, _key_function('groupby', fn, key, attr, method, required=False))
+
+	def counts(self, fn=None, key=None, attr=None, method=None, top=None):
+		'''
+		Count the occurrences of each item (or of each key, given in the same ways as for :data:`sortby`),
+		in a single pass. Returns ``(item, count)`` pairs, most common first. If ``top`` is given,
+		only that many are returned.
+
+		Like ``sort | uniq -c``, but without sorting (or holding) the input. This respects ``--memory-limit``,
+		beyond which counts are spilled to temporary files (see :data:`GroupBy.agg`).
+
+		>>> list(Stream(['b', 'a', 'b', 'c', 'b', 'a']).counts())
+		[('b', 3), ('a', 2), ('c', 1)]
+		>>> list(Stream(['x 1', 'y 2', 'x 3']).counts(lambda l: l.split()[0], top=1))
+		[('x', 2)]
+		'''
+		from piep import external
+		fn = _key_function('counts', fn, key, attr, method, required=False)
+		return _aggregate_result(external.count(self.src, key=fn, top=top))
 
-		if key is not None: fn = operator.itemgetter(key)
-		if attr is not None: fn = operator.attrgetter(attr)
-		if method is not None: fn = operator.methodcaller(method)
-		return self._replace(sorted(self, key=fn))
+	def columns(self, sep=None, types=None, names=None, header=False):
+		'''
+		Parse delimited lines into :class:`piep.columns.Columns`, for fast numeric aggregation.
+		Lines are split on ``sep`` (default: whitespace), and converted in large batches into
+		typed arrays, which support vectorised ``sum``, ``mean``, ``min``, ``max``, ``histogram`` and ``filter``.
+		This reads the entire stream, but holds only the selected columns (not the lines) in memory.
+		Blank lines are skipped.
+
+		``types`` gives the type of each column (``float``, ``int``, ``str`` or any other conversion function),
+		either as a list (where ``None`` skips that column), or as a dict of ``{column: type}``
+		selecting just those columns. By default, every column is a ``float``. Columns are identified
+		by their field index (from 0) or, if ``header`` is set (or ``names`` are given), by name.
+
+		>>> cols = Stream(['a 10 1.5', 'b 20 2.5', 'c 30 3.5']).columns(types={1: int, 2: float})
+		>>> cols.sum(1), cols.mean(2)
+		(60, 2.5)
+		>>> cols.filter(1, ge=20).max(2)
+		3.5
+		'''
+		from piep import columns
+		return columns.parse(self.src, sep=sep, types=types, names=names, header=header)
 
 	def reverse(self):
 		'''
-		Return a reversed version of this stream (note: reads entire stream into memory)
-		Alias for ``reversed(self)``
+		Return a reversed version of this stream. Alias for ``reversed(self)``
+
+		Note: this reads the entire stream into memory, unless it's the (unmodified)
+		input from a regular file, which is instead read backwards from the end.
 		'''
 		return self._replace(reversed(self))
 
 
+class GroupBy(object):
+	'''
+	Items grouped by a key (see :data:`BaseList.groupby`).
+	'''
+	def __init__(self, src, key):
+		self._src = src
+		self._key = key
+
+	def agg(self, **aggregates):
+		'''
+		Compute aggregates for each group in a single pass, without sorting. Each group holds
+		only the state of its aggregates (e.g. a running sum), not its items.
+
+		Each keyword names an aggregate (``count``, ``sum``, ``mean``, ``min``, ``max``, ``first``
+		or ``last``), and its value gives what to aggregate: ``True`` for the items themselves,
+		or a function of each item (or a list of functions, to aggregate several values in the same way).
+		For ``count``, the value is only used to count the items.
+
+		Returns a :class:`List` of rows: the group's key (or its elements, if it's a tuple) followed by each
+		aggregate, in the order given. Groups are in the order their first item was seen.
+
+		If the groups don't fit within ``--memory-limit``, their state is spilled to temporary files
+		(partitioned by the hash of each key), which are aggregated one at a time. In that case, the
+		result is a :class:`Stream` instead, and the rows are in no particular order.
+
+		>>> groups = Stream(['a 1', 'b 5', 'a 3']).groupby(lambda l: l.split()[0])
+		>>> list(groups.agg(max=lambda l: int(l.split()[1]), first=True))
+		[('a', 3, 'a 1'), ('b', 5, 'b 5')]
+		'''
+		from piep import external
+		return _aggregate_result(external.aggregate(self._src, self._key, list(aggregates.items())))
+
+def _aggregate_result(rows):
+	# (results which were spilled to disk are produced lazily)
+	if isinstance(rows, list):
+		return List(rows)
+	return Stream(rows)
+
+def _key_function(method_name, fn=None, key=None, attr=None, method=None, required=True):
+	'''
+	Turn exactly one of the (fn, key, attr, method) arguments accepted by
+	e.g. :data:`BaseList.sortby` into a key function. Like :data:`BaseList.join_on`'s
+	``key``, a ``key`` which is already a function is used as-is.
+	If not ``required``, no arguments at all is also acceptable (and returns ``None``).
+	'''
+	defined_items = list(filter(lambda x: x is not None, (fn, key, attr, method)))
+	if not (defined_items or required):
+		return None
+	assert len(defined_items) == 1, "exactly one of (fn, key, attr, method) arguments allowed to `%s` method (you gave %s: %r)" % (method_name, len(defined_items), defined_items)
+
+	if key is not None: fn = key if callable(key) else operator.itemgetter(key)
+	if attr is not None: fn = operator.attrgetter(attr)
+	if method is not None: fn = operator.methodcaller(method)
+	return fn
+
+def _digester(bits):
+	'''returns a function producing a `bits`-sized digest of a string (or bytes) item'''
+	assert bits in (64, 128), "digest must be 64 or 128 (bits), not %r" % (bits,)
+	from hashlib import blake2b
+	size = bits // 8
+	def hash(item):
+		# (the type is part of the hash, so that e.g. 'a' and b'a' are distinct)
+		if isinstance(item, str):
+			return blake2b(item.encode('utf-8', 'surrogatepass'), digest_size=size, person=b'str').digest()
+		if isinstance(item, bytes):
+			return blake2b(item, digest_size=size, person=b'bytes').digest()
+		raise TypeError("uniq(digest=...) only supports str and bytes items, not %s" % (type(item).__name__,))
+	return hash
+
 class List(list, BaseList):
 	def __init__(self, *a, **k):
 		super(List, self).__init__(*a,**k)
@@ -241,12 +443,23 @@ class Stream(BaseList):
 		[1, 2]
 		>>> list(Stream([1])[:2])
 		[1]
+		>>> Stream([1,2])[-3]
+		Traceback (most recent call last):
+		...
+		IndexError: -3
 		"""
 		if isinstance(n, slice):
 			return self._slice(n.start, n.stop, n.step)
 		try:
 			if n < 0:
-				return pad_end(abs(n), self.src).end[0]
+				backwards = self._backwards()
+				if backwards is not None:
+					drop(-n - 1, backwards)
+					return next(backwards)
+				end = pad_end(-n, self.src).end
+				if len(end) < -n:
+					raise StopIteration()
+				return end[0]
 			elif n > 0:
 				drop(n, self.src)
 			return next(self.src)
@@ -256,6 +469,14 @@ class Stream(BaseList):
 	def _replace(self, src):
 		self.src = iter(src)
 		return self
+
+	def _backwards(self):
+		'''
+		If this stream is the unmodified input from a regular file, returns its lines
+		in reverse order, read backwards from the end of the file (otherwise, returns None).
+		'''
+		from piep.reader import reversed_lines
+		return reversed_lines(self.src)
 	
 	# unfortunately, list(item) will call __len__
 	# and therefore drain the iter if it's defined
@@ -287,15 +508,23 @@ class Stream(BaseList):
 				self._replace(pad_end(abs(stop), self.src))
 
 		else: # start < 0
-			if negative_stop:
+			backwards = self._backwards() if (stop is None or negative_stop) else None
+			if negative_stop and start >= stop:
+				self._replace([])
+
+			elif backwards is not None:
+				# e.g. lst[-5:-2] or lst[-5:], reading backwards from the end of the file
+				skip = -stop if negative_stop else 0
+				lines = take(stop - start if negative_stop else -start, drop(skip, backwards, True), True)
+				lines.reverse()
+				self._replace(lines)
+
+			elif negative_stop:
 				# e.g lst[-5:-2]
 				# get the padded end
 				padded = pad_end(abs(stop), self.src)
-				if start >= stop:
-					self._replace([])
-				else:
-					start -= stop
-					self._replace(pad_end(abs(start), padded).end)
+				start -= stop
+				self._replace(pad_end(abs(start), padded).end)
 
 			elif stop is None:
 				self._replace(pad_end(abs(start), self.src).end)
@@ -318,6 +547,9 @@ class Stream(BaseList):
 		return self
 	
 	def __reversed__(self):
+		backwards = self._backwards()
+		if backwards is not None:
+			return self._replace(backwards)
 		rev = reversed(list(self.src))
 		self._replace(rev)
 		return List(rev)
@@ -377,45 +609,25 @@ class pad_end(object):
 	[6, 7, 8, 9]
 	"""
 	def __init__(self, n, it):
-		self._n = n
+		assert n > 0
 		self._it = it
-		self._fill_cache()
+		self._cache = deque(islice(it, n), maxlen=n)
 	
 	def __iter__(self):
 		return self
 
-	def _fill_cache(self):
-		"""fills cache with up to `self._n` items"""
-		self._cache = []
-		self._cache_head = 0
-
-		assert self._n > 0
-		n = 0
-		try:
-			while n < self._n:
-				self._cache.append(next(self._it))
-				n += 1
-		except StopIteration: pass
-
-	def _rotate(self, item):
-		"""add the given item to the end of the cache, pushing off (and returning) the current head"""
-		try:
-			old_item = self._cache[self._cache_head]
-		except IndexError as e:
-			print("Key Error %s" % (e,))
-			print("cache = %r" % (self._cache))
-			print("cache head = %r" % (self._cache_head))
-			raise
-		self._cache[self._cache_head] = item
-		self._cache_head = (self._cache_head + 1) % self._n
-		return old_item
 	@property
 	def end(self):
-		exhaust(self)
-		return self._cache[self._cache_head:] + self._cache[:self._cache_head]
+		# (the deque drops items from the front as the rest are added)
+		self._cache.extend(self._it)
+		return list(self._cache)
 
 	def __next__(self):
-		return self._rotate(next(self._it))
+		item = next(self._it)
+		# (only reached once the cache is full)
+		head = self._cache[0]
+		self._cache.append(item)
+		return head
 	next = __next__ # for python2
 
 
@@ -1,43 +1,217 @@
 from __future__ import print_function
-import subprocess
 from piep.error import Exit
 from piep.line import Line
 
+# commands started since the last check (see `check_for_failed_commands`)
 active_commands = []
+
+# a `piep.memo.ResultCache`, when command results are cached (`--sh-cache`)
+result_cache = None
+
+# how much of a streamed command's remaining output is read (and discarded) when we stop
+# reading it early, so that a command which is about to exit isn't killed by SIGPIPE
+DRAIN_BYTES = 1 << 20
+
+# total seconds spent waiting for commands (only tracked when profiling, see `piep.profiler`)
+command_time = None
+
+def _timed(fn, *args):
+	global command_time
+	if command_time is None:
+		return fn(*args)
+	import time
+	start = time.perf_counter()
+	try:
+		return fn(*args)
+	finally:
+		command_time += time.perf_counter() - start
+
+# when commands are run from multiple threads, each thread
+# tracks its own commands (see `track_commands_per_thread`)
+_thread_state = None
+
+def _commands():
+	state = _thread_state
+	if state is not None:
+		commands = getattr(state, 'commands', None)
+		if commands is not None:
+			return commands
+	return active_commands
+
+def track_commands_per_thread():
+	'''
+	Returns a function which runs ``fn(*args)`` with its own set of active commands,
+	so that ``check_for_failed_commands`` in one thread only waits for commands
+	started by that thread.
+	'''
+	global _thread_state
+	if _thread_state is None:
+		import threading
+		_thread_state = threading.local()
+	state = _thread_state
+
+	def run(fn, *args):
+		state.commands = []
+		try:
+			result = fn(*args)
+			check_for_failed_commands()
+			finish_streamed_commands()
+			return result
+		finally:
+			state.commands = None
+	return run
+
 class Command(object):
-	def __init__(self, cmd, check=None, **kw):
+	def __init__(self, cmd, check=None, input=None, cache=True, **kw):
+		import subprocess
 		self.cmd = cmd
 
 		self.raise_on_error = check
+		self.input = input
+		self.cache = cache
 		defaults = dict(stdout = subprocess.PIPE)
+		if input is not None:
+			if 'stdin' in kw:
+				raise ValueError("stdin and input arguments may not both be used")
+			defaults['stdin'] = subprocess.PIPE
 		defaults.update(kw)
 		self.kwargs = defaults
 
-		active_commands.append(self)
+		_commands().append(self)
 		self.checked = False
+		self.streaming = False
+		self.stream_closed = False
 		self.proc = None
 		self.stdout = None
 		self.stderr = None
+		self._feeder = None
+		self._feed_errors = []
 	
 	def _spawn(self):
+		import subprocess
 		if self.proc is None:
 			try:
 				self.proc = subprocess.Popen(self.cmd, **self.kwargs)
 			except OSError as e:
 				raise Exit("error executing %r: %s" % (list(self.cmd), e))
+			if self.input is not None:
+				self._start_feeding()
+
+	def _start_feeding(self):
+		'''write ``input`` to the command's stdin from a separate thread'''
+		import threading
+		# the feeder thread owns stdin (so that `communicate()` leaves it alone)
+		pipe, self.proc.stdin = self.proc.stdin, None
+		self._feeder = threading.Thread(target=self._feed, args=(pipe,), name='piep-sh-input')
+		self._feeder.daemon = True
+		self._feeder.start()
+
+	def _feed(self, pipe):
+		import io
+		from piep.writer import format_lines, write_lines
+		out = io.TextIOWrapper(pipe, encoding='utf-8')
+		try:
+			if isinstance(self.input, str):
+				out.write(self.input)
+			else:
+				write_lines(format_lines(self.input, ' '), out=out)
+		except BrokenPipeError:
+			pass # the command stopped reading (like `head`)
+		except BaseException as e:
+			self._feed_errors.append(e)
+		finally:
+			try:
+				out.close()
+			except BrokenPipeError:
+				pass
 	
 	def wait(self, raise_on_error=True):
-		self._spawn()
 		self.checked = True
-		(self.stdout, self.stderr) = self.proc.communicate()
+		key = self._cache_key()
+		cached = None if key is None else result_cache.get(key)
+		if cached is not None:
+			(status, self.stdout) = cached
+		else:
+			self._spawn()
+			(self.stdout, self.stderr) = _timed(self.proc.communicate)
+			status = self.proc.returncode
+			if key is not None:
+				result_cache.put(key, status, self.stdout)
+		self._finish(raise_on_error, status)
+
+	def _cache_key(self):
+		if result_cache is None or not self.cache or self.proc is not None:
+			return None
+		return result_cache.key(self.cmd, self.kwargs if self.input is None else _without_stdin(self.kwargs), self.input)
+
+	def _finish(self, raise_on_error, status, stopped_early=False):
+		if self._feeder is not None:
+			self._feeder.join()
+			if self._feed_errors:
+				raise self._feed_errors[0]
 		self.ended = True
-		self.status = self.proc.returncode
-		self.succeeded = self.status == 0
+		self.status = status
+		# (a command whose output we stopped reading is expected to get SIGPIPE)
+		self.succeeded = self.status == 0 or (stopped_early and _killed_by_sigpipe(self.status))
 		explicitly_suppressed = self.raise_on_error is False
 		if self.raise_on_error or (raise_on_error and not explicitly_suppressed):
 			if not self.succeeded:
+				import subprocess
 				raise subprocess.CalledProcessError(self.status, ' '.join(self.cmd))
 	
+	def __iter__(self):
+		'''
+		Iterate over the command's output as :class:`piep.Line` objects. Unless the command has
+		already finished, lines are read as the command produces them (rather than buffering
+		its entire output), and the command is checked for failure once its output is exhausted
+		(or, if only part of it is read, at the next check for failed commands).
+		'''
+		import subprocess
+		# (when stderr is also piped, reading only stdout could deadlock,
+		# and results which might be cached need to be read in full)
+		if self.checked or self.kwargs.get('stderr') is subprocess.PIPE or self._cache_key() is not None:
+			return iter(Line(self.__str__()).splitlines())
+		self._spawn()
+		self.streaming = True
+		# (it may have already been dropped from the active commands, if it was a stage's result)
+		_commands().append(self)
+		return self._stream()
+
+	def _stream(self):
+		import io
+		from piep.reader import read_lines
+		stdout = self.proc.stdout
+		# (kept until the stream is closed, since the wrapper closes `stdout` when it's collected)
+		text = None if stdout is None else io.TextIOWrapper(stdout, encoding='utf-8')
+		try:
+			if text is not None:
+				yield from read_lines(text)
+		finally:
+			self._close_stream()
+		self.checked = True
+		self._finish(True, self.proc.returncode)
+
+	def _close_stream(self):
+		'''stop reading the command's output (once up to `DRAIN_BYTES` more has been discarded), and wait for it to exit'''
+		stdout = self.proc.stdout
+		if stdout is not None:
+			remaining = DRAIN_BYTES
+			while remaining > 0:
+				chunk = _timed(stdout.read1, remaining)
+				if not chunk:
+					break
+				remaining -= len(chunk)
+			stdout.close()
+		_timed(self.proc.wait)
+		self.stream_closed = True
+
+	def _check_stream(self):
+		'''check a streamed command whose output wasn't read in full'''
+		if not self.stream_closed:
+			self._close_stream()
+		self.checked = True
+		self._finish(True, self.proc.returncode, stopped_early=True)
+
 	def __bool__(self):
 		self.wait(raise_on_error = False)
 		return self.succeeded
@@ -68,12 +242,223 @@ class Command(object):
 	def __getattr__(self, attr):
 		return getattr(Line(self), attr)
 	
-def check_for_failed_commands():
+def _killed_by_sigpipe(status):
+	import signal
+	# (a shell reports a command killed by a signal as 128 + the signal number)
+	return status in (-signal.SIGPIPE, 128 + signal.SIGPIPE)
+
+def _without_stdin(kwargs):
+	'''the arguments for a command, excluding the stdin pipe added for its input'''
+	return dict((k, v) for k, v in kwargs.items() if k != 'stdin')
+
+def check_for_failed_commands(result=None):
+	'''
+	Wait for every command started since the last check, raising an error for any which failed.
+	Commands whose output is being streamed (including ``result``, the current value of
+	``pp`` in file mode, which will be streamed into the next stage) are instead
+	checked once their output has been read, or once the stream is closed
+	(see :func:`finish_streamed_commands`).
+	'''
 	global active_commands
+	commands = _commands()
+	streaming = []
 	try:
-		for cmd in active_commands:
-			if not cmd.checked:
+		for cmd in commands:
+			if cmd.checked:
+				continue
+			if cmd.streaming:
+				if cmd.stream_closed:
+					cmd._check_stream()
+				else:
+					streaming.append(cmd)
+			elif cmd is not result:
 				cmd.wait()
 	finally:
-		active_commands = []
+		if commands is active_commands:
+			active_commands = streaming
+		else:
+			commands[:] = streaming
+
+def finish_streamed_commands():
+	'''
+	Stop reading the output of any commands which are still being streamed (once the
+	pipeline has finished with them), and check whether they failed. Since we may not have
+	read their entire output, a command which was killed by SIGPIPE didn't fail.
+	'''
+	global active_commands
+	commands = _commands()
+	try:
+		for cmd in commands:
+			if cmd.streaming and not cmd.checked:
+				cmd._check_stream()
+	finally:
+		if commands is active_commands:
+			active_commands = []
+		else:
+			del commands[:]
+
+def closing_streamed_commands():
+	'''a generator which finishes all streamed commands once it's iterated, without yielding anything'''
+	finish_streamed_commands()
+	yield from ()
+
+# long-running coprocesses (see `coprocess`), keyed on the arguments they were started with
+coprocesses = {}
+
+def coprocess(cmd, kwargs):
+	'''returns the running coprocess for ``cmd`` and ``kwargs``, starting it if necessary'''
+	key = repr((cmd, sorted(kwargs.items())))
+	proc = coprocesses.get(key)
+	if proc is None:
+		proc = coprocesses[key] = Coprocess(cmd, **kwargs)
+	return proc
+
+def close_coprocesses():
+	'''close every coprocess, raising the first failure (once all have exited)'''
+	error = None
+	for proc in list(coprocesses.values()):
+		try:
+			proc.close()
+		except Exception as e:
+			error = error or e
+	coprocesses.clear()
+	if error is not None:
+		raise error
+
+def closing_coprocesses():
+	'''a generator which closes all coprocesses once it's iterated, without yielding anything'''
+	close_coprocesses()
+	yield from ()
+
+class Coprocess(object):
+	'''
+	A long-running command which responds to each request (a line written to its stdin)
+	with ``lines`` lines of output or, if ``end`` is given, all lines up to (but not including)
+	a line equal to ``end``.
+	'''
+	def __init__(self, cmd, lines=1, end=None, check=None, **kw):
+		import threading
+		import subprocess
+		self.cmd = cmd
+		self.lines = lines
+		self.end = end
+		self.raise_on_error = check
+		defaults = dict(stdin=subprocess.PIPE, stdout=subprocess.PIPE, encoding='utf-8')
+		defaults.update(kw)
+		self.kwargs = defaults
+		self.proc = None
+		# (when lines are processed on multiple threads, each request & response must stay together)
+		self._lock = threading.Lock()
+
+	def _spawn(self):
+		import subprocess
+		if self.proc is None:
+			try:
+				self.proc = subprocess.Popen(self.cmd, **self.kwargs)
+			except OSError as e:
+				raise Exit("error executing %r: %s" % (list(self.cmd), e))
+		return self.proc
+
+	def __call__(self, request):
+		'''send ``request``, and return the response (as a single, possibly multi-line, string)'''
+		with self._lock:
+			proc = self._spawn()
+			try:
+				proc.stdin.write(_request(request))
+				proc.stdin.flush()
+			except BrokenPipeError:
+				self._ended()
+			return _timed(self._response, proc.stdout)
+
+	def map(self, requests):
+		'''
+		Returns a :class:`piep.Stream` of responses to each of ``requests``. Requests are written from
+		a separate thread, so the coprocess doesn't have to wait for piep between requests.
+		'''
+		from piep.sequence import Stream
+		return Stream(self._map(requests))
+
+	def _map(self, requests):
+		import queue
+		import threading
+		proc = self._spawn()
+		# one item per request sent, then None (or the exception which stopped us)
+		sent = queue.Queue()
+
+		def feed():
+			try:
+				for request in requests:
+					proc.stdin.write(_request(request))
+					proc.stdin.flush()
+					sent.put(True)
+			except BrokenPipeError:
+				pass
+			except BaseException as e:
+				sent.put(e)
+			sent.put(None)
+
+		feeder = threading.Thread(target=feed, name='piep-coproc-input')
+		feeder.daemon = True
+		feeder.start()
+		finished = False
+		try:
+			while True:
+				item = sent.get()
+				if item is None:
+					break
+				if isinstance(item, BaseException):
+					raise item
+				yield self._response(proc.stdout)
+			finished = True
+		finally:
+			if not finished:
+				# unread responses would be mistaken for the response to a later request
+				self.kill()
+
+	def _response(self, stdout):
+		if self.end is None:
+			return Line('\n'.join(self._readline(stdout) for _ in range(self.lines)))
+		lines = []
+		while True:
+			line = self._readline(stdout)
+			if line == self.end:
+				return Line('\n'.join(lines))
+			lines.append(line)
+
+	def _readline(self, stdout):
+		line = stdout.readline()
+		if not line:
+			self._ended()
+		return line.rstrip('\n\r')
+
+	def _ended(self):
+		self.close()
+		raise Exit("%s exited without responding" % (' '.join(self.cmd),))
+
+	def kill(self):
+		proc, self.proc = self.proc, None
+		if proc is not None:
+			proc.kill()
+			proc.wait()
+
+	def close(self):
+		'''close the coprocess's stdin and wait for it to exit, raising an error if it failed'''
+		proc, self.proc = self.proc, None
+		if proc is None:
+			return
+		try:
+			proc.stdin.close()
+		except BrokenPipeError:
+			pass
+		if proc.stdout is not None:
+			# (discard anything else it prints)
+			for line in proc.stdout:
+				pass
+			proc.stdout.close()
+		status = proc.wait()
+		if status != 0 and self.raise_on_error is not False:
+			import subprocess
+			raise subprocess.CalledProcessError(status, ' '.join(self.cmd))
 
+def _request(request):
+	return '%s\n' % (request,)
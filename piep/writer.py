@@ -0,0 +1,150 @@
+'''
+Batched output for piep's results.
+
+Rather than calling ``print()`` once per result, lines are collected into
+batches, joined and encoded in one go and written with a single call
+to the underlying binary stream. Pipelines which write to stdout themselves
+(e.g. with ``print()``) are written one line at a time instead, so that
+their output stays in order.
+'''
+import sys
+from itertools import islice
+
+BATCH_LINES = 1024
+
+def format_lines(lines, join):
+	'''
+	Convert pipeline results into output lines: ``None`` results are skipped,
+	and tuples / lists are joined with ``join``.
+
+	>>> list(format_lines(['a', None, ('b', 'c'), [1, 2]], '-'))
+	['a', 'b-c', '1-2']
+	'''
+	for line in lines:
+		if line is None:
+			continue
+		if isinstance(line, (tuple, list)):
+			try:
+				# fast path: all elements are already strings
+				line = join.join(line)
+			except TypeError:
+				line = join.join(map(str, line))
+		yield line
+
+def _join(sep, batch):
+	try:
+		return sep.join(batch)
+	except TypeError:
+		return sep.join(map(str, batch))
+
+def write_lines(lines, out=None, sep='\n', batch_lines=BATCH_LINES, threaded=False, interleaved=False):
+	'''
+	Write each of ``lines`` to ``out`` (default ``sys.stdout``), in batches of ``batch_lines``.
+
+	When ``sep`` is a newline, it terminates every line. Otherwise (e.g. for
+	``\\0``) it is only written between lines. Interactive outputs are written
+	one line at a time.
+
+	If ``threaded`` is true, writes happen on a separate thread so that
+	formatting and I/O can overlap. If ``interleaved`` is true (because producing
+	``lines`` may also write to ``out``), each line is written through ``out``'s
+	text layer as soon as it's produced instead.
+	'''
+	if out is None:
+		out = sys.stdout
+	if interleaved:
+		batch_lines = 1
+		threaded = False
+	elif _isatty(out):
+		batch_lines = 1
+
+	write, close = _output(out, threaded, interleaved)
+	terminate = sep == '\n'
+	lines = iter(lines)
+	first = True
+	try:
+		while True:
+			batch = list(islice(lines, batch_lines))
+			if not batch:
+				break
+			text = _join(sep, batch)
+			if terminate:
+				text += sep
+			elif first:
+				first = False
+			else:
+				text = sep + text
+			write(text)
+	finally:
+		close()
+
+def _isatty(out):
+	try:
+		return out.isatty()
+	except (AttributeError, ValueError):
+		return False
+
+def _output(out, threaded, interleaved=False):
+	'''returns (write, close) functions for `out`'''
+	buffer = None if interleaved else getattr(out, 'buffer', None)
+	if buffer is None:
+		write = out.write
+		flush = getattr(out, 'flush', lambda: None)
+	else:
+		encoding, errors = out.encoding, out.errors
+		write_bytes = buffer.write
+		flush_text = out.flush
+		def write(text):
+			# (anything printed since the last batch needs to come first)
+			flush_text()
+			write_bytes(text.encode(encoding, errors))
+		flush = buffer.flush
+		if _isatty(out):
+			write = lambda text: (flush_text(), write_bytes(text.encode(encoding, errors)), flush())
+
+	if not threaded:
+		return write, flush
+	return _threaded_output(write, flush)
+
+def _threaded_output(write, flush):
+	import threading
+	import queue
+
+	pending = queue.Queue(maxsize=8)
+	errors = []
+
+	def run():
+		while True:
+			text = pending.get()
+			if text is None:
+				break
+			if errors:
+				continue # drain (and drop) remaining output
+			try:
+				write(text)
+			except BaseException as e:
+				errors.append(e)
+		if not errors:
+			try:
+				flush()
+			except BaseException as e:
+				errors.append(e)
+
+	thread = threading.Thread(target=run, name='piep-writer')
+	thread.daemon = True
+	thread.start()
+
+	def check():
+		if errors:
+			raise errors[0]
+
+	def threaded_write(text):
+		check()
+		pending.put(text)
+
+	def close():
+		pending.put(None)
+		thread.join()
+		check()
+
+	return threaded_write, close
@@ -1,7 +1,7 @@
 #!/usr/bin/env python3
 from setuptools import *
 setup(
-	packages = find_packages(exclude=['test', 'test.*']),
+	packages = find_packages(exclude=['test', 'test.*', 'bench', 'bench.*']),
 	entry_points={'console_scripts': ['piep=piep.main:main']},
 	name='piep',
 	url='http://gfxmonk.net/dist/0install/piep.xml',
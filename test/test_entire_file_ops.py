@@ -91,6 +91,41 @@ class StreamFunctions(TestCase):
 			run('pp.sort(uniq=True)', [3,2,1,1]),
 			['1','2','3'])
 
+	def test_sort_spills_to_disk_beyond_memory_limit(self):
+		lines = [str((n * 7919) % 1000) for n in range(1000)]
+		self.assertEqual(
+			run('--memory-limit=1K', 'pp.sort()', lines),
+			sorted(lines))
+		self.assertEqual(
+			run('--memory-limit=1K', 'pp.sort(uniq=True)', lines + lines),
+			sorted(set(lines)))
+
+	def test_sortby_is_stable_when_spilling_to_disk(self):
+		lines = ['%s %s' % (n % 3, n) for n in range(300)]
+		self.assertEqual(
+			run('--memory-limit=1K', 'pp.sortby(lambda l: l.split()[0])', lines),
+			sorted(lines, key=lambda l: l.split()[0]))
+
+	def test_spilled_runs_are_merged_a_few_at_a_time(self):
+		from piep import external
+		old_fan_in = external.MERGE_FAN_IN
+		external.MERGE_FAN_IN = 3
+		try:
+			lines = [str((n * 7919) % 1000) for n in range(1000)]
+			self.assertEqual(run('--memory-limit=200', 'pp.sort()', lines), sorted(lines))
+			self.assertEqual(run('--memory-limit=200', 'pp.sort(uniq=True)', lines + lines), sorted(set(lines)))
+			keyed = ['%s %s' % (n % 7, n) for n in range(1000)]
+			self.assertEqual(
+				run('--memory-limit=200', 'pp.sortby(lambda l: l.split()[0])', keyed),
+				sorted(keyed, key=lambda l: l.split()[0]))
+		finally:
+			external.MERGE_FAN_IN = old_fan_in
+
+	def test_sortby_computes_each_key_once_when_spilling(self):
+		self.assertEqual(
+			run('--memory-limit=1K', '--eval=calls=[]', 'pp.sortby(lambda l: calls.append(l) or int(l)) | pp[:1] + [len(calls)]', [str(n) for n in range(500, 0, -1)]),
+			['1', '500'])
+
 	def test_sortby(self):
 		self.assertEqual(
 				run('p.split() | pp.sortby(lambda x: x[0]) | p[1]', ["0 zero", "3 three", "2 two", "0 zero"]),
@@ -116,6 +151,48 @@ class StreamFunctions(TestCase):
 		self.assertRaises(AssertionError, lambda: run('pp.sortby(len, attr=0)', []))
 		self.assertRaises(AssertionError, lambda: run('pp.sortby(len, method=0)', []))
 
+	def test_top_and_bottom(self):
+		lines = ['3', '10', '2', '10', '7']
+		self.assertEqual(run('pp.top(2)', lines), ['7', '3'])
+		self.assertEqual(run('pp.top(2, int)', lines), ['10', '10'])
+		self.assertEqual(run('pp.bottom(2, int)', lines), ['2', '3'])
+		self.assertEqual(run('pp.bottom(3, method="__len__")', lines), ['3', '2', '7'])
+		self.assertEqual(run('pp.bottom(10)', lines), sorted(lines))
+
+	def test_top_and_bottom_spill_when_k_items_exceed_the_memory_limit(self):
+		from piep import external
+		lines = ['%04d' % ((n * 7919) % 1000) for n in range(1000)]
+		sorts = []
+		old_sort = external.sort
+		external.sort = lambda *a, **k: sorts.append(k) or old_sort(*a, **k)
+		try:
+			self.assertEqual(run('--memory-limit=1K', 'pp.sort() | pp[:500]', lines), sorted(lines)[:500])
+			self.assertEqual(run('--memory-limit=1K', 'pp.sort() | pp[-500:]', lines), sorted(lines)[-500:])
+			self.assertEqual(run('--memory-limit=1K', 'pp.top(500, int)', lines), sorted(lines, reverse=True)[:500])
+			self.assertEqual(len(sorts), 3)
+			self.assertEqual(run('--memory-limit=1K', 'pp.bottom(5)', lines), sorted(lines)[:5])
+			self.assertEqual(len(sorts), 3)
+		finally:
+			external.sort = old_sort
+
+	def test_sort_then_slice_uses_a_bounded_heap(self):
+		from piep.main import compile_pipe_exprs
+		lines = [str((n * 7919) % 100) for n in range(100)]
+		for pipeline, expected in [
+			(['pp.sort()', 'pp[:5]'], sorted(lines)[:5]),
+			(['pp.sort()[-5:]'], sorted(lines)[-5:]),
+			(['pp.sortby(int)', 'pp[:5]'], sorted(lines, key=int)[:5]),
+			(['pp.sortby(key=0)[:5]'], sorted(lines, key=lambda l: l[0])[:5]),
+		]:
+			self.assertEqual(run(' | '.join(pipeline), lines), expected)
+			names = compile_pipe_exprs(pipeline).co_names
+			self.assertNotIn('sort', names)
+			self.assertNotIn('sortby', names)
+
+		# no equivalent for a sorted, unique prefix
+		self.assertIn('sort', compile_pipe_exprs(['pp.sort(uniq=True)', 'pp[:3]']).co_names)
+		self.assertEqual(run('pp.sort(uniq=True) | pp[:3]', lines + lines), sorted(set(lines))[:3])
+
 	def test_uniq(self):
 		self.assertEqual(
 			sorted(run('pp.uniq()', [5, 4, 3, 2, 1, 2, 3, 4, 5])),
@@ -125,6 +202,19 @@ class StreamFunctions(TestCase):
 		self.assertEqual(
 			run('pp.uniq(stable=True)', [5, 4, 1, 5, 2, 1, 3]),
 			['5','4','1','2','3'])
+
+	def test_uniq_works_lazily(self):
+		self.assertEqual(
+			run('pp.uniq() | pp[:3]', itertools.cycle('abc')),
+			['a','b','c'])
+
+	def test_uniq_with_digests(self):
+		for bits in ('64', '128'):
+			self.assertEqual(
+				run('pp.uniq(digest=%s)' % bits, [5, 4, 1, 5, 2, 1, 3]),
+				['5','4','1','2','3'])
+		self.assertRaises(AssertionError, lambda: run('pp.uniq(digest=32)', [1]))
+		self.assertRaises(TypeError, lambda: run('int(p) | pp.uniq(digest=64)', [1, 2]))
 	
 	def test_chunk_on_predicate(self):
 		self.assertEqual(
@@ -230,12 +320,223 @@ class TestMultipleFileInput(TestCase):
 						'--file=' + f.name, 'pp.zip_shortest(files[0]) | p[0], p[1].upper()', ['1']),
 					['1-A'])
 
+class TestReadingFilesBackwards(TestCase):
+	def _run(self, expr, contents):
+		with tempfile.NamedTemporaryFile() as f:
+			f.write(contents)
+			f.flush()
+			return run('-i', f.name, expr, [])
+
+	def test_tail_of_a_file(self):
+		contents = b''.join(b'line %d\n' % (n,) for n in range(10000))
+		self.assertEqual(self._run('pp[-3:]', contents), ['line 9997', 'line 9998', 'line 9999'])
+		self.assertEqual(self._run('pp[-5:-3]', contents), ['line 9995', 'line 9996'])
+		self.assertEqual(self._run('pp[-1]', contents), ['line 9999'])
+		self.assertEqual(self._run('pp.reverse()[:2]', contents), ['line 9999', 'line 9998'])
+
+	def test_missing_trailing_newline_and_blank_lines(self):
+		contents = b'a\n\nb\r\nc'
+		self.assertEqual(self._run('pp.reverse()', contents), ['c', 'b', '', 'a'])
+		self.assertEqual(self._run('pp[-2:]', contents), ['b', 'c'])
+
+	def test_only_the_end_of_the_file_is_read(self):
+		# (decoding the first block, which is more than `bufsize` bytes from the end, would fail)
+		contents = b'\xff\xfe\n' + b'ok\n' * 500000
+		self.assertEqual(self._run('pp[-2:]', contents), ['ok', 'ok'])
+
+	def test_index_beyond_the_start_of_a_file(self):
+		with self.assertRaises(IndexError):
+			self._run('pp[-5]', b'a\nb\n')
+
+class TestAggregation(TestCase):
+	lines = ['a 200 10', 'b 404 5', 'a 500 30', 'c 200 1', 'a 200 2']
+
+	def test_groupby_agg(self):
+		self.assertEqual(
+			run('pp.groupby(lambda l: l.split()[0]).agg(count=True, sum=lambda l: int(l.split()[2]), last=True)', self.lines),
+			['a 3 42 a 200 2', 'b 1 5 b 404 5', 'c 1 1 c 200 1'])
+
+	def test_tuple_keys_and_multiple_values(self):
+		self.assertEqual(
+			run('p.split() | pp.groupby(lambda f: (f[0], f[1])).agg(min=[lambda f: int(f[2]), lambda f: f[1]], mean=lambda f: int(f[2]))', self.lines),
+			['a 200 2 200 6.0', 'b 404 5 404 5.0', 'a 500 30 500 30.0', 'c 200 1 200 1.0'])
+
+	def test_unknown_aggregate(self):
+		with self.assertRaises(ValueError):
+			run('pp.groupby().agg(median=True)', self.lines)
+
+	def test_counts(self):
+		self.assertEqual(run('pp.counts(lambda l: l.split()[1])', self.lines), ['200 3', '404 1', '500 1'])
+		self.assertEqual(run('p.split()[0] | pp.counts(top=1)', self.lines), ['a 3'])
+
+	def test_key_may_be_a_function(self):
+		self.assertEqual(run('pp.counts(key=lambda l: l[0])', self.lines), ['a 3', 'b 1', 'c 1'])
+		self.assertEqual(run('p.split() | pp.counts(key=1)', self.lines), ['200 3', '404 1', '500 1'])
+		self.assertEqual(run('pp.bottom(1, key=lambda l: -int(l.split()[2]))', self.lines), ['a 500 30'])
+
+	def test_aggregation_spills_to_disk_beyond_memory_limit(self):
+		lines = [str((n * 7919) % 500) for n in range(2000)]
+		expected = sorted('%s %d %d' % (k, 4, int(k) * 4) for k in set(lines))
+		self.assertEqual(
+			sorted(run('--memory-limit=1K', 'pp.groupby().agg(count=True, sum=int)', lines)),
+			expected)
+		self.assertEqual(
+			sorted(run('--memory-limit=1K', 'pp.counts()', lines)),
+			sorted('%s 4' % (k,) for k in set(lines)))
+		self.assertEqual(
+			run('--memory-limit=1K', 'pp.counts(top=2)', lines + ['42'] * 10 + ['7'] * 5),
+			['42 14', '7 9'])
+
+	def test_spilled_partitions_which_are_too_large_are_split_again(self):
+		from piep import external
+		lines = [str((n * 7919) % 2000) for n in range(6000)]
+		levels = []
+		old_spill, old_partitions = external._spill_partitions, external.PARTITIONS
+		external._spill_partitions = lambda pairs, partitions, level=0: levels.append(level) or old_spill(pairs, partitions, level)
+		external.PARTITIONS = 2
+		try:
+			self.assertEqual(
+				sorted(run('--memory-limit=2K', 'pp.groupby().agg(count=True, first=True, last=True)', lines)),
+				sorted('%s 3 %s %s' % (k, k, k) for k in set(lines)))
+			self.assertEqual(
+				sorted(run('--memory-limit=2K', 'pp.counts()', lines)),
+				sorted('%s 3' % (k,) for k in set(lines)))
+		finally:
+			external._spill_partitions, external.PARTITIONS = old_spill, old_partitions
+		self.assertEqual(max(levels), external.MAX_REPARTITIONS)
+
+class TestJoin(TestCase):
+	def test_join_with_a_lookup_file(self):
+		with tempfile.NamedTemporaryFile() as f:
+			write_and_rewind(f, '200 OK\n404 Not Found\n500 Error\n')
+			self.assertEqual(
+				run('--file=' + f.name,
+					'pp.join_on(ff, key=lambda l: l.split()[1], other_key=lambda l: l.split()[0]) | p[0].split()[0], p[1]',
+					['a 200', 'b 302', 'c 404', 'd 200']),
+				['a 200 OK', 'c 404 Not Found', 'd 200 OK'])
+
+	def test_left_join(self):
+		self.assertEqual(
+			run('p.split() | pp.join_on([["1", "one"], ["2", "two"], ["2", "deux"]], key=0, how="left") | p[0][1], p[1] and p[1][1]', ['1 a', '3 b', '2 c']),
+			['a one', 'b None', 'c two', 'c deux'])
+
+	def test_invalid_join_type(self):
+		with self.assertRaises(ValueError):
+			run('pp.join_on([], how="outer")', ['a'])
+
+	def test_join_spills_to_disk_beyond_memory_limit(self):
+		left = ['%d left' % (n % 300,) for n in range(600)]
+		right = ['%d right%d' % (n, r) for n in range(0, 400, 2) for r in range(2)]
+		expected = sorted(
+			'%s %s' % (l, r) for l in left for r in right if l.split()[0] == r.split()[0])
+		for how, extra in [('inner', []), ('left', sorted(l + ' None' for l in left if int(l.split()[0]) % 2))]:
+			with tempfile.NamedTemporaryFile() as f:
+				write_and_rewind(f, '\n'.join(right) + '\n')
+				self.assertEqual(
+					sorted(run('--memory-limit=1K', '--file=' + f.name,
+						'pp.join_on(ff, key=lambda l: l.split()[0], how=%r) | p[0], p[1]' % (how,), left)),
+					sorted(expected + extra))
+
+class TestColumns(TestCase):
+	lines = ['host status bytes', 'a 200 10', 'b 404 2.5', 'a 200 30', 'c 500 7.5']
+	use_numpy = False
+
+	def setUp(self):
+		from piep import columns
+		self.old_use_numpy = columns.use_numpy
+		columns.use_numpy = self.use_numpy
+
+	def tearDown(self):
+		from piep import columns
+		columns.use_numpy = self.old_use_numpy
+
+	def test_aggregates(self):
+		self.assertEqual(run('pp.columns(header=True, types={"bytes": float}).sum()', self.lines), ['50.0'])
+		self.assertEqual(run('pp.columns(header=True, types={"status": int}).max()', self.lines), ['500'])
+		self.assertEqual(run('pp[1:] | pp.columns(types={2: float}).mean()', self.lines), ['12.5'])
+		self.assertEqual(run('pp[1:] | pp.columns(types=[None, int, None]).min(1)', self.lines), ['200'])
+
+	def test_filter_outputs_rows(self):
+		self.assertEqual(
+			run('pp.columns(header=True, types=[str, int, float]).filter("status", ne=200)', self.lines),
+			['b 404 2.5', 'c 500 7.5'])
+		self.assertEqual(
+			run('pp.columns(header=True, types=[str, int]).filter("host", fn=lambda h: h == "a") | p[1]', self.lines),
+			['200', '200'])
+
+	def test_histogram(self):
+		self.assertEqual(
+			run('pp.columns(types={0: int}).histogram(bins=2, range=(0, 10))', [0, 1, 5, 9, 10, 11, -1]),
+			['0.0 5.0 2', '5.0 10.0 3'])
+
+	def test_other_separators(self):
+		self.assertEqual(run('pp.columns(",", types={1: int}).sum()', ['a,1', 'b,2', ',3']), ['6'])
+
+	def test_short_lines_are_reported(self):
+		with self.assertRaises(ValueError) as context:
+			run('pp.columns(types={1: int}).sum()', ['a 1', 'b', 'c 3'])
+		self.assertIn('line 2', str(context.exception))
+
+	def test_conversion_errors_are_reported(self):
+		with self.assertRaises(ValueError) as context:
+			run('pp.columns(types={1: float}).sum()', ['a 1', 'b 2', 'c x'])
+		self.assertIn('line 3', str(context.exception))
+		self.assertIn("'x'", str(context.exception))
+
+	def test_blank_lines_are_skipped(self):
+		self.assertEqual(run('pp.columns(header=True, types={"status": int}).sum()', [''] + self.lines + ['', ' ']), ['1304'])
+		with self.assertRaises(ValueError) as context:
+			run('pp.columns(types={1: int}).sum()', ['a 1', '', 'b'])
+		self.assertIn('line 3', str(context.exception))
+
+	def test_sums_are_exact(self):
+		self.assertEqual(run('pp.columns(types=[int]).sum()', [2 ** 62, 2 ** 62, 1]), [str(2 ** 63 + 1)])
+		self.assertEqual(run('pp.columns().sum()', ['0.1'] * 10), ['1.0'])
+
+	def test_file_input_is_read_in_blocks(self):
+		with tempfile.NamedTemporaryFile() as f:
+			f.write(b''.join(b'%d %d\n' % (n, n % 7) for n in range(100000)))
+			f.flush()
+			self.assertEqual(run('-i', f.name, 'pp.columns(types=[int, int]).sum(0)', []), [str(sum(range(100000)))])
+			self.assertEqual(run('-i', f.name, 'pp.columns().filter(1, eq=3).max(0)', []), ['99998.0'])
+
+class TestColumnsWithNumPy(TestColumns):
+	use_numpy = True
+
+	def setUp(self):
+		try:
+			import numpy
+		except ImportError:
+			self.skipTest('NumPy is not installed')
+		super().setUp()
+
 class TestOutput(TestCase):
 	def test_separating_output_with_null_bytes(self):
 		self.assertEqual(
 				run_full('--print0', 'p + "_"', 'a\nb\nc'),
 				'a_\000b_\000c_')
 
+	def test_separating_joined_output_with_null_bytes(self):
+		self.assertEqual(
+				run_full('--print0', '--join=-', 'p, i', 'a\nb'),
+				'a-0\000b-1')
+
+	def test_writing_output_from_a_thread(self):
+		self.assertEqual(
+				run_full('--write-thread', 'p', '\n'.join(map(str, range(5000)))),
+				''.join('%s\n' % n for n in range(5000)))
+
+	def test_printed_output_is_interleaved_with_results(self):
+		self.assertEqual(
+				run_full('print("x:" + p) or p', 'a\nb\nc'),
+				'x:a\na\nx:b\nb\nx:c\nc\n')
+		self.assertEqual(
+				run_full('--write-thread', '-e', 'def show(x): print("x:" + x)', 'show(p) or p', 'a\nb'),
+				'x:a\na\nx:b\nb\n')
+		self.assertEqual(
+				run_full('-m', 'sys', 'sys.stdout.write("x:" + p + "\\n") and p', 'a\nb'),
+				'x:a\na\nx:b\nb\n')
+
 class TestInput(TestCase):
 	def test_self_constructing_pipeline(self):
 		self.assertEqual(
@@ -246,3 +547,38 @@ class TestInput(TestCase):
 		self.assertEqual(
 				run_full('--no-input', 'pp = [1,2,3] | p + 1', None),
 				'2\n3\n4\n')
+
+	def test_reading_null_separated_input(self):
+		self.assertEqual(
+				run_full('-0', 'p.upper()', 'a\nb\000c\000'),
+				'A\nB\nC\n')
+
+	def test_reading_input_in_small_blocks(self):
+		with tempfile.NamedTemporaryFile() as f:
+			write_and_rewind(f, 'one\r\ntwo\n\nthree')
+			self.assertEqual(
+					run_full('--bufsize=2', '-i', f.name, 'repr(p)', None),
+					"'one'\n'two'\n''\n'three'\n")
+
+	def test_memory_mapped_input(self):
+		with tempfile.NamedTemporaryFile() as f:
+			write_and_rewind(f, 'one\r\ntwo\n\nthree\n')
+			self.assertEqual(
+					run_full('--mmap', '--bufsize=2', '-i', f.name, 'repr(p)', None),
+					"'one'\n'two'\n''\n'three'\n")
+
+	def test_memory_mapped_input_at_the_default_bufsize(self):
+		for contents in ['a\nb\n', 'a\nb', 'a\n\n', '\n']:
+			with tempfile.NamedTemporaryFile() as f:
+				write_and_rewind(f, contents)
+				self.assertEqual(
+						run_full('--mmap', '-i', f.name, 'repr(p)', None),
+						run_full('-i', f.name, 'repr(p)', None))
+		with tempfile.NamedTemporaryFile() as f:
+			write_and_rewind(f, 'a\nb\n')
+			self.assertEqual(run_full('--mmap', '-i', f.name, 'len(pp)', None), '2\n')
+
+	def test_memory_mapped_input_falls_back_for_pipes(self):
+		self.assertEqual(
+				run_full('--mmap', 'p.upper()', 'a\nb'),
+				'A\nB\n')
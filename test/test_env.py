@@ -1,6 +1,11 @@
 from test.test_helper import run, temp_cwd
 from unittest import TestCase
 import subprocess
+import tempfile
+import shutil
+import os
+import sys
+from piep import main
 
 
 class TestModuleImporting(TestCase):
@@ -20,3 +25,149 @@ class TestModuleImporting(TestCase):
 			self.assertEqual(
 				run('-p', '.', '-m', 'mymod', 'mymod.up(p)', ['a']), ['A'])
 
+
+class TempCacheDir(TestCase):
+	def setUp(self):
+		self.cache_dir = tempfile.mkdtemp()
+		self.old_env = os.environ.get('PIEP_CACHE_DIR')
+		os.environ['PIEP_CACHE_DIR'] = self.cache_dir
+
+	def tearDown(self):
+		if self.old_env is None:
+			del os.environ['PIEP_CACHE_DIR']
+		else:
+			os.environ['PIEP_CACHE_DIR'] = self.old_env
+		shutil.rmtree(self.cache_dir)
+
+class TestPipelineCache(TempCacheDir):
+	def cached(self):
+		path = os.path.join(self.cache_dir, 'pipelines')
+		return [name for _, _, names in os.walk(path) for name in names]
+
+	def test_compiled_pipelines_are_reused(self):
+		self.assertEqual(run('p.upper() | i, p', ['a', 'b']), ['0 A', '1 B'])
+		self.assertEqual(len(self.cached()), 1)
+		self.assertEqual(run('p.upper() | i, p', ['c']), ['0 C'])
+		self.assertEqual(len(self.cached()), 1)
+
+	def test_options_are_part_of_the_key(self):
+		self.assertEqual(run('[2]', [1]), ['2'])
+		self.assertEqual(run('--no-input', '[2]', [1]), ['2'])
+		self.assertEqual(len(self.cached()), 2)
+
+	def test_only_the_newest_pipelines_are_kept(self):
+		from piep import cache
+		old_max = cache.MAX_PIPELINES
+		cache.MAX_PIPELINES = 2
+		try:
+			for n in range(4):
+				run('p + "%d"' % (n,), [1])
+		finally:
+			cache.MAX_PIPELINES = old_max
+		self.assertEqual(len(self.cached()), 2)
+
+	def test_pipelines_from_other_versions_are_removed(self):
+		path = os.path.join(self.cache_dir, 'pipelines')
+		os.makedirs(os.path.join(path, 'stale-version'))
+		for stale in [os.path.join(path, 'stale-version', 'pipeline'), os.path.join(path, 'unversioned')]:
+			with open(stale, 'w'):
+				pass
+		self.assertEqual(len(self.cached()), 2)
+		run('p', [1])
+		self.assertEqual(len(self.cached()), 1)
+		from piep import cache
+		self.assertEqual(os.listdir(path), [cache._version()])
+
+	def test_cache_can_be_bypassed(self):
+		self.assertEqual(run('--no-cache', 'p', [1]), ['1'])
+		self.assertEqual(self.cached(), [])
+
+	def test_cache_can_be_cleared(self):
+		run('p', [1])
+		self.assertEqual(main.main(['--clear-cache']), 0)
+		self.assertEqual(self.cached(), [])
+
+class TestCommandResultCache(TempCacheDir):
+	pid = 'str(sh("sh", "-c", "echo $$"%s)) | len(set(pp))'
+
+	def test_results_are_reused(self):
+		self.assertEqual(run('--sh-cache=memory', self.pid % ('',), [1, 2, 3]), ['1'])
+		self.assertEqual(run(self.pid % ('',), [1, 2, 3]), ['3'])
+		self.assertEqual(run('--sh-cache=memory', self.pid % (', cache=False',), [1, 2, 3]), ['3'])
+
+	def test_failures_are_only_cached_when_requested(self):
+		failing = 'str(sh("sh", "-c", "echo $$; exit 1", check=False)) | len(set(pp))'
+		self.assertEqual(run('--sh-cache=memory', failing, [1, 2]), ['2'])
+		self.assertEqual(run('--sh-cache=memory', '--sh-cache-failures', failing, [1, 2]), ['1'])
+
+	def test_results_are_stored_on_disk(self):
+		echo_pid = 'sh("sh", "-c", "echo $$")'
+		first = run('--sh-cache=disk', echo_pid, [1])
+		self.assertEqual(run('--sh-cache=disk', echo_pid, [1]), first)
+		self.assertNotEqual(run('--sh-cache=memory', echo_pid, [1]), first)
+		self.assertEqual(main.main(['--clear-cache']), 0)
+		self.assertNotEqual(run('--sh-cache=disk', echo_pid, [1]), first)
+
+	def test_selected_environment_variables_are_part_of_the_key(self):
+		from piep import memo
+		echo_env = 'sh("sh", "-c", "echo $PIEP_TEST")'
+		old_env = os.environ.get('PIEP_TEST')
+		try:
+			for options, expected in [([], ['a', 'a']), (['--sh-cache-env=PIEP_TEST'], ['a', 'b'])]:
+				results = []
+				for value in ['a', 'b']:
+					os.environ['PIEP_TEST'] = value
+					results += run('--sh-cache=disk', *options + [echo_env, [1]])
+				self.assertEqual(results, expected)
+				memo.clear()
+		finally:
+			if old_env is None:
+				del os.environ['PIEP_TEST']
+			else:
+				os.environ['PIEP_TEST'] = old_env
+
+	def test_explicit_environments_are_part_of_the_key(self):
+		echo_env = 'sh("sh", "-c", "echo $PIEP_TEST", env=dict(PIEP_TEST=p))'
+		self.assertEqual(run('--sh-cache=disk', echo_env, ['a', 'b']), ['a', 'b'])
+		self.assertEqual(run('--sh-cache=memory', '--sh-cache-env=PIEP_TEST', echo_env, ['a', 'b']), ['a', 'b'])
+
+	def test_paths_can_be_part_of_the_key(self):
+		with temp_cwd():
+			for contents in ('one', 'three'):
+				with open('file', 'w') as f:
+					f.write(contents)
+				self.assertEqual(run('--sh-cache=disk', 'sh("cat", p)', ['file']), ['one'])
+				self.assertEqual(run('--sh-cache=disk', '--sh-cache-paths', 'sh("cat", p)', ['file']), [contents])
+
+class TestProfiler(TestCase):
+	def test_each_stage_is_reported(self):
+		from io import StringIO
+		from piep.builtins import builtins
+		from piep.profiler import Profiler
+		from piep.sequence import Stream
+		code = main.compile_pipe_exprs(main.split_on_pipes('p.upper() | pp[:2] | sh("echo", p)'), input_lines=True, profile=True)
+		bindings = builtins.copy()
+		bindings['pp'] = Stream(iter(['a', 'b', 'c']))
+		profiler = bindings['_profiler'] = Profiler()
+		main.execfn(code, bindings)
+		self.assertEqual(list(map(str, bindings['pp'])), ['A', 'B'])
+
+		out = StringIO()
+		profiler.report(out)
+		rows = [line.rsplit(None, 5) for line in out.getvalue().splitlines()]
+		# (stages are lazy, so only the lines needed by `pp[:2]` are read)
+		self.assertEqual([row[:3] for row in rows[1:-1]], [
+			['(input)', '-', '2'],
+			['p.upper()', '2', '2'],
+			['pp[:2]', '2', '2'],
+			['sh("echo", p)', '2', '2'],
+		])
+		self.assertEqual(rows[-1][0], '(total)')
+
+class TestStartup(TestCase):
+	def test_optional_modules_are_loaded_lazily(self):
+		script = 'import sys, piep.main; print(" ".join(sorted(set(sys.argv[1:]).intersection(sys.modules))))'
+		modules = ['ast', 'subprocess', 'shlex', 'tempfile', 'multiprocessing', 'mmap']
+		output = subprocess.check_output([sys.executable, '-c', script] + modules,
+			env={'PYTHONPATH': os.path.dirname(os.path.dirname(main.__file__))})
+		self.assertEqual(output.decode('utf-8').strip(), '')
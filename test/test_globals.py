@@ -1,6 +1,7 @@
 from test.test_helper import run
 from unittest import TestCase
 import subprocess
+from piep.error import Exit
 
 class TestGlobals(TestCase):
 	def test_len(self):
@@ -71,3 +72,87 @@ class TestShellCommands(TestCase):
 	def test_shell_attributes_that_dont_exist_cause_coercion_to_str(self):
 		self.assertEqual(run('sh("echo", p).upper()', ['a']), ['A'])
 
+
+	def test_concurrent_shell_commands_keep_input_order(self):
+		lines = [str(n) for n in range(20)]
+		self.assertEqual(
+			run('--sh-jobs=4', 'sh("sh", "-c", "sleep 0.0$((%s %% 3)); echo %s" % (p, p)) | "%s) %s" % (i, p)', lines),
+			['%s) %s' % (n, n) for n in range(20)])
+
+	def test_concurrent_shell_failures_report_the_first_failing_line(self):
+		try:
+			run('--sh-jobs=4', 'sh("sh", "-c", "sleep 0.0$((3 - %s %% 3)); exit %s" % (p, p))', ['0', '0', '3', '2', '0'])
+		except subprocess.CalledProcessError as e:
+			self.assertEqual(e.returncode, 3)
+		else:
+			self.fail("no error raised")
+
+	def test_concurrent_shell_commands_with_shared_state_run_serially(self):
+		lines = [str(n) for n in range(20)]
+		self.assertEqual(
+			run('--sh-jobs=4', '--eval=seen=[]', 'sh("sh", "-c", "sleep 0.0$((%s %% 3)); echo %s" % (p, p)) | seen.append(p) or len(seen)', lines),
+			[str(n) for n in range(1, 21)])
+
+	def test_threads_only_allow_commands_which_are_tracked_per_line(self):
+		from piep import parallel
+		bindings = {}
+		exec('def fetch(x):\n\treturn sh("echo", x)', bindings)
+		self.assertIsNone(parallel.serial_reason(bindings['fetch'], ['fetch'], threads=True))
+		self.assertIn('`sh`', parallel.serial_reason(bindings['fetch'], ['fetch']))
+		exec('def ask(x):\n\treturn coproc("cat").ask(x)', bindings)
+		self.assertIn('`coproc`', parallel.serial_reason(bindings['ask'], ['ask'], threads=True))
+
+	def test_concurrent_shell_failures_are_suppressed_explicitly(self):
+		self.assertEqual(run('--sh-jobs=4', 'sh("false", check=False) or p', ['a', 'b', 'c']), ['a', 'b', 'c'])
+
+	def test_shell_output_is_a_sequence_of_lines(self):
+		self.assertEqual(run('-n', 'sh("printf", "ab\\ncd\\n")', []), ['ab', 'cd'])
+		self.assertEqual(run('sh("printf", "ab\\ncd\\n") | list(p)', ['1']), ['ab cd'])
+
+	def test_shell_output_is_streamed(self):
+		self.assertEqual(run('-n', 'sh("yes") | pp[:2]', []), ['y', 'y'])
+
+	def test_shell_input(self):
+		self.assertEqual(run('sh("sort", input=pp)', ['b', 'c', 'a']), ['a', 'b', 'c'])
+		self.assertEqual(run('sh("wc", "-c", input=p) | p.strip()', ['abc']), ['3'])
+		self.assertEqual(run('-n', 'sh("head", "-n", "2", input=iter(int, 1))', []), ['0', '0'])
+
+	def test_streamed_shell_failures_are_tracked(self):
+		self.assertRaises(subprocess.CalledProcessError, lambda: run('sh("sh", "-c", "cat; exit 3", input=pp)', ['a']))
+		self.assertEqual(run('sh("sh", "-c", "cat; exit 3", input=pp, check=False)', ['a']), ['a'])
+
+	def test_partly_read_shell_failures_are_tracked(self):
+		for pipeline in [
+				'sh("sh", "-c", "echo a; exit 2") | pp[:0]',
+				'sh("sh", "-c", "echo a; echo b; exit 2") | pp[:1]']:
+			self.assertRaises(subprocess.CalledProcessError, lambda: run('-n', pipeline, []))
+		self.assertRaises(subprocess.CalledProcessError, lambda: run('next(iter(sh("sh", "-c", "echo a; exit 2")))', ['x']))
+		self.assertEqual(run('-n', 'sh("sh", "-c", "echo a; exit 2", check=False) | pp[:0]', []), [])
+		# (stopping early is expected to kill a command with SIGPIPE)
+		self.assertEqual(run('-n', 'sh("sh", "-c", "yes; exit 0") | pp[:1]', []), ['y'])
+
+	def test_shell_input_errors_are_raised(self):
+		self.assertRaises(ZeroDivisionError, lambda: run('sh("cat", input=(1/0 for x in pp))', ['a']))
+
+class TestCoprocesses(TestCase):
+	echo = ('sh', '-c', 'while read x; do echo "$x"; done')
+
+	def test_requests_are_sent_to_a_single_process(self):
+		self.assertEqual(run('coproc("sh", "-c", "while read x; do echo $$; done")(p) | len(set(pp))', ['a', 'b', 'c']), ['1'])
+		self.assertEqual(run('coproc("sed", "-u", "s/^/> /")(p)', ['a', 'b']), ['> a', '> b'])
+
+	def test_multi_line_responses(self):
+		self.assertEqual(run('coproc("sed", "-u", "p", lines=2)(p) | p.replace("\\n", ",")', ['a', 'b']), ['a,a', 'b,b'])
+		self.assertEqual(run('coproc("sed", "-u", "s/ /\\\\n/g; s/$/\\\\n--/", end="--")(p) | p.splitlines() | len(p)', ['a b c', 'd']), ['3', '1'])
+
+	def test_pipelined_requests(self):
+		self.assertEqual(run('coproc(*%r).map(pp)' % (self.echo,), list('abc')), ['a', 'b', 'c'])
+		self.assertEqual(run('coproc(*%r).map(pp) | pp[:2]' % (self.echo,), list('abc')), ['a', 'b'])
+
+	def test_failures_are_raised_at_the_end(self):
+		cmd = 'coproc("sh", "-c", "while read x; do echo $x; done; exit 3"%s)(p)'
+		self.assertRaises(subprocess.CalledProcessError, lambda: run(cmd % ('',), ['a']))
+		self.assertEqual(run(cmd % (', check=False',), ['a']), ['a'])
+
+	def test_exiting_without_a_response(self):
+		self.assertRaises(Exit, lambda: run('coproc("true", check=False)(p)', ['a']))
@@ -10,12 +10,25 @@ from io import StringIO
 from piep import main
 from piep.pycompat import *
 
+# keep the pipelines (and command results) cached by tests out of the user's own cache
+CACHE_DIR = tempfile.mkdtemp(prefix='piep-test-cache-')
+os.environ['PIEP_CACHE_DIR'] = CACHE_DIR
+import atexit
+atexit.register(shutil.rmtree, CACHE_DIR, True)
+
+class LineInput(object):
+	'''a lazy stand-in for sys.stdin'''
+	def __init__(self, lines):
+		self._lines = map(str, lines)
+	def __iter__(self): return self._lines
+	def close(self): pass
+
 def run(*args):
 	args = list(args)
 	input_lines = args.pop()
 	opts, args = main.parse_args(args)
 	old_stdin = sys.stdin
-	sys.stdin = map(str, input_lines)
+	sys.stdin = LineInput(input_lines)
 	try:
 		return [str(line) for line in main.run(opts, args)]
 	finally:
@@ -30,7 +43,8 @@ def run_full(*args):
 		stdin=subprocess.PIPE,
 		stdout=subprocess.PIPE, stderr=subprocess.PIPE,
 		env={
-			'PYTHONPATH': os.path.dirname(os.path.dirname(main.__file__))
+			'PYTHONPATH': os.path.dirname(os.path.dirname(main.__file__)),
+			'PIEP_CACHE_DIR': os.environ['PIEP_CACHE_DIR'],
 		}
 	)
 	out, err = proc.communicate(stdin)
@@ -1,4 +1,7 @@
 from unittest import TestCase
+import re
+import subprocess
+from piep import main
 from test.test_helper import run
 
 class TestParsing(TestCase):
@@ -49,6 +52,12 @@ class TestFilters(TestCase):
 				run('--debug', 'i % 2 == 0', ['0', '1', '2', '3', '4']),
 				['0', '2','4'])
 
+	def test_trailing_assignments_to_p_are_filtered(self):
+		for options in [[], ['--jobs=2']]:
+			self.assertEqual(run(*options + ['p = len(p) > 3', ['ab', 'cdef']]), ['cdef'])
+			self.assertEqual(run(*options + ['p = None if p == "ab" else p.upper()', ['ab', 'cdef']]), ['CDEF'])
+			self.assertEqual(run(*options + ['x = len(p)', ['ab', 'cdef']]), ['ab', 'cdef'])
+
 class TestLineFunctions(TestCase):
 	def test_path_functions(self):
 		self.assertEqual(run('p.dirname()'  ,  ['a/b/c.py'])       ,  ['a/b'])
@@ -68,6 +77,15 @@ class TestLineFunctions(TestCase):
 		self.assertEqual(run('p.match("b(?P<m>..)?","m")' ,  ['a beef c'])        ,  ['ee'])
 		self.assertEqual(run('p.match("b(?P<m>..)?","m")' ,  ['a b'])             ,  [])
 		self.assertEqual(run('p.matches("b..")'           ,  ['a bee c', 'nope']) ,  ['a bee c'])
+		self.assertEqual(run('p.matches("B..", flags=re.I)', ['a bee c', 'nope']) ,  ['a bee c'])
+		self.assertEqual(run('p.splitre(" +", 1)'         ,  ['a b   c'])         ,  ['a b   c'])
+		self.assertEqual(run('--eval=PATTERNS=["a", "c"]', 'p.matches(PATTERNS[i])', ['xa', 'xb']), ['xa'])
+
+	def test_lines_have_no_instance_dict(self):
+		from piep.line import Line
+		self.assertFalse(hasattr(Line('a'), '__dict__'))
+		self.assertIsInstance(Line('a b').split()[0], Line)
+		self.assertIsNone(Line('a').match('b'))
 
 	def test_reversed(self):
 		self.assertEqual(run('p.reversed()', ['123','abc']), ['321','cba'])
@@ -79,3 +97,111 @@ class TestLineFunctions(TestCase):
 		self.assertEqual(run('p=repr', ['abc']), [str(repr)])
 
 
+
+class TestParallel(TestCase):
+	def test_results_are_in_input_order(self):
+		lines = [str(n) for n in range(3000)]
+		self.assertEqual(
+			run('--jobs=3', 'int(p) % 3 != 1 | p, i', lines),
+			['%s %s' % (n, n) for n in range(3000) if n % 3 != 1])
+
+	def test_global_expressions_between_parallel_groups(self):
+		self.assertEqual(
+			run('--jobs=2', '--eval=SUFFIX="!"', 'p.upper() | pp[1:] | p + SUFFIX', ['a', 'b', 'c']),
+			['B!', 'C!'])
+
+	def test_shared_state_falls_back_to_serial(self):
+		self.assertEqual(
+			run('--jobs=2', '--eval=seen=set()', 'p not in seen and not seen.add(p)', ['a', 'b', 'a', 'c', 'b']),
+			['a', 'b', 'c'])
+
+	def test_functions_using_shared_state_fall_back_to_serial(self):
+		define = 'def first(x):\n\tif x in seen: return None\n\tseen.add(x)\n\treturn x'
+		lines = [str(n) for n in range(3000)]
+		self.assertEqual(
+			run('--jobs=2', '--eval=seen=set()', '--eval=' + define, 'first(int(p) % 10)', lines),
+			[str(n) for n in range(10)])
+
+	def test_pure_functions_run_in_parallel(self):
+		from piep import parallel
+		define = 'def double(x):\n\treturn helper(x) * 2\ndef helper(x):\n\treturn int(x)'
+		bindings = {}
+		exec(define, bindings)
+		self.assertIsNone(parallel._unshareable(['double'], bindings, set()))
+		exec('def helper(x, cache={}):\n\treturn cache.setdefault(x, x)', bindings)
+		self.assertIn('a dict', parallel._unshareable(['double'], bindings, set()))
+		bindings['table'] = {}
+		exec('def lookup(x):\n\treturn table.get(x)', bindings)
+		self.assertIn('`table`', parallel._unshareable(['lookup'], bindings, set()))
+
+def _referenced_names(code):
+	names = set(code.co_names + code.co_varnames)
+	for const in code.co_consts:
+		if hasattr(const, 'co_names'):
+			names.update(_referenced_names(const))
+	return names
+
+class TestCodeGeneration(TestCase):
+	def compiled_names(self, pipeline, **kw):
+		return _referenced_names(main.compile_pipe_exprs(main.split_on_pipes(pipeline), **kw))
+
+	def test_string_methods_and_predicates_skip_result_checks(self):
+		names = self.compiled_names('p.strip().upper() | p.startswith("A") | "x" not in p', input_lines=True)
+		self.assertNotIn('callable', names)
+		self.assertNotIn('_check_for_failed_commands', names)
+		self.assertEqual(
+			run('p.strip().upper() | p.startswith("A") | "X" not in p', [' abc ', 'bcd', 'axe', ' ']),
+			['ABC'])
+
+	def test_unknown_results_are_still_checked(self):
+		self.assertIn('callable', self.compiled_names('p.strip() | int(p)', input_lines=True))
+		# `p` isn't known to be a string after a file-level expression
+		self.assertIn('callable', self.compiled_names('pp.merge() | p.upper()', input_lines=True))
+		self.assertEqual(run('p.strip() | repr', [' a']), [repr('a')])
+
+	def test_commands_are_checked_when_they_may_be_used(self):
+		self.assertIn('_check_for_failed_commands', self.compiled_names('sh("echo", p) | p.upper()'))
+		self.assertIn('_check_for_failed_commands', self.compiled_names('fn(p)'))
+		self.assertIn('_check_for_failed_commands', self.compiled_names('len(p)', rebound=['len']))
+		self.assertRaises(subprocess.CalledProcessError,
+			lambda: run('--eval=len = lambda x: sh("false")', 'len(p) | p.upper()', ['a']))
+
+	def test_profiling_probes_are_only_added_when_profiling(self):
+		self.assertNotIn('_profiler', self.compiled_names('p.upper() | pp.sort()', input_lines=True))
+		self.assertIn('_profiler', self.compiled_names('p.upper() | pp.sort()', input_lines=True, profile=True))
+
+	def test_loop_invariants_are_hoisted(self):
+		pipeline = 'p.upper() | p in set("A B".split()) and p.matches(re.compile("[A-Z]"))'
+		self.assertIn('_hoisted_0', self.compiled_names(pipeline))
+		self.assertNotIn('_hoisted_0', self.compiled_names(pipeline, hoist=False))
+		for opts in [[], ['--no-hoist']]:
+			self.assertEqual(run(*opts + [pipeline, ['a', 'b', 'c']]), ['A', 'B'])
+
+	def test_hoisted_errors_happen_when_they_otherwise_would(self):
+		pipeline = 'p == "skip" or p in set(open("/nonexistent").read().split())'
+		self.assertEqual(run(pipeline, []), [])
+		self.assertEqual(run(pipeline, ['skip']), ['skip'])
+		self.assertRaises(IOError, lambda: run(pipeline, ['skip', 'x']))
+
+	def test_values_which_may_be_modified_are_not_hoisted(self):
+		self.assertEqual(
+			run('--eval=seen=set()', 'p not in frozenset(seen) and not seen.add(p)', ['a', 'b', 'a']),
+			['a', 'b'])
+		self.assertEqual(run('x = list("ab") | x.append(p) or len(x)', ['a', 'b']), ['3', '3'])
+
+	def test_regexes_are_precompiled(self):
+		pipeline = 'p.lower() | p.matches("a+b") | re.sub("a+", "-", p, flags=re.I)'
+		names = self.compiled_names(pipeline, input_lines=True)
+		self.assertIn('_compile_regex', names)
+		self.assertIn('_hoisted_1', names)
+		self.assertEqual(run(pipeline, ['aAb', 'b', 'ab']), ['-b', '-b'])
+		self.assertEqual(run('re.findall("[0-9]", p) | "".join(p)', ['a1b2']), ['12'])
+		self.assertRaises(re.error, lambda: run('p.matches("(")', ['a']))
+
+	def test_string_method_chains_use_plain_strings(self):
+		pipeline = 'p.strip().lower().split()[1] | p.ext() | p.upper().startswith(".P")'
+		self.assertIn('_str', self.compiled_names(pipeline, input_lines=True))
+		self.assertEqual(run(pipeline, [' A B.PY ', 'a b.txt']), ['.py'])
+		# results are still Lines wherever they're visible
+		self.assertEqual(run('p.strip().upper() | type(p).__name__', [' a ']), ['Line'])
+		self.assertEqual(run('p.strip().split() | type(p[0]).__name__', [' a ']), ['Line'])